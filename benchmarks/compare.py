@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Compares two result files written by run.py. Every number found in both
+is printed with its relative change:
+
+    python benchmarks/compare.py before.json after.json
+
+Latencies (seconds) are better when lower; rates (per second) are better
+when higher. Changes beyond the threshold are marked as a regression (!)
+or an improvement (+).
+"""
+
+from optparse import OptionParser
+import json
+
+def flatten(value, path=''):
+    """
+    Flattens the numbers of a result tree into a dict keyed by their path.
+    Lists of measurements are keyed by their 'clients', 'bytes', 'codec'
+    and 'payload' fields.
+    """
+    numbers = {}
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            numbers.update(flatten(item, '%s/%s' % (path, key)))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            key = index
+            if isinstance(item, dict):
+                keys = [str(item[field]) for field in ('clients', 'bytes', 'codec', 'payload')
+                        if item.has_key(field)]
+                if len(keys) != 0:
+                    key = ','.join(keys)
+            numbers.update(flatten(item, '%s[%s]' % (path, key)))
+    elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        numbers[path] = value
+    return numbers
+
+def main():
+    parser = OptionParser(usage='%prog [options] before.json after.json')
+    parser.add_option('-t', '--threshold', type='float', default=5.0,
+                      help='percentage of change to mark (default: 5)')
+    settings, files = parser.parse_args()
+    if len(files) != 2:
+        parser.error('two result files are needed')
+    before, after = [flatten(json.load(open(name))['results']) for name in files]
+
+    for path in sorted(set(before) & set(after)):
+        old, new = before[path], after[path]
+        if old == 0:
+            continue
+        change = (new - old) * 100.0 / old
+        higher_is_better = path.endswith('per_second') or path.endswith('calls')
+        mark = ' '
+        if abs(change) >= settings.threshold:
+            mark = (change > 0) == higher_is_better and '+' or '!'
+        print '%s %-60s %14.6g %14.6g %+8.1f%%' % (mark, path, old, new, change)
+
+if __name__ == '__main__':
+    main()
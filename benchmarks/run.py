@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the single connection RPC library. A server is started on
+the loopback interface and measured with the following benchmarks:
+
+    latency      round-trip time percentiles of a no-op call
+    throughput   no-op calls per second with 1 to N client threads and
+                 client processes
+    payload      echo calls with payloads from 100 B to 100 MB
+    connect      the cost of connecting (and negotiating) and closing
+    compression  bandwidth saved against CPU time spent per codec
+
+The results are written as JSON, so runs can be compared with compare.py:
+
+    python benchmarks/run.py -o before.json
+    python benchmarks/run.py -o after.json
+    python benchmarks/compare.py before.json after.json
+
+The server listens on TCP, or on a Unix domain socket with -t unix. With
+-m, payloads of at least the given size are passed in shared memory. The
+benchmarks use the scrpc package of this source tree.
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scrpc import SCRPC, SCProxy, AsyncSCRPC
+from scrpc.compression import available_codecs, compression_stats, reset_compression_stats
+from threading import Thread
+from multiprocessing import Pool
+from optparse import OptionParser
+import platform
+import tempfile
+import random
+import json
+import time
+
+BENCHMARKS = ('latency', 'throughput', 'payload', 'connect', 'compression')
+PAYLOAD_SIZES = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+PERCENTILES = (50, 90, 99, 99.9)
+
+def nop():
+    return None
+
+def echo(data):
+    return data
+
+def percentiles(samples):
+    """
+    Summarizes a list of durations.
+    @rtype: dict
+    @return: The nearest-rank percentiles in PERCENTILES ('p50' etc.), the
+    'mean', 'min' and 'max', all in seconds, and the number of 'samples'.
+    """
+    samples = sorted(samples)
+    summary = {'samples': len(samples), 'mean': sum(samples) / len(samples),
+               'min': samples[0], 'max': samples[-1]}
+    for percentile in PERCENTILES:
+        rank = int(round(percentile / 100.0 * len(samples) + 0.5)) - 1
+        summary['p%s' % ('%g' % percentile).replace('.', '_')] = samples[min(max(rank, 0), len(samples) - 1)]
+    return summary
+
+def start_server(kind, transport='tcp'):
+    """
+    Starts a server on the loopback interface.
+    @type kind: str
+    @param kind: 'thread' for SCRPC or 'async' for AsyncSCRPC.
+    @type transport: str
+    @param transport: 'tcp', or 'unix' for a Unix domain socket.
+    @return: The server and its address.
+    """
+    address = ('127.0.0.1', 0)
+    if transport == 'unix':
+        address = os.path.join(tempfile.mkdtemp(), 'scrpc.sock')
+    if kind == 'async':
+        server = AsyncSCRPC(address)
+    else:
+        server = SCRPC(address)
+    server.register_function(nop)
+    server.register_function(echo)
+    server.setDaemon(True)
+    server.start()
+    if transport == 'unix':
+        return server, address
+    return server, ('127.0.0.1', server.get_address()[1])
+
+def bench_latency(address, options, settings):
+    """Measures the round-trip time of no-op calls on one connection."""
+    proxy = SCProxy(address, **options) #IGNORE:W0142
+    try:
+        for _ in xrange(settings.warmup):
+            proxy.nop()
+        samples = []
+        for _ in xrange(settings.calls):
+            started = time.time()
+            proxy.nop()
+            samples.append(time.time() - started)
+    finally:
+        proxy.close()
+    return percentiles(samples)
+
+def count_calls(address, options, start, duration):
+    """
+    Makes no-op calls on a connection of its own from start until the
+    duration has passed. Runs in client threads and processes.
+    @rtype: int
+    @return: The number of calls made.
+    """
+    proxy = SCProxy(address, **options) #IGNORE:W0142
+    try:
+        proxy.nop()
+        time.sleep(max(start - time.time(), 0))
+        calls = 0
+        end = start + duration
+        while time.time() < end:
+            proxy.nop()
+            calls += 1
+        return calls
+    finally:
+        proxy.close()
+
+def client_counts(maximum):
+    """Returns 1, 2, 4, ... up to and including maximum."""
+    counts = []
+    count = 1
+    while count < maximum:
+        counts.append(count)
+        count *= 2
+    return counts + [maximum]
+
+def bench_throughput(address, options, settings):
+    """Measures calls per second with several client threads and processes."""
+    results = {'threads': [], 'processes': []}
+    for threads in client_counts(settings.max_threads):
+        counts = [0] * threads
+        start = time.time() + 0.5
+        def client(index):
+            counts[index] = count_calls(address, options, start, settings.duration)
+        workers = [Thread(target=client, args=(index, )) for index in xrange(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        results['threads'].append({'clients': threads, 'calls': sum(counts),
+                                   'calls_per_second': sum(counts) / settings.duration})
+    for processes in client_counts(settings.max_processes):
+        pool = Pool(processes)
+        try:
+            start = time.time() + 1.0
+            jobs = [pool.apply_async(count_calls, (address, options, start, settings.duration))
+                    for _ in xrange(processes)]
+            counts = [job.get() for job in jobs]
+        finally:
+            pool.terminate()
+        results['processes'].append({'clients': processes, 'calls': sum(counts),
+                                     'calls_per_second': sum(counts) / settings.duration})
+    return results
+
+def bench_payload(address, options, settings):
+    """Measures echo calls with payloads of increasing size."""
+    proxy = SCProxy(address, **options) #IGNORE:W0142
+    results = []
+    try:
+        for size in PAYLOAD_SIZES:
+            if size > settings.max_payload:
+                break
+            payload = 'x' * size
+            proxy.echo(payload)
+            # Large payloads take long; fewer calls give the same precision.
+            calls = max(3, min(settings.calls, 10000000 / size))
+            samples = []
+            for _ in xrange(calls):
+                started = time.time()
+                proxy.echo(payload)
+                samples.append(time.time() - started)
+            summary = percentiles(samples)
+            results.append({'bytes': size, 'seconds': summary,
+                            'megabytes_per_second': 2 * size / summary['p50'] / 1e6})
+    finally:
+        proxy.close()
+    return results
+
+def bench_connect(address, options, settings):
+    """Measures connecting to the server (with negotiation) and closing."""
+    connect = []
+    close = []
+    for _ in xrange(max(settings.calls / 10, 10)):
+        started = time.time()
+        proxy = SCProxy(address, **options) #IGNORE:W0142
+        connected = time.time()
+        proxy.close()
+        connect.append(connected - started)
+        close.append(time.time() - connected)
+    return {'connect': percentiles(connect), 'close': percentiles(close)}
+
+def bench_compression(address, options, settings):
+    """
+    Measures echo calls of compressible and incompressible payloads with
+    every available codec, and what the compression saved and cost.
+    """
+    generator = random.Random(0)
+    words = ['%x' % generator.getrandbits(24) for _ in xrange(1000)]
+    payloads = {'text': ' '.join([generator.choice(words) for _ in xrange(200000)]),
+                'random': ''.join([chr(generator.getrandbits(8)) for _ in xrange(1000000)])}
+    results = []
+    for codec in [None] + available_codecs():
+        codec_options = dict(options)
+        if codec != None:
+            codec_options['compression'] = (codec, )
+        proxy = SCProxy(address, **codec_options) #IGNORE:W0142
+        try:
+            for name, payload in sorted(payloads.items()):
+                proxy.echo(payload)
+                reset_compression_stats()
+                samples = []
+                for _ in xrange(settings.repeat):
+                    started = time.time()
+                    proxy.echo(payload)
+                    samples.append(time.time() - started)
+                # Both directions are compressed in the same process.
+                stats = compression_stats().get(codec, {})
+                results.append({'codec': codec, 'payload': name, 'bytes': len(payload),
+                                'seconds': percentiles(samples),
+                                'bytes_in': stats.get('bytes_in', 0),
+                                'bytes_out': stats.get('bytes_out', 0),
+                                'compression_seconds': stats.get('seconds', 0.0)})
+        finally:
+            proxy.close()
+    return results
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-b', '--benchmarks', default=','.join(BENCHMARKS),
+                      help='comma separated benchmarks to run (default: all)')
+    parser.add_option('-o', '--output', help='file to write the results to (default: stdout)')
+    parser.add_option('-s', '--server', default='thread', choices=('thread', 'async'),
+                      help='thread (SCRPC) or async (AsyncSCRPC)')
+    parser.add_option('-t', '--transport', default='tcp', choices=('tcp', 'unix'),
+                      help='tcp or unix (domain socket)')
+    parser.add_option('-m', '--shared-memory', type='int', default=None,
+                      help='size from which payloads are passed in shared memory')
+    parser.add_option('-p', '--protocol', type='int', default=None, help='protocol version to use')
+    parser.add_option('--serializer', default='pickle', help='serializer to use')
+    parser.add_option('-n', '--calls', type='int', default=10000, help='calls per measurement')
+    parser.add_option('--warmup', type='int', default=1000, help='calls before measuring latency')
+    parser.add_option('-d', '--duration', type='float', default=3.0,
+                      help='seconds per throughput measurement')
+    parser.add_option('--max-threads', type='int', default=16, help='most client threads')
+    parser.add_option('--max-processes', type='int', default=8, help='most client processes')
+    parser.add_option('--max-payload', type='int', default=PAYLOAD_SIZES[-1], help='largest payload')
+    parser.add_option('--repeat', type='int', default=20, help='calls per compression measurement')
+    parser.add_option('-q', '--quick', action='store_true', help='a short run for smoke testing')
+    settings, _ = parser.parse_args()
+    if settings.quick:
+        settings.calls, settings.warmup, settings.duration = 500, 100, 0.5
+        settings.max_threads, settings.max_processes, settings.repeat = 4, 2, 3
+        settings.max_payload = min(settings.max_payload, 1000000)
+    benchmarks = settings.benchmarks.split(',')
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark (%s)' % name)
+
+    options = {'serializers': (settings.serializer, )}
+    if settings.protocol != None:
+        options['protocol'] = settings.protocol
+    if settings.shared_memory != None:
+        options['shared_memory'] = settings.shared_memory
+    server, address = start_server(settings.server, settings.transport)
+    report = {'meta': {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'server': settings.server, 'transport': settings.transport,
+                       'options': options,
+                       'settings': dict(vars(settings))},
+              'results': {}}
+    try:
+        for name in benchmarks:
+            sys.stderr.write('%s...\n' % name)
+            report['results'][name] = globals()['bench_%s' % name](address, options, settings)
+    finally:
+        server.stop()
+        if settings.transport == 'unix':
+            server.teardown()
+            os.rmdir(os.path.dirname(address))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if settings.output:
+        out = open(settings.output, 'w')
+        try:
+            out.write(output + '\n')
+        finally:
+            out.close()
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
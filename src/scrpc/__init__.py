@@ -1,2 +1,7 @@
 from server import SCRPC
-from client import SCProxy
+from client import SCProxy, SCFuture, SCStream, SCUpload, SCBatch
+from asyncrpc import AsyncSCRPC, AsyncSCProxy
+from pool import SCProxyPool
+from cache import ResultCache
+from cancellation import CancellationToken, current_token
+from metrics import Metrics, MetricsHook
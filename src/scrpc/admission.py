@@ -0,0 +1,192 @@
+"""
+Admission control of the calls performed by an SCRPC server. A call is
+performed right away while the server is below its limits: the number of
+calls performed at once (in flight), in total and per function. Beyond
+them the call waits in a queue, and once the queue is full calls are shed:
+they are answered with an overloaded NACK without being performed, so
+the client can retry them elsewhere. This keeps the latency of the calls
+that are performed bounded instead of letting every call wait longer and
+longer for a thread.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from threading import Event
+from collections import deque
+from protocol import overloaded_message
+
+class AdmissionControl(object):
+    """
+    Tracks the calls in flight and queued, and decides which calls are
+    performed, queued or shed. Queued calls are admitted first come, first
+    served, as far as the limits of their functions allow. All methods are
+    thread-safe.
+    """
+
+    def __init__(self, max_calls=None, max_queued=None, queue_timeout=None):
+        """
+        Constructor.
+        @type max_calls: int
+        @param max_calls: The maximum number of calls in flight, or None for
+        no limit.
+        @type max_queued: int
+        @param max_queued: The maximum number of calls waiting to be
+        performed, or None for no limit. 0 sheds calls as soon as a limit is
+        reached.
+        @type queue_timeout: float
+        @param queue_timeout: The maximum number of seconds a call waits in
+        the queue before it is shed, or None for no limit. Calls with a
+        deadline wait until the deadline at most.
+        @raise ValueError: If a limit is invalid.
+        """
+        super(AdmissionControl, self).__init__()
+        if max_calls != None and max_calls < 1:
+            raise ValueError('Invalid maximum number of calls (%i)' % max_calls)
+        if max_queued != None and max_queued < 0:
+            raise ValueError('Invalid maximum number of queued calls (%i)' % max_queued)
+        if queue_timeout != None and queue_timeout <= 0:
+            raise ValueError('Invalid queue timeout (%f)' % queue_timeout)
+        self.__max_calls = max_calls
+        self.__max_queued = max_queued
+        self.__queue_timeout = queue_timeout
+        # The limits of the functions that have one, indexed by name.
+        self.__limits = {}
+        # The calls in flight, in total and indexed by function name.
+        self.__in_flight = 0
+        self.__running = {}
+        # The function names and wake up events of the queued calls, oldest
+        # first.
+        self.__queue = deque()
+        self.__admitted = 0
+        self.__delayed = 0
+        self.__shed = 0
+        self.__lock = allocate_lock()
+
+    def set_limit(self, function_name, limit):
+        """
+        Limits the number of calls of a function in flight.
+        @type limit: int
+        @param limit: The limit, or None to remove it.
+        @raise ValueError: If the limit is invalid.
+        """
+        if limit != None and limit < 1:
+            raise ValueError('Invalid maximum number of calls (%i)' % limit)
+        with self.__lock:
+            if limit == None:
+                self.__limits.pop(function_name, None)
+            else:
+                self.__limits[function_name] = limit
+            self.__wake()
+
+    def sheds(self):
+        """Returns whether calls are shed when the queue is full."""
+        return self.__max_queued != None
+
+    def check(self, function_name):
+        """
+        Checks whether a call would be shed, without admitting it. Lets the
+        server shed calls before spending anything on them.
+        @rtype: str
+        @return: None, or the message to shed the call with.
+        """
+        with self.__lock:
+            if self.__runnable(function_name) or self.__max_queued == None or \
+               len(self.__queue) < self.__max_queued:
+                return None
+            self.__shed += 1
+        return overloaded_message('too many queued calls')
+
+    def enter(self, function_name, token=None):
+        """
+        Admits a call, waiting in the queue while a limit is reached. Calls
+        admitted must be followed by leave once they are performed.
+        @type function_name: str
+        @param function_name: The function called.
+        @type token: CancellationToken
+        @param token: The cancellation token of the call, or None.
+        @rtype: str
+        @return: None if the call has been admitted, or the message to NACK
+        the call with.
+        """
+        with self.__lock:
+            if self.__runnable(function_name):
+                self.__start(function_name)
+                return None
+            if self.__max_queued != None and len(self.__queue) >= self.__max_queued:
+                self.__shed += 1
+                return overloaded_message('too many queued calls')
+            waiter = (function_name, Event())
+            self.__queue.append(waiter)
+            self.__delayed += 1
+
+        timeout = self.__queue_timeout
+        if token != None and token.deadline != None:
+            remaining = token.remaining()
+            if timeout == None or remaining < timeout:
+                timeout = remaining
+        waiter[1].wait(timeout)
+
+        with self.__lock:
+            # The call may have been admitted just after the wait timed out.
+            if waiter[1].is_set():
+                return None
+            self.__queue.remove(waiter)
+            self.__shed += 1
+        if token != None and token.reason() != None:
+            return token.reason()
+        return overloaded_message('call queued for too long')
+
+    def leave(self, function_name):
+        """Tells that a call admitted by enter has been performed."""
+        with self.__lock:
+            self.__in_flight -= 1
+            running = self.__running[function_name] - 1
+            if running == 0:
+                del self.__running[function_name]
+            else:
+                self.__running[function_name] = running
+            self.__wake()
+
+    def stats(self):
+        """
+        @rtype: dict
+        @return: The number of calls 'in_flight' and 'queued' now, the
+        numbers of calls 'admitted', that had to wait in the queue
+        ('delayed') and 'shed' so far, and the calls in flight per function
+        ('functions').
+        """
+        with self.__lock:
+            return {'in_flight': self.__in_flight, 'queued': len(self.__queue),
+                    'admitted': self.__admitted, 'delayed': self.__delayed, 'shed': self.__shed,
+                    'functions': dict(self.__running)}
+
+    def __runnable(self, function_name):
+        """
+        Checks whether a call is within the limits. Must be called with the
+        lock held.
+        """
+        if self.__max_calls != None and self.__in_flight >= self.__max_calls:
+            return False
+        limit = self.__limits.get(function_name)
+        return limit == None or self.__running.get(function_name, 0) < limit
+
+    def __start(self, function_name):
+        """Counts a call as in flight. Must be called with the lock held."""
+        self.__in_flight += 1
+        self.__running[function_name] = self.__running.get(function_name, 0) + 1
+        self.__admitted += 1
+
+    def __wake(self):
+        """
+        Admits the queued calls that are within the limits, oldest first.
+        Must be called with the lock held.
+        """
+        if len(self.__queue) == 0:
+            return
+        for waiter in list(self.__queue):
+            if self.__max_calls != None and self.__in_flight >= self.__max_calls:
+                break
+            if self.__runnable(waiter[0]):
+                self.__queue.remove(waiter)
+                self.__start(waiter[0])
+                waiter[1].set()
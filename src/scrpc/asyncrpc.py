@@ -0,0 +1,1071 @@
+"""
+Event-loop based versions of the single-connection RPC server and client.
+Instead of a thread per connection, all connections are multiplexed on a
+single EventLoop. Registered functions are either performed in an executor
+(the default) or, when registered as asynchronous, called directly on the
+loop thread.
+"""
+
+from __future__ import with_statement
+from threading import Thread, currentThread
+from thread import allocate_lock
+from functools import partial
+from types import TupleType, GeneratorType
+from socket import error as socket_error
+import struct
+from eventloop import EventLoop, FramedConnection, READ
+from executor import ThreadPool, ProcessPool
+from timedsocket import TimedSocket, address_type, open_connection
+from server import SCRPC, SCFunctionTable, run_function, next_chunk, marshal_outcome, check_batch, run_batch, \
+    wait_for_process
+from client import SCProxy, SCFuture, SCStream, SCBatch, decode_reply, feed_stream, split_uploads, send_upload, \
+    copy_outcome, complete_batch
+from streaming import STREAM_WINDOW, StreamWindow
+from serializers import DEFAULT_SERIALIZER, get_serializer, check_serializers, select_serializer
+from compression import COMPRESSION_THRESHOLD, CompressionError, check_codecs, get_codec, \
+    select_codec, compress_payload, decompress_payload
+from protocol import PROTOCOL_VERSION, HELLO_FUNCTION, HELLO, CALL, EXCEPTION, ACK, NACK, \
+    STREAM, CHUNK, MORE, STOP, UPLOAD, DATA, EOF, BATCH, CANCEL, SERVER_BUSY, NO_COMMON_SERIALIZER, ProtocolError, \
+    busy_message, overloaded_message, hello_request, hello_reply, parse_hello, pack_frame, parse_frame, \
+    split_deadline, upload_id
+from cancellation import CancellationToken, set_current_token
+import logging
+import time
+
+class AsyncStream(object):
+    """The state of a stream sent by an AsyncSCConnection."""
+
+    def __init__(self, generator):
+        super(AsyncStream, self).__init__()
+        self.generator = generator
+        # The number of chunks that may be sent before the client grants more.
+        self.credits = STREAM_WINDOW
+        # Whether a chunk is being pulled out of the generator.
+        self.busy = False
+        # Whether the generator has begun to run.
+        self.started = False
+        self.stopped = False
+
+class AsyncSCConnection(FramedConnection):
+    """A client connection of an AsyncSCRPC server."""
+
+    def __init__(self, loop, sock, rpcserver):
+        super(AsyncSCConnection, self).__init__(loop, sock)
+        self.__server = rpcserver
+        self.__protocol = 1
+        # Pickle is used until the client negotiates something else. It is
+        # None if the server does not allow pickle.
+        self.__serializer = rpcserver.default_serializer()
+        # The compression codec. None until the client negotiates one.
+        self.__codec = None
+        # The dispatch record of a version 1 call waiting for input.
+        self.__awaiting_input = None
+        # The streams in progress, indexed by call id.
+        self.__streams = {}
+        # The iterators of the uploads in progress, indexed by upload id, and
+        # the uploads of each call, indexed by call id.
+        self.__uploads = {}
+        self.__upload_calls = {}
+        # The cancellation tokens of the calls in progress, indexed by call
+        # id (protocol version 8).
+        self.__tokens = {}
+
+    def connection_closed(self):
+        self.__server.remove_connection(self)
+        for upload in self.__uploads.itervalues():
+            upload.finish(SCRPC.Error('Connection to client lost.'))
+        for call_id in self.__streams.keys():
+            self.__stop_stream(call_id)
+
+    def frame_received(self, frame):
+        """Dispatches a frame received from the client."""
+        logger = logging.getLogger('SCRPC (server)')
+        if self.__awaiting_input != None:
+            self.__perform_rpc(frame)
+        elif frame[:4] == CALL and self.__protocol >= 2:
+            self.__perform_call(frame)
+        elif frame[:5] == BATCH and self.__protocol >= 5:
+            self.__perform_batch(frame)
+        elif frame[:6] == CANCEL and self.__protocol >= 8:
+            self.__cancel_call(frame)
+        elif (frame[:4] == MORE or frame[:4] == STOP) and self.__protocol >= 3:
+            self.__control_stream(frame)
+        elif frame[:6] == UPLOAD and self.__protocol >= 4:
+            self.__announce_uploads(frame)
+        elif (frame[:4] == DATA or frame[:3] == EOF) and self.__protocol >= 4:
+            self.__receive_upload(frame)
+        elif frame[:7] == 'PERFORM':
+            request = str(frame[8:])
+            if request.split(' ')[0] == HELLO_FUNCTION:
+                self.__negotiate(request)
+            else:
+                self.__start_rpc(request)
+        else:
+            logger.debug('Ignoring unknown command.')
+
+    def __negotiate(self, request):
+        """Handles a protocol negotiation request from the client."""
+        try:
+            version, options = parse_hello(request.split(' ')[1:])
+        except ProtocolError:
+            self.send_frame('NACK Invalid negotiation request.')
+            return
+        reply_options = {}
+        if options.has_key('serializers'):
+            serializer = select_serializer(options['serializers'].split(','),
+                                           self.__server.allowed_serializers())
+            if serializer == None:
+                self.send_frame('%s %s.' % (NACK, NO_COMMON_SERIALIZER))
+                return
+            self.__serializer = serializer
+            reply_options['serializer'] = serializer.name
+        if options.has_key('compression'):
+            self.__codec = select_codec(options['compression'].split(','),
+                                        self.__server.allowed_codecs())
+            if self.__codec != None:
+                reply_options['compression'] = self.__codec.name
+        self.__protocol = min(version, PROTOCOL_VERSION)
+        self.send_frame(hello_reply(self.__protocol, reply_options))
+
+    def __start_rpc(self, function_name):
+        """Handles the PERFORM request of a version 1 call."""
+        dispatch = self.__server.get_record(function_name)
+        if dispatch == None:
+            self.send_frame('NACK Function (%s) does not exist.' % function_name)
+            return
+        if self.__server.default_serializer() == None:
+            # Version 1 input is always pickled.
+            self.send_frame('NACK Pickled input is not accepted.')
+            return
+        self.send_frame(ACK)
+
+        # <HACK> See SCWorker.__perform_rpc.
+        if dispatch.intent != None: dispatch.intent(False)
+        # </HACK>
+
+        self.__awaiting_input = dispatch
+
+    def __perform_rpc(self, cmd_input):
+        """Handles the input frame of a version 1 call."""
+        dispatch = self.__awaiting_input
+        self.__awaiting_input = None
+        intent_function = dispatch.intent
+
+        argument_list = self.__unmarshal(cmd_input, intent_function, DEFAULT_SERIALIZER)
+        if argument_list == None:
+            return
+        busy = self.__server.busy()
+        if busy != None:
+            # <HACK>
+            if intent_function: intent_function(True)
+            # </HACK>
+            self.send_frame('%s %s' % (NACK, busy))
+            return
+        self.send_frame(ACK)
+        self.__server.dispatch(dispatch, argument_list, DEFAULT_SERIALIZER, self.__reply_v1)
+
+    def __reply_v1(self, verb, payload):
+        if isinstance(payload, str):
+            payload = (payload, )
+        self.send_frame(('%s ' % verb, ) + payload)
+
+    def __perform_call(self, frame):
+        """Handles a version 2 CALL frame."""
+        try:
+            _, flags, (call_id, function_name), cmd_input = parse_frame(frame, 2)
+            seconds, function_name = split_deadline(flags, function_name)
+        except (ProtocolError, ValueError):
+            logging.getLogger('SCRPC (server)').debug('Malformed CALL frame.', exc_info=True)
+            self.handle_close()
+            return
+        token = None
+        if self.__protocol >= 8:
+            token = CancellationToken()
+            if seconds != None:
+                token.deadline = time.time() + seconds
+            if token.expired():
+                self.__reply_v2(call_id, NACK, token.reason())
+                return
+            self.__tokens[call_id] = token
+
+        dispatch = self.__server.get_record(function_name)
+        if dispatch == None:
+            self.__reply_v2(call_id, NACK, 'Function (%s) does not exist.' % function_name)
+            return
+        serializer = self.__serializer
+        if serializer == None:
+            self.__reply_v2(call_id, NACK, 'No serializer has been negotiated.')
+            return
+        try:
+            cmd_input = decompress_payload(self.__codec, flags, cmd_input)
+        except CompressionError, excep:
+            self.__reply_v2(call_id, NACK, str(excep))
+            return
+
+        # <HACK> See SCWorker.__perform_rpc.
+        intent_function = dispatch.intent
+        if intent_function != None: intent_function(False)
+        # </HACK>
+
+        argument_list = self.__unmarshal(cmd_input, intent_function, serializer, call_id)
+        if argument_list == None:
+            return
+        busy = self.__server.busy()
+        if busy != None:
+            # <HACK>
+            if intent_function: intent_function(True)
+            # </HACK>
+            self.__reply_v2(call_id, NACK, busy)
+            return
+
+        # Put the iterators of the uploads in place of their arguments. They
+        # are consumed in the executor, as reading them blocks.
+        uploads = self.__upload_calls.get(call_id, ())
+        if len(uploads) != 0:
+            if not self.__server.accepts_uploads(function_name):
+                # <HACK>
+                if intent_function: intent_function(True)
+                # </HACK>
+                self.__reply_v2(call_id, NACK, 'Function (%s) cannot take uploads.' % function_name)
+                return
+            argument_list = list(argument_list)
+            for position, upload in uploads:
+                if position >= len(argument_list):
+                    self.__reply_v2(call_id, NACK, 'Invalid upload position.')
+                    return
+                argument_list[position] = upload
+            argument_list = tuple(argument_list)
+        self.__server.dispatch(dispatch, argument_list, serializer, partial(self.__reply_v2, call_id),
+                               self.__protocol >= 3, token)
+
+    def __cancel_call(self, frame):
+        """Handles a CANCEL frame of the client."""
+        try:
+            _, _, (call_id, ), _ = parse_frame(frame)
+        except (ProtocolError, ValueError):
+            logging.getLogger('SCRPC (server)').debug('Malformed CANCEL frame.', exc_info=True)
+            return
+        token = self.__tokens.get(call_id)
+        if token != None:
+            token.cancel()
+
+    def __perform_batch(self, frame):
+        """Handles a BATCH frame."""
+        try:
+            _, flags, (call_id, mode), cmd_input = parse_frame(frame, 2)
+        except (ProtocolError, ValueError):
+            logging.getLogger('SCRPC (server)').debug('Malformed BATCH frame.', exc_info=True)
+            self.handle_close()
+            return
+        serializer = self.__serializer
+        if serializer == None:
+            self.__reply_v2(call_id, NACK, 'No serializer has been negotiated.')
+            return
+        try:
+            calls = serializer.loads(decompress_payload(self.__codec, flags, cmd_input))
+        except CompressionError, excep:
+            self.__reply_v2(call_id, NACK, str(excep))
+            return
+        except serializer.errors + (ImportError, ), excep:
+            logging.getLogger('SCRPC (server)').debug('Unmarshaling error', exc_info=True)
+            self.__reply_v2(call_id, EXCEPTION, serializer.dumps_exception(excep))
+            return
+        calls = check_batch(calls)
+        if calls == None:
+            self.__reply_v2(call_id, NACK, 'Batch must be a list of calls.')
+            return
+        busy = self.__server.busy()
+        if busy != None:
+            self.__reply_v2(call_id, NACK, busy)
+            return
+        self.__server.dispatch_batch(calls, serializer, mode == 'parallel',
+                                     partial(self.__reply_v2, call_id))
+
+    def __reply_v2(self, call_id, verb, payload):
+        if len(self.__tokens) != 0:
+            self.__tokens.pop(call_id, None)
+        if verb == STREAM:
+            self.__start_stream(call_id, payload)
+            return
+        if verb != CHUNK and len(self.__upload_calls) != 0:
+            # The call (or its stream) is over.
+            self.__end_uploads(call_id)
+        flags, payload = compress_payload(self.__codec, payload, self.__server.COMPRESSION_THRESHOLD)
+        self.send_frame(pack_frame(verb, (call_id,), payload, flags))
+
+    def __start_stream(self, call_id, generator):
+        """Starts streaming the items of a generator to the client."""
+        if self.closed:
+            generator.close()
+            return
+        self.__streams[call_id] = AsyncStream(generator)
+        self.send_frame(pack_frame(STREAM, (call_id, )))
+        self.__pump(call_id)
+
+    def __pump(self, call_id):
+        """Pulls the next chunk of a stream if the client has granted it."""
+        stream = self.__streams.get(call_id)
+        if stream == None or stream.busy or stream.credits == 0:
+            return
+        stream.busy = True
+        stream.credits -= 1
+        self.__server.pull_chunk(stream.generator, self.__serializer,
+                                 partial(self.__chunk_pulled, call_id), stream.started)
+        stream.started = True
+
+    def __chunk_pulled(self, call_id, verb, payload):
+        """Sends a chunk pulled out of the generator of a stream."""
+        stream = self.__streams.get(call_id)
+        stream.busy = False
+        if stream.stopped:
+            self.__stop_stream(call_id)
+            return
+        self.__reply_v2(call_id, verb, payload)
+        if verb != CHUNK:
+            # The generator may have been cut short.
+            self.__stop_stream(call_id)
+            return
+        self.__pump(call_id)
+
+    def __control_stream(self, frame):
+        """Handles the MORE and STOP frames of the client."""
+        try:
+            verb, _, fields, _ = parse_frame(frame)
+            stream = self.__streams.get(fields[0])
+            if stream == None:
+                # The stream has ended already.
+                return
+            if verb == MORE:
+                stream.credits += int(fields[1])
+                self.__pump(fields[0])
+            else:
+                self.__stop_stream(fields[0])
+        except (ProtocolError, IndexError, ValueError):
+            logging.getLogger('SCRPC (server)').debug('Malformed stream control frame.', exc_info=True)
+
+    def __stop_stream(self, call_id):
+        """
+        Ends a stream. If a chunk is being pulled, the stream ends once it 
+        has been.
+        """
+        stream = self.__streams[call_id]
+        stream.stopped = True
+        if not stream.busy:
+            del self.__streams[call_id]
+            stream.generator.close()
+            self.__end_uploads(call_id)
+
+    def __announce_uploads(self, frame):
+        """Handles an UPLOAD frame announcing the uploads of a call."""
+        try:
+            _, _, (call_id, positions), _ = parse_frame(frame)
+            positions = [int(position) for position in positions.split(',')]
+        except (ProtocolError, ValueError):
+            logging.getLogger('SCRPC (server)').debug('Malformed UPLOAD frame.', exc_info=True)
+            return
+        uploads = []
+        for position in positions:
+            uid = upload_id(call_id, position)
+            upload = SCStream(partial(self.loop.call_soon_threadsafe, self.__grant_upload, uid),
+                              lambda: None)
+            self.__uploads[uid] = upload
+            uploads.append((position, upload))
+        self.__upload_calls[call_id] = uploads
+
+    def __receive_upload(self, frame):
+        """Handles the DATA and EOF frames of an upload."""
+        try:
+            verb, flags, fields, payload = parse_frame(frame)
+            upload = self.__uploads.get(fields[0])
+        except (ProtocolError, IndexError):
+            logging.getLogger('SCRPC (server)').debug('Malformed upload frame.', exc_info=True)
+            return
+        if upload == None:
+            # The call has finished already.
+            return
+        serializer = self.__serializer
+        try:
+            payload = decompress_payload(self.__codec, flags, payload)
+            if verb == DATA:
+                upload.feed(serializer.loads(payload))
+                return
+            del self.__uploads[fields[0]]
+            if len(payload) == 0:
+                upload.finish()
+            else:
+                upload.finish(serializer.loads_exception(payload))
+        except Exception, excep: #IGNORE:W0703
+            logging.getLogger('SCRPC (server)').debug('Error receiving upload.', exc_info=True)
+            upload.finish(excep)
+
+    def __grant_upload(self, uid, count):
+        """Lets the client send count more chunks of an upload."""
+        if self.__uploads.has_key(uid):
+            self.send_frame(pack_frame(MORE, (uid, count)))
+
+    def __end_uploads(self, call_id):
+        """
+        Forgets the uploads of a finished call, and stops the client 
+        sending those that are not complete.
+        """
+        for position, upload in self.__upload_calls.pop(call_id, ()):
+            uid = upload_id(call_id, position)
+            if self.__uploads.pop(uid, None) != None and not self.closed:
+                self.send_frame(pack_frame(STOP, (uid, )))
+            upload.finish()
+
+    def __unmarshal(self, cmd_input, intent_function, serializer, call_id=None):
+        """
+        Unmarshals and checks the input of a call. Errors are reported to
+        the client.
+        @rtype: tuple
+        @return: The argument list or None if the input was invalid.
+        """
+        if call_id == None:
+            reply = self.__reply_v1
+        else:
+            reply = partial(self.__reply_v2, call_id)
+        try:
+            argument_list = serializer.loads_arguments(cmd_input)
+        except serializer.errors + (ImportError, ), excep:
+            logging.getLogger('SCRPC (server)').debug('Unmarshaling error', exc_info=True)
+            # <HACK>
+            if intent_function: intent_function(True)
+            # </HACK>
+            reply(EXCEPTION, serializer.dumps_exception(excep))
+            return None
+        if type(argument_list) != TupleType:
+            # <HACK>
+            if intent_function: intent_function(True)
+            # </HACK>
+            if call_id == None:
+                self.send_frame('NACK Argument must be a tuple.')
+            else:
+                reply(NACK, 'Argument must be a tuple.')
+            return None
+        return argument_list
+
+class AsyncSCRPC(Thread):
+    """
+    The event-loop based single-connection RPC server. It is used like
+    SCRPC and speaks the same protocol, but handles all connections in one
+    thread.
+    """
+
+    EXECUTOR_THREADS = 16 # The size of the default executor.
+    PROCESS_POOL_SIZE = None # The number of worker processes. None means one per CPU.
+    LISTEN_BACKLOG = 128
+    COMPRESSION_THRESHOLD = COMPRESSION_THRESHOLD # Replies smaller than this are not compressed.
+
+    def __init__(self, address=('', 0), executor=None, max_connections=None, max_queued=None,
+                 serializers=None, compression=None):
+        """
+        Constructor.
+        @type address: tuple
+        @param address: The address that the RPC server should listen on for
+        incoming connection requests, or the path of a Unix domain socket.
+        @type executor: object
+        @param executor: The executor performing functions that are not
+        registered as asynchronous. It must have a submit(function, *args)
+        method returning a future with add_done_callback and result methods.
+        Defaults to a ThreadPool with EXECUTOR_THREADS threads.
+        @type max_connections: int
+        @param max_connections: The maximum number of client connections. 
+        Connections beyond this are refused with a NACK. None means no limit.
+        @type max_queued: int
+        @param max_queued: The maximum number of calls handed to the executor
+        and not yet finished. Calls beyond this are refused with a NACK. None
+        means no limit.
+        @type serializers: list
+        @param serializers: The names of the serializers clients may 
+        negotiate. None means all available serializers.
+        @type compression: list
+        @param compression: The names of the compression codecs clients may
+        negotiate. None means all available codecs.
+        @see: SCRPC.__init__
+        """
+        super(AsyncSCRPC, self).__init__()
+
+        self.__loop = EventLoop()
+        self.__server_sock = TimedSocket(type=address_type(address))
+        self.__server_sock.bind(address)
+        self.__server_sock.listen(AsyncSCRPC.LISTEN_BACKLOG)
+        self.__server_sock.sock.setblocking(0)
+
+        self.__own_executor = executor == None
+        if self.__own_executor:
+            executor = ThreadPool(AsyncSCRPC.EXECUTOR_THREADS)
+        self.__executor = executor
+        self.__process_pool = None
+        self.__process_pool_lock = allocate_lock()
+        self.__functions = SCFunctionTable()
+        self.__serializers = check_serializers(serializers)
+        self.__codecs = check_codecs(compression)
+        self.__asynchronous = set()
+        self.__connections = set()
+        self.__max_connections = max_connections
+        self.__max_queued = max_queued
+        self.__queued = 0
+
+    def fileno(self):
+        return self.__server_sock.sock.fileno()
+
+    def get_address(self):
+        return self.__server_sock.addr
+
+    def get_function(self, function_name):
+        return self.__functions.get(function_name)
+
+    def get_record(self, function_name):
+        return self.__functions.get_record(function_name)
+
+    def remove_connection(self, connection):
+        self.__connections.discard(connection)
+
+    def accepts_uploads(self, function_name):
+        """
+        Checks whether a function may be passed uploads. Uploads are 
+        iterators that block, so they cannot be passed to asynchronous 
+        functions, and they cannot be sent to worker processes.
+        """
+        return function_name not in self.__asynchronous and \
+            self.__functions.get_executor(function_name) != 'process'
+
+    def allowed_serializers(self):
+        return self.__serializers
+
+    def allowed_codecs(self):
+        return self.__codecs
+
+    def default_serializer(self):
+        """Returns the serializer of connections that negotiate none."""
+        if DEFAULT_SERIALIZER.name in self.__serializers:
+            return DEFAULT_SERIALIZER
+        return None
+
+    def register_function(self, rpc_function, rpc_name='', asynchronous=False, executor='thread'):
+        """
+        Registers a new function with the RPC server.
+        @type rpc_function: function
+        @param rpc_function: The function to register.
+        @type rpc_name: str
+        @param rpc_name: An (optional) name to use for the function. If this is not
+        given the functions original name is used.
+        @type asynchronous: bool
+        @param asynchronous: If True the function is called on the event loop
+        thread, so it must not block. It may return an SCFuture (or any object
+        with an add_done_callback method) to deliver its result later.
+        @type executor: str
+        @param executor: 'thread' (the default) performs the function in the
+        executor given to the constructor. 'process' performs it in a pool of
+        PROCESS_POOL_SIZE worker processes.
+        @see: SCRPC.register_function
+        """
+        record = self.__functions.register(rpc_function, rpc_name, executor)
+        if asynchronous:
+            self.__asynchronous.add(record.name)
+
+    def busy(self):
+        """
+        Checks whether the server can take another call.
+        @rtype: str
+        @return: None or the message to refuse the call with.
+        """
+        if self.__max_queued != None and self.__queued >= self.__max_queued:
+            return overloaded_message('too many queued calls')
+        return None
+
+    def dispatch(self, record, argument_list, serializer, reply, stream=False, token=None):
+        """
+        Performs a call and passes the reply verb and payload to reply on the
+        loop thread. Called by the connections.
+        @type record: SCDispatchRecord
+        @param record: The dispatch record of the function.
+        @type serializer: Serializer
+        @param serializer: The serializer to marshal the outcome with.
+        @type stream: bool
+        @param stream: Whether the client can receive streamed results. If
+        so, generators are passed to reply with the STREAM verb.
+        @type token: CancellationToken
+        @param token: The cancellation token of the call.
+        @see: SCRPC.perform
+        """
+        function = record.function
+        if record.name not in self.__asynchronous:
+            executor = self.__executor
+            if record.executor == 'process':
+                with self.__process_pool_lock:
+                    if self.__process_pool == None:
+                        self.__process_pool = ProcessPool(AsyncSCRPC.PROCESS_POOL_SIZE)
+                executor = self.__process_pool
+            try:
+                if executor is self.__process_pool:
+                    # Generators cannot be sent back from a worker process,
+                    # and neither can tokens be sent to it.
+                    if token != None and token.reason() != None:
+                        reply(NACK, token.reason())
+                        return
+                    stream = False
+                    future = executor.submit(run_function, function, argument_list, serializer.name, stream)
+                else:
+                    future = executor.submit(run_function, function, argument_list, serializer.name, stream,
+                                             None, token)
+            except ThreadPool.Full:
+                reply(NACK, overloaded_message('too many queued calls'))
+                return
+            self.__queued += 1
+            future.add_done_callback(partial(self.__loop.call_soon_threadsafe, self.__send_outcome,
+                                             serializer, reply))
+            return
+
+        previous = set_current_token(token)
+        try:
+            cmd_output = function(*argument_list) #IGNORE:W0142
+        except Exception, excep: #IGNORE:W0703
+            reply(*marshal_outcome(serializer, False, excep)) #IGNORE:W0142
+            return
+        finally:
+            set_current_token(previous)
+        if hasattr(cmd_output, 'add_done_callback'):
+            cmd_output.add_done_callback(partial(self.__loop.call_soon_threadsafe, self.__send_result,
+                                                 serializer, reply, stream))
+        else:
+            self.__send_result(serializer, reply, stream, None, cmd_output)
+
+    def dispatch_batch(self, calls, serializer, parallel, reply):
+        """
+        Performs a batch of calls in the executor and passes the reply verb
+        and payload to reply on the loop thread. Called by the connections.
+        @see: run_batch
+        """
+        try:
+            future = self.__executor.submit(run_batch, self, serializer, calls, parallel)
+        except ThreadPool.Full:
+            reply(NACK, overloaded_message('too many queued calls'))
+            return
+        self.__queued += 1
+        future.add_done_callback(partial(self.__loop.call_soon_threadsafe, self.__send_outcome,
+                                         serializer, reply))
+
+    def perform(self, record, argument_list, serializer):
+        """
+        Calls a registered function in the calling thread, or in the process
+        pool for functions registered with it. Used for the calls of batches.
+        Asynchronous functions cannot be called this way.
+        @type record: SCDispatchRecord
+        @param record: The dispatch record of the function.
+        @rtype: tuple
+        @return: The reply verb and payload parts.
+        @see: run_function
+        """
+        if record.name in self.__asynchronous:
+            return NACK, 'Function (%s) cannot be batched.' % record.name
+        if record.executor == 'process':
+            with self.__process_pool_lock:
+                if self.__process_pool == None:
+                    self.__process_pool = ProcessPool(AsyncSCRPC.PROCESS_POOL_SIZE)
+            return wait_for_process(self.__process_pool.submit(run_function, record.function, argument_list,
+                                                                serializer.name), serializer)
+        return run_function(record.function, argument_list, serializer.name)
+
+    def pull_chunk(self, generator, serializer, callback, started=True):
+        """
+        Pulls the next chunk out of the generator of a stream in the 
+        executor and passes the frame verb and payload to callback on the
+        loop thread. Called by the connections.
+        @type started: bool
+        @param started: Whether chunks have been pulled out of the generator
+        before. Only a stream that has had no effect yet is refused as 
+        overloaded, which tells the client it may retry the call.
+        @see: next_chunk
+        """
+        try:
+            future = self.__executor.submit(next_chunk, generator, serializer.name)
+        except ThreadPool.Full:
+            if started:
+                callback(NACK, busy_message('too many queued calls'))
+            else:
+                callback(NACK, overloaded_message('too many queued calls'))
+            return
+        future.add_done_callback(partial(self.__loop.call_soon_threadsafe, self.__chunk_pulled,
+                                         serializer, callback))
+
+    def __chunk_pulled(self, serializer, callback, future):
+        try:
+            verb, payload = future.result(0)
+        except Exception, excep:
+            verb, payload = marshal_outcome(serializer, False, excep)
+        callback(verb, payload)
+
+    def __send_outcome(self, serializer, reply, future):
+        """Sends the outcome of a call performed by the executor."""
+        self.__queued -= 1
+        try:
+            verb, payload = future.result(0)
+        except Exception, excep:
+            verb, payload = marshal_outcome(serializer, False, excep)
+        reply(verb, payload)
+
+    def __send_result(self, serializer, reply, stream, future, cmd_output=None):
+        """Marshals and sends the result of an asynchronous function."""
+        if future != None:
+            try:
+                cmd_output = future.result(0)
+            except Exception, excep:
+                reply(*marshal_outcome(serializer, False, excep)) #IGNORE:W0142
+                return
+        if isinstance(cmd_output, GeneratorType):
+            if stream:
+                reply(STREAM, cmd_output)
+                return
+            try:
+                cmd_output = list(cmd_output)
+            except Exception, excep: #IGNORE:W0703
+                reply(*marshal_outcome(serializer, False, excep)) #IGNORE:W0142
+                return
+        reply(*marshal_outcome(serializer, True, cmd_output)) #IGNORE:W0142
+
+    def handle_read(self):
+        """Accepts pending connections on the listening socket."""
+        while True:
+            try:
+                sock, _ = self.__server_sock.sock.accept()
+            except socket_error:
+                return
+            self.__serve(sock)
+
+    def add_socket(self, sock):
+        """
+        Serves a connection that was not accepted by the server.
+        @see: SCRPC.add_socket
+        """
+        self.__loop.call_soon_threadsafe(self.__serve, sock)
+
+    def __serve(self, sock):
+        """Serves a new connection. Runs in the loop thread."""
+        if self.__max_connections != None and \
+           len(self.__connections) >= self.__max_connections:
+            self.__refuse_connection(sock)
+            return
+        self.__connections.add(AsyncSCConnection(self.__loop, sock, self))
+
+    def __refuse_connection(self, sock):
+        """Tells a new client that the server is busy and disconnects it."""
+        logging.getLogger('SCRPC (server)').debug('Refusing connection.')
+        message = '%s %s' % (NACK, busy_message('too many connections'))
+        try:
+            sock.setblocking(0)
+            sock.send(struct.pack('!I', len(message)) + message)
+        except socket_error:
+            pass
+        sock.close()
+
+    def handle_write(self):
+        pass
+
+    def handle_close(self):
+        pass
+
+    def run(self):
+        """
+        Main thread function. Runs the event loop until stop is called.
+        """
+        self.__loop.add_handler(self, READ)
+        self.__loop.run()
+        self.__loop.remove_handler(self)
+        for connection in list(self.__connections):
+            connection.handle_close()
+
+    def stop(self, block=False):
+        """Stop the RPC server thread.
+        @type block: bool
+        @param block: Whether or not the call should block until the service is
+        closed down properly.
+        """
+        self.__loop.stop()
+        if block and currentThread() is not self:
+            self.join()
+
+    def teardown(self):
+        """
+        Close down the RPC server completely. This closes the server socket
+        making the AsyncSCRPC object unusable.
+        """
+        self.__server_sock.close()
+        self.__loop.close()
+        if self.__own_executor:
+            self.__executor.shutdown(False)
+        if self.__process_pool != None:
+            self.__process_pool.shutdown(False)
+
+class AsyncSCProxyConnection(FramedConnection):
+    """The connection of an AsyncSCProxy."""
+
+    def __init__(self, loop, sock, serializer, codec, data=''):
+        super(AsyncSCProxyConnection, self).__init__(loop, sock, data)
+        self.__serializer = serializer
+        self.__codec = codec
+        self.__pending = {}
+        self.__streams = {}
+        # The windows of the uploads in progress, indexed by upload id.
+        self.__uploads = {}
+
+    def send_call(self, call_id, frame, future, uploads=()):
+        """
+        Sends a CALL frame and starts sending the uploads of the call.
+        @type uploads: list
+        @param uploads: The positions and SCUpload objects of the streamed
+        arguments.
+        """
+        if self.closed:
+            future.set_exception(SCProxy.CommunicationError('Connection to server lost.'))
+            return
+        self.__pending[call_id] = future
+        if len(uploads) != 0:
+            positions = ','.join([str(position) for position, _ in uploads])
+            self.send_frame(pack_frame(UPLOAD, (call_id, positions)))
+        self.send_frame(frame)
+        for position, upload in uploads:
+            uid = upload_id(call_id, position)
+            window = StreamWindow()
+            self.__uploads[uid] = window
+            sender = Thread(target=self.__upload, args=(uid, upload, window))
+            sender.setDaemon(True)
+            sender.start()
+
+    def __upload(self, uid, upload, window):
+        """Thread function sending an upload."""
+        try:
+            send_upload(upload, uid, window, self.__serializer, self.__codec, self.__send_upload_frame)
+        finally:
+            self.loop.call_soon_threadsafe(self.__uploads.pop, uid, None)
+
+    def __send_upload_frame(self, frame):
+        """Sends a frame of an upload. Called by the sender threads."""
+        if self.closed:
+            raise SCProxy.CommunicationError('Connection to server lost.')
+        self.loop.call_soon_threadsafe(self.send_frame, frame)
+
+    def frame_received(self, frame):
+        try:
+            verb, flags, fields, payload = parse_frame(frame)
+        except ProtocolError:
+            logging.getLogger("SMRPC-Client").info('Malformed reply from server.')
+            self.handle_close()
+            return
+        if verb == MORE or verb == STOP:
+            # The server grants more chunks of an upload, or has no use for
+            # the rest of it.
+            window = self.__uploads.get(fields[0])
+            if window == None:
+                return
+            if verb == MORE:
+                window.grant(int(fields[1]))
+            else:
+                del self.__uploads[fields[0]]
+                window.stop()
+            return
+        call_id = fields[0]
+        stream = self.__streams.get(call_id)
+        if stream != None:
+            if verb != CHUNK:
+                del self.__streams[call_id]
+            feed_stream(stream, verb, flags, payload, self.__serializer, self.__codec)
+            return
+        future = self.__pending.pop(call_id, None)
+        if future == None:
+            return
+        if verb == STREAM:
+            stream = SCStream(partial(self.loop.call_soon_threadsafe, self.__control_stream, MORE, call_id),
+                              partial(self.loop.call_soon_threadsafe, self.__control_stream, STOP, call_id))
+            self.__streams[call_id] = stream
+            future.set_result(stream)
+            return
+        try:
+            payload = decompress_payload(self.__codec, flags, payload)
+            future.set_result(decode_reply(verb, payload, self.__serializer))
+        except CompressionError, excep:
+            future.set_exception(SCProxy.MarshalingError('Error decompressing reply.', excep))
+        except Exception, excep:
+            future.set_exception(excep)
+
+    def __control_stream(self, verb, call_id, count=None):
+        """Sends a MORE or STOP frame for a stream."""
+        if verb == STOP:
+            self.__streams.pop(call_id, None)
+            self.send_frame(pack_frame(STOP, (call_id, )))
+        else:
+            self.send_frame(pack_frame(MORE, (call_id, count)))
+
+    def connection_closed(self):
+        pending, self.__pending = self.__pending, {}
+        for future in pending.itervalues():
+            future.set_exception(SCProxy.CommunicationError('Connection to server lost.'))
+        streams, self.__streams = self.__streams, {}
+        for stream in streams.itervalues():
+            stream.finish(SCProxy.CommunicationError('Connection to server lost.'))
+        uploads, self.__uploads = self.__uploads, {}
+        for window in uploads.itervalues():
+            window.stop()
+
+class AsyncSCProxy(object):
+    """
+    A proxy handling a connection to an RPC server through an event loop.
+    Calls return SCFuture objects immediately, and any number of proxies
+    can share one loop thread. The server must speak protocol version 2.
+    """
+
+    __default_loop = None
+    __default_loop_lock = allocate_lock()
+
+    def __init__(self, address=('localhost', 3344), loop=None, serializers=('pickle', ),
+                 compression=None):
+        """
+        Constructor.
+        @type address: tuple
+        @param address: The address where the server is listening, the path
+        of its Unix domain socket or a connected socket.
+        @type loop: EventLoop
+        @param loop: The (running) event loop to use. Defaults to a loop
+        shared by all proxies, running in a daemon thread.
+        @type serializers: tuple
+        @param serializers: The serializers to offer the server, most 
+        preferred first.
+        @type compression: tuple
+        @param compression: The compression codecs to offer the server, most
+        preferred first. None disables compression.
+        @see: SCProxy.__init__
+        @raise ValueError: If a serializer or a codec is unknown.
+        """
+        super(AsyncSCProxy, self).__init__()
+        if loop == None:
+            loop = AsyncSCProxy.default_loop()
+        self.__loop = loop
+        self.__call_id = 0
+        self.__lock = allocate_lock()
+
+        serializers = check_serializers(serializers)
+        options = {'serializers': ','.join(serializers)}
+        if compression != None:
+            options['compression'] = ','.join(check_codecs(compression))
+
+        # Connect and negotiate the protocol version before handing the
+        # connection over to the loop.
+        try:
+            sock = open_connection(address)
+        except Exception, excep:
+            raise SCProxy.CommunicationError('Error connecting to RPC server.', excep)
+        try:
+            sock.send_lp(hello_request(PROTOCOL_VERSION, options))
+            response = sock.recv_lp()
+        except Exception, excep:
+            sock.close()
+            raise SCProxy.CommunicationError('Error connecting to RPC server.', excep)
+        if response[:4] == NACK and (response[5:].startswith(SERVER_BUSY) or \
+                                     response[5:].startswith(NO_COMMON_SERIALIZER)):
+            sock.close()
+            raise SCProxy.CommunicationError(response[5:])
+        if response[:5] != HELLO:
+            sock.close()
+            raise SCProxy.CommunicationError('Server does not support protocol version 2.')
+        version, options = parse_hello(response[6:].split(' '))
+        serializer_name = options.get('serializer', DEFAULT_SERIALIZER.name)
+        if version < 2:
+            sock.close()
+            raise SCProxy.CommunicationError('Server does not support protocol version 2.')
+        if serializer_name not in serializers:
+            sock.close()
+            raise SCProxy.CommunicationError('Server does not support serializer %s.' %
+                                             ' or '.join(serializers))
+        self.__version = version
+        self.__serializer = get_serializer(serializer_name)
+        self.__codec = None
+        if options.has_key('compression'):
+            self.__codec = get_codec(options['compression'])
+        self.__connection = AsyncSCProxyConnection(loop, sock.sock, self.__serializer, self.__codec,
+                                                   sock.buffered())
+
+    @classmethod
+    def default_loop(cls):
+        """Returns the event loop shared by proxies created without one."""
+        with cls.__default_loop_lock:
+            if cls.__default_loop == None:
+                cls.__default_loop = EventLoop()
+                cls.__default_loop.run_in_thread()
+            return cls.__default_loop
+
+    def __getattr__(self, attrname):
+        """
+        Forwards any unknown attribute requests to the call method.
+        @see: SCProxy.__getattr__
+        """
+        if attrname == '':
+            return self
+        stub = partial(self.call, attrname)
+        self.__dict__[attrname] = stub
+        return stub
+
+    def call(self, function_name, *function_input):
+        """
+        Starts a remote procedure call.
+        @type function_name: str
+        @param function_name: The name of the remote function to call.
+        @type function_input: list
+        @param function_input: The input for the remote function.
+        @rtype: SCFuture
+        @return: A future holding the outcome of the call.
+        @see: SCUpload
+        """
+        function_input, uploads = split_uploads(function_input, self.__version >= 4)
+        return self.__send_call(CALL, function_name, function_input, uploads)
+
+    def batch(self, parallel=False):
+        """
+        Starts a batch of calls.
+        @see: SCProxy.batch
+        @rtype: SCBatch
+        """
+        return SCBatch(self.__send_batch, parallel)
+
+    def __send_batch(self, calls, futures, parallel):
+        """
+        Sends the calls of a batch. Servers older than protocol version 5
+        get the calls one by one.
+        """
+        if self.__version < 5:
+            for (function_name, function_input), future in zip(calls, futures):
+                self.call(function_name, *function_input).add_done_callback(partial(copy_outcome, future))
+            return
+        calls = [(function_name, split_uploads(function_input, False)[0])
+                 for function_name, function_input in calls]
+        try:
+            batch_future = self.__send_call(BATCH, parallel and 'parallel' or 'sequential', calls)
+        except SCProxy.MarshalingError, excep:
+            for future in futures:
+                future.set_exception(excep)
+            return
+        batch_future.add_done_callback(partial(complete_batch, futures, self.__serializer))
+
+    def __send_call(self, verb, function_name, function_input, uploads=()):
+        """
+        Marshals the input of a call and hands the frame to the loop.
+        @see: SCProxy.__send_call
+        @rtype: SCFuture
+        """
+        try:
+            marshalled_input = self.__serializer.dumps(function_input)
+        except Exception, excep:
+            raise SCProxy.MarshalingError('Error marshaling function input', excep)
+        flags, marshalled_input = compress_payload(self.__codec, marshalled_input,
+                                                   SCProxy.COMPRESSION_THRESHOLD)
+        with self.__lock:
+            self.__call_id += 1
+            call_id = str(self.__call_id)
+        future = SCFuture()
+        frame = pack_frame(verb, (call_id, function_name), marshalled_input, flags)
+        self.__loop.call_soon_threadsafe(self.__connection.send_call, call_id, frame, future, uploads)
+        return future
+
+    def close(self):
+        """Closes the connection. Pending calls fail with a CommunicationError."""
+        self.__loop.call_soon_threadsafe(self.__connection.handle_close)
@@ -0,0 +1,224 @@
+"""
+Caching of the results of functions registered with an SCRPC server. The
+results are kept marshalled, so a call answered from the cache is neither
+performed nor marshalled again. SCProxy clients may keep the results in a
+cache of their own, which the server invalidates over the connection.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from collections import OrderedDict, Iterator
+import time
+
+# The default limit of the size of the results cached, in bytes.
+MAX_BYTES = 64 * 1048576
+# The default size of the largest result cached, in bytes.
+MAX_RESULT_BYTES = 1048576
+
+class ResultCache(object):
+    """
+    A cache of marshalled results, shared by the functions it is registered
+    with. It holds at most size calls and max_bytes bytes of results, 
+    evicting the least recently used, and forgets results ttl seconds after
+    they were stored. Results larger than max_result_bytes are not cached, 
+    so a few of them cannot evict everything else. The results of a call 
+    are kept per serializer. Only results are cached, never exceptions.
+    All methods are thread-safe.
+    """
+
+    def __init__(self, size=1024, ttl=None, max_bytes=MAX_BYTES, max_result_bytes=MAX_RESULT_BYTES):
+        """
+        Constructor.
+        @type size: int
+        @param size: The maximum number of calls cached.
+        @type ttl: float
+        @param ttl: The number of seconds results are kept, or None to keep
+        them until they are evicted or invalidated.
+        @type max_bytes: int
+        @param max_bytes: The maximum size of all results cached.
+        @type max_result_bytes: int
+        @param max_result_bytes: The size of the largest result cached. It 
+        is at most max_bytes.
+        @raise ValueError: If a size or the ttl is invalid.
+        """
+        super(ResultCache, self).__init__()
+        if size < 1:
+            raise ValueError('Invalid cache size (%i)' % size)
+        if ttl != None and ttl <= 0:
+            raise ValueError('Invalid ttl (%f)' % ttl)
+        if max_bytes < 1:
+            raise ValueError('Invalid cache size in bytes (%i)' % max_bytes)
+        if max_result_bytes < 1:
+            raise ValueError('Invalid result size (%i)' % max_result_bytes)
+        self.__size = size
+        self.__ttl = ttl
+        self.__max_bytes = max_bytes
+        self.__max_result_bytes = min(max_result_bytes, max_bytes)
+        # The expiry time, the marshalled results by variant and the size of
+        # the results of each call, indexed by key and ordered from least to
+        # most recently used.
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__expirations = 0
+        self.__oversized = 0
+        # Counts the invalidations, so that results computed before one are
+        # not stored after it.
+        self.__generation = 0
+        self.__lock = allocate_lock()
+
+    def generation(self):
+        """
+        Returns the number of invalidations so far. It is taken before a
+        result is computed and passed to put.
+        """
+        return self.__generation
+
+    def get(self, key, variant):
+        """
+        Looks up the result of a call.
+        @type key: tuple
+        @param key: The key of the call (see cache_key).
+        @param variant: How the result was marshalled, e.g. the name of the
+        serializer.
+        @rtype: tuple
+        @return: The parts of the marshalled result, or None on a miss.
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry != None and entry[0] != None and entry[0] <= time.time():
+                self.__expirations += 1
+                self.__bytes -= entry[2]
+                entry = None
+            if entry == None:
+                self.__misses += 1
+                return None
+            # Move the call to the most recently used end.
+            self.__entries[key] = entry
+            payload = entry[1].get(variant)
+            if payload == None:
+                self.__misses += 1
+            else:
+                self.__hits += 1
+            return payload
+
+    def put(self, key, variant, payload, generation=None):
+        """
+        Stores the result of a call.
+        @type payload: tuple
+        @param payload: The parts of the marshalled result, or the result
+        in one str.
+        @type generation: int
+        @param generation: The generation of the cache when the computation
+        of the result began. If results have been invalidated since, the 
+        result may be stale and is not stored.
+        @see: ResultCache.get
+        """
+        length = payload_size(payload)
+        with self.__lock:
+            if generation != None and generation != self.__generation:
+                return
+            if length > self.__max_result_bytes:
+                self.__oversized += 1
+                return
+            entry = self.__entries.pop(key, None)
+            if entry == None:
+                expires = None
+                if self.__ttl != None:
+                    expires = time.time() + self.__ttl
+                entry = [expires, {}, 0]
+                while len(self.__entries) >= self.__size:
+                    self.__evict()
+            replaced = entry[1].get(variant)
+            if replaced != None:
+                entry[2] -= payload_size(replaced)
+                self.__bytes -= payload_size(replaced)
+            entry[1][variant] = payload
+            entry[2] += length
+            self.__bytes += length
+            # The call itself is out of the entries while others are evicted.
+            while self.__bytes > self.__max_bytes and len(self.__entries) != 0:
+                self.__evict()
+            self.__entries[key] = entry
+
+    def __evict(self):
+        """Evicts the least recently used call. The lock must be held."""
+        _, entry = self.__entries.popitem(False)
+        self.__bytes -= entry[2]
+        self.__evictions += 1
+
+    def invalidate(self, function_name=None, argument_list=None):
+        """
+        Forgets cached results.
+        @type function_name: str
+        @param function_name: The function whose results to forget, or None
+        for all functions.
+        @type argument_list: tuple
+        @param argument_list: The arguments of the call whose result to
+        forget, or None for all calls of the function. If they cannot make
+        a key, all calls of the function are forgotten.
+        """
+        key = None
+        if function_name != None and argument_list != None:
+            key = cache_key(function_name, argument_list)
+        with self.__lock:
+            self.__generation += 1
+            if function_name == None:
+                self.__entries.clear()
+                self.__bytes = 0
+            elif key != None:
+                entry = self.__entries.pop(key, None)
+                if entry != None:
+                    self.__bytes -= entry[2]
+            else:
+                for key in [key for key in self.__entries if key[0] == function_name]:
+                    self.__bytes -= self.__entries.pop(key)[2]
+
+    def stats(self):
+        """
+        @rtype: dict
+        @return: The numbers of 'hits', 'misses', 'evictions' (to keep
+        within the sizes), 'expirations' (of the ttl) and results too large
+        to cache ('oversized'), and the number of calls cached ('entries')
+        and the size of their results ('bytes').
+        """
+        with self.__lock:
+            return {'hits': self.__hits, 'misses': self.__misses, 'evictions': self.__evictions,
+                    'expirations': self.__expirations, 'oversized': self.__oversized,
+                    'entries': len(self.__entries), 'bytes': self.__bytes}
+
+def payload_size(payload):
+    """
+    @type payload: tuple
+    @param payload: The parts of a marshalled result, or the result in one
+    str.
+    @rtype: int
+    @return: The size of the result in bytes.
+    """
+    if not isinstance(payload, tuple):
+        return len(payload)
+    length = 0
+    for part in payload:
+        length += len(part)
+    return length
+
+def cache_key(function_name, argument_list):
+    """
+    Builds the cache key of a call.
+    @rtype: tuple
+    @return: The key, or None if the call cannot be cached because an
+    argument is unhashable (e.g. a list) or an iterator (e.g. an upload).
+    Arguments that are equal but of different types (1 and 1.0) give
+    different keys.
+    """
+    for argument in argument_list:
+        if isinstance(argument, Iterator):
+            return None
+    key = (function_name, argument_list, tuple([type(argument) for argument in argument_list]))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
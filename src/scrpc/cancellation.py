@@ -0,0 +1,127 @@
+"""
+Deadlines and cancellation of remote calls. Servers perform each call that
+carries a deadline or may be cancelled (protocol version 8) with a
+CancellationToken. Registered functions reach the token of the call they
+perform through current_token(), and may check it to stop early:
+
+    def crunch(data):
+        token = current_token()
+        for block in data:
+            if token != None:
+                token.check()
+            ...
+
+Calls made by SCProxy while a call is performed inherit its deadline, so
+the deadline is propagated along chains of calls.
+"""
+
+from __future__ import with_statement
+from threading import local
+from protocol import DEADLINE_EXCEEDED, CALL_CANCELLED
+import time
+
+_current = local()
+
+class CancellationToken(object):
+    """
+    Tells a function whether the call it performs is still wanted: the
+    client has not cancelled it and its deadline has not passed.
+    """
+
+    class Cancelled(Exception):
+        """Raised by check when the call is no longer wanted."""
+        def __init__(self, msg):
+            super(CancellationToken.Cancelled, self).__init__(msg)
+
+    def __init__(self, deadline=None):
+        """
+        Constructor.
+        @type deadline: float
+        @param deadline: The time (as returned by time.time) by which the
+        call must be finished, or None.
+        """
+        super(CancellationToken, self).__init__()
+        self.deadline = deadline
+        self.__cancelled = False
+
+    def cancel(self):
+        """Cancels the call."""
+        self.__cancelled = True
+
+    def expired(self):
+        """Returns whether the deadline of the call has passed."""
+        return self.deadline != None and time.time() >= self.deadline
+
+    def cancelled(self):
+        """Returns whether the call has been cancelled or has expired."""
+        return self.__cancelled or self.expired()
+
+    def remaining(self):
+        """
+        @rtype: float
+        @return: The number of seconds left until the deadline, or None if
+        the call has none.
+        """
+        if self.deadline == None:
+            return None
+        return max(self.deadline - time.time(), 0.0)
+
+    def reason(self):
+        """
+        @rtype: str
+        @return: CALL_CANCELLED or DEADLINE_EXCEEDED if the call is no
+        longer wanted, else None.
+        """
+        if self.__cancelled:
+            return CALL_CANCELLED
+        if self.expired():
+            return DEADLINE_EXCEEDED
+        return None
+
+    def check(self):
+        """
+        @raise CancellationToken.Cancelled: If the call has been cancelled
+        or has expired.
+        """
+        reason = self.reason()
+        if reason != None:
+            raise CancellationToken.Cancelled(reason)
+
+def current_token():
+    """
+    @rtype: CancellationToken
+    @return: The token of the call performed by the current thread, or None.
+    """
+    return getattr(_current, 'token', None)
+
+def set_current_token(token):
+    """
+    Sets the token of the call performed by the current thread.
+    @return: The previous token, to be restored when the call is done.
+    """
+    previous = getattr(_current, 'token', None)
+    _current.token = token
+    return previous
+
+def call_deadline(options):
+    """
+    Works out the deadline of a call from the keyword arguments given to
+    SCProxy: 'timeout' (seconds from now) or 'deadline' (a time.time()
+    value). Without either, the deadline of the call performed by the
+    current thread is inherited.
+    @type options: dict
+    @rtype: float
+    @return: The deadline, or None.
+    @raise TypeError: If an unknown keyword argument is given.
+    """
+    for name in options:
+        if name not in ('timeout', 'deadline'):
+            raise TypeError('Unexpected keyword argument (%s)' % name)
+    if options.get('deadline') != None:
+        return options['deadline']
+    if options.get('timeout') != None:
+        return time.time() + options['timeout']
+    token = current_token()
+    if token != None:
+        return token.deadline
+    return None
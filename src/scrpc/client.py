@@ -1,16 +1,374 @@
 """This file contains the single-minded RPC client."""
 
 from __future__ import with_statement
-from timedsocket import TimedSocket
-from cPickle import loads, dumps, PicklingError, UnpicklingError
+from timedsocket import TimedSocket, open_connection
+from cPickle import UnpicklingError
 from functools import partial
 from thread import allocate_lock
+from threading import Thread, Event, Condition
+from collections import deque
+from serializers import DEFAULT_SERIALIZER, get_serializer, check_serializers
+from compression import COMPRESSION_THRESHOLD, CompressionError, check_codecs, get_codec, \
+    compress_payload, decompress_payload
+from streaming import STREAM_BATCH, StreamWindow
+from metrics import CallRecord
+from sharedmemory import SHARED_MEMORY_THRESHOLD, SharedMemoryError, SharedPayloads, create_probe, map_payload, \
+     remove_probe
+from cache import ResultCache, cache_key
+from cancellation import call_deadline
+from pubsub import PUSH_QUEUE_SIZE, PushQueue
+from protocol import PROTOCOL_VERSION, HELLO, CALL, RESULT, EXCEPTION, NACK, \
+    STREAM, CHUNK, END, MORE, STOP, UPLOAD, DATA, EOF, BATCH, INVALIDATE, CANCEL, FUNCTIONS, SUBSCRIBE, \
+    UNSUBSCRIBE, PUBLISH, FLAG_CACHEABLE, \
+    FLAG_DEADLINE, FLAG_SHARED, FLAG_NUMBERED, SERVER_BUSY, SERVER_OVERLOADED, NO_COMMON_SERIALIZER, \
+    DEADLINE_EXCEEDED, CALL_CANCELLED, ProtocolError, hello_request, parse_hello, pack_frame, parse_frame, \
+    parse_functions, unmarshal, upload_id
 import logging
+import time
+
+class SCFuture(object):
+    """The pending outcome of a remote call made with SCProxy.call_async."""
+
+    def __init__(self, canceller=None, deadline=None):
+        """
+        Constructor.
+        @type canceller: function
+        @param canceller: Called without arguments when the call is 
+        cancelled, to tell the server.
+        @type deadline: float
+        @param deadline: The time (as returned by time.time) after which 
+        the call is cancelled when waited for, or None.
+        """
+        super(SCFuture, self).__init__()
+        self.__done = Event()
+        self.__lock = allocate_lock()
+        self.__result = None
+        self.__exception = None
+        self.__callbacks = []
+        self.__canceller = canceller
+        self.__deadline = deadline
+
+    def done(self):
+        """Returns whether the call has finished."""
+        return self.__done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the call to finish and returns its result. If the remote 
+        function raised an exception it is re-raised here.
+        @type timeout: float
+        @param timeout: The maximum number of seconds to wait. None means 
+        wait forever.
+        @raise SCProxy.RemoteError: If the timeout is reached.
+        @raise SCProxy.DeadlineExceeded: If the deadline of the call passes.
+        """
+        if not self.wait(timeout):
+            raise SCProxy.RemoteError('Timeout while performing remote function.')
+        if self.__exception != None:
+            raise self.__exception
+        return self.__result
+
+    def wait(self, timeout=None):
+        """
+        Waits for the call to finish.
+        @type timeout: float
+        @param timeout: The maximum number of seconds to wait. None means 
+        wait forever.
+        @rtype: bool
+        @return: Whether the call has finished. Calls whose deadline passes
+        while waiting are cancelled, and so finish.
+        """
+        if self.__deadline != None:
+            remaining = max(self.__deadline - time.time(), 0.0)
+            if timeout == None or remaining <= timeout:
+                self.__done.wait(remaining)
+                if not self.__done.is_set():
+                    self.cancel(SCProxy.DeadlineExceeded(DEADLINE_EXCEEDED))
+                return True
+        self.__done.wait(timeout)
+        return self.__done.is_set()
+
+    def cancel(self, exception=None):
+        """
+        Cancels the call if it has not finished. The future fails and the
+        server is asked to stop performing the call (version 8 servers).
+        @type exception: Exception
+        @param exception: The exception to fail the future with. Defaults 
+        to SCProxy.Cancelled.
+        @rtype: bool
+        @return: Whether the call was cancelled.
+        """
+        if exception == None:
+            exception = SCProxy.Cancelled(CALL_CANCELLED)
+        if not self.__complete(None, exception):
+            return False
+        if self.__canceller != None:
+            self.__canceller()
+        return True
+
+    def add_done_callback(self, callback):
+        """
+        Registers a callback that is called with the future as its only 
+        argument once the call has finished. If the call has already 
+        finished the callback is called right away.
+        @type callback: function
+        @param callback: The callback to register.
+        """
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        """Completes the future with the given result."""
+        self.__complete(result, None)
+
+    def set_exception(self, exception):
+        """Completes the future with the given exception."""
+        self.__complete(None, exception)
+
+    def __complete(self, result, exception):
+        with self.__lock:
+            if self.__done.is_set():
+                return False
+            self.__result = result
+            self.__exception = exception
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                logging.getLogger("SMRPC-Client").debug('Exception in future callback.', exc_info=True)
+        return True
+
+class SCStream(object):
+    """
+    The items produced by a remote generator function. They arrive in 
+    chunks while the stream is being iterated over, and the server is only
+    allowed to run a few chunks ahead of the consumer. Streams that are not
+    consumed to the end should be closed.
+    """
+
+    def __init__(self, request_more, stop):
+        """
+        Constructor.
+        @type request_more: function
+        @param request_more: Called with a count to let the server send 
+        that many more chunks.
+        @type stop: function
+        @param stop: Called to make the server end the stream.
+        """
+        super(SCStream, self).__init__()
+        self.__request_more = request_more
+        self.__stop = stop
+        self.__condition = Condition()
+        self.__chunks = deque()
+        self.__items = deque()
+        self.__finished = False
+        self.__exception = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """
+        Returns the next item of the stream.
+        @raise StopIteration: When the stream has ended.
+        @raise Exception: The exception raised by the remote generator.
+        """
+        if len(self.__items) == 0:
+            with self.__condition:
+                while len(self.__chunks) == 0 and not self.__finished:
+                    self.__condition.wait()
+                if len(self.__chunks) == 0:
+                    excep, self.__exception = self.__exception, None
+                    if excep != None:
+                        raise excep
+                    raise StopIteration()
+                self.__items = deque(self.__chunks.popleft())
+            # The chunk has been consumed, so the server may send another.
+            self.__request_more(1)
+        return self.__items.popleft()
+
+    def close(self):
+        """Stops the stream. Items not yet received are discarded."""
+        with self.__condition:
+            if self.__finished:
+                return
+            self.__finished = True
+            self.__chunks.clear()
+            self.__condition.notifyAll()
+        self.__items.clear()
+        self.__stop()
+
+    def feed(self, items):
+        """Adds a chunk of items received from the server."""
+        with self.__condition:
+            if not self.__finished:
+                self.__chunks.append(items)
+                self.__condition.notify()
+
+    def finish(self, exception=None):
+        """Ends the stream, optionally with an exception."""
+        with self.__condition:
+            if not self.__finished:
+                self.__finished = True
+                self.__exception = exception
+                self.__condition.notifyAll()
+
+    def fail(self, exception):
+        """Ends the stream with an exception raised on this side."""
+        self.finish(exception)
+        self.__stop()
+
+class SCUpload(object):
+    """
+    Wraps an argument that is sent to the server in chunks rather than in
+    the CALL frame, so it never has to be held in memory as a whole. The
+    remote function receives an iterator over the items of the argument. 
+    Servers that do not support uploads get a list of the items instead.
+    """
+
+    BLOCK_SIZE = 262144 # The number of bytes read from file-like objects at a time.
+
+    def __init__(self, source, block_size=BLOCK_SIZE):
+        """
+        Constructor.
+        @type source: iterable or file
+        @param source: The items to send. The items of a file-like object
+        (anything with a read method) are blocks of up to block_size bytes.
+        @type block_size: int
+        @param block_size: The size of the blocks read from a file.
+        """
+        super(SCUpload, self).__init__()
+        self.__source = source
+        self.__block_size = block_size
+
+    def __iter__(self):
+        if not hasattr(self.__source, 'read'):
+            return iter(self.__source)
+        return iter(partial(self.__source.read, self.__block_size), '')
+
+    def chunks(self):
+        """
+        Groups the items into the chunks they are sent in. Blocks of a file
+        are sent one per chunk.
+        """
+        if hasattr(self.__source, 'read'):
+            batch_size = 1
+        else:
+            batch_size = STREAM_BATCH
+        chunk = []
+        for item in self:
+            chunk.append(item)
+            if len(chunk) >= batch_size:
+                yield chunk
+                chunk = []
+        if len(chunk) != 0:
+            yield chunk
+
+    def collect(self):
+        """Returns all the items in a list."""
+        return list(self)
+
+class SCBatch(object):
+    """
+    Collects calls that are sent to the server together, in one frame if the
+    server supports batches. Calls return SCFuture objects that complete
+    once the outcomes of the batch arrive. Used as a context manager, the
+    batch is sent at the end of the block and waited for:
+
+        with proxy.batch() as batch:
+            first = batch.lookup(1)
+            second = batch.lookup(2)
+        print first.result(), second.result()
+    """
+
+    def __init__(self, send, parallel=False):
+        """
+        Constructor.
+        @type send: function
+        @param send: Called with the calls (pairs of function name and 
+        input), their futures and the parallel flag to send the batch.
+        @type parallel: bool
+        @param parallel: Whether the server may perform the calls 
+        concurrently rather than in order.
+        """
+        super(SCBatch, self).__init__()
+        self.__send = send
+        self.__parallel = parallel
+        self.__calls = []
+        self.__futures = []
+        self.__sent = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            self.send()
+            for future in self.__futures:
+                future.wait(SCProxy.MAX_CALL_LENGTH)
+        return False
+
+    def __getattr__(self, attrname):
+        """
+        Forwards any unknown attribute requests to the call method.
+        @see: SCProxy.__getattr__
+        """
+        if attrname == '':
+            return self
+        else:
+            return partial(self.call, attrname)
+
+    def __len__(self):
+        return len(self.__calls)
+
+    def call(self, function_name, *function_input):
+        """
+        Adds a call to the batch.
+        @type function_name: str
+        @param function_name: The name of the remote function to call.
+        @type function_input: list
+        @param function_input: The input for the remote function.
+        @rtype: SCFuture
+        @return: A future holding the outcome of the call.
+        @raise ValueError: If the batch has been sent already.
+        """
+        if self.__sent:
+            raise ValueError('Batch has been sent already')
+        future = SCFuture()
+        self.__calls.append((function_name, function_input))
+        self.__futures.append(future)
+        return future
+
+    def send(self):
+        """Sends the calls of the batch, unless they have been sent already."""
+        if self.__sent:
+            return
+        self.__sent = True
+        if len(self.__calls) != 0:
+            self.__send(self.__calls, self.__futures, self.__parallel)
+
+    def results(self):
+        """
+        Sends the batch and waits for the outcomes of its calls.
+        @rtype: list
+        @return: The results of the calls.
+        @raise Exception: The exception raised by the first call that 
+        failed.
+        """
+        self.send()
+        return [future.result(SCProxy.MAX_CALL_LENGTH) for future in self.__futures]
 
 class SCProxy(object):
     """A proxy handling a connection to an instance of SCRPC"""
 
     MAX_CALL_LENGTH = 600.0 # The maximum number of seconds to wait for a remote call to finish.
+    COMPRESSION_THRESHOLD = COMPRESSION_THRESHOLD # Input smaller than this is not compressed.
+    PUSH_QUEUE_SIZE = PUSH_QUEUE_SIZE # The number of topics whose pushed values may wait for the callbacks.
 
     class RemoteError(Exception):
         def __init__(self, *args):
@@ -23,18 +381,119 @@ class SCProxy(object):
     class MarshalingError(Exception):
         def __init__(self, *args):
             super(SCProxy.MarshalingError, self).__init__(*args)
+
+    class DeadlineExceeded(RemoteError):
+        def __init__(self, *args):
+            super(SCProxy.DeadlineExceeded, self).__init__(*args)
+
+    class Cancelled(RemoteError):
+        def __init__(self, *args):
+            super(SCProxy.Cancelled, self).__init__(*args)
+
+    class Overloaded(RemoteError):
+        """
+        Raised when the server sheds a call. The call has not been 
+        performed, so it may be retried, preferably on another server.
+        """
+        def __init__(self, *args):
+            super(SCProxy.Overloaded, self).__init__(*args)
     
-    def __init__(self, address=('localhost', 3344)):
+    def __init__(self, address=('localhost', 3344), protocol=PROTOCOL_VERSION,
+                 serializers=('pickle', ), compression=None, metrics=None, cache=None,
+                 shared_memory=None):
+        """
+        Constructor.
+        @type address: tuple
+        @param address: The address where the SCRPC server is listening, or
+        the path of its Unix domain socket. It may also be a connected 
+        socket, e.g. one end of a socket.socketpair whose other end is 
+        passed to SCRPC.add_socket. Such a connection cannot be reopened 
+        once it is lost.
+        @type protocol: int
+        @param protocol: The highest protocol version to negotiate with the
+        server. Use 1 to force the original four message handshake.
+        @type serializers: tuple
+        @param serializers: The serializers to offer the server, most 
+        preferred first. Version 1 servers only speak 'pickle'.
+        @type compression: tuple
+        @param compression: The compression codecs (e.g. 'zstd', 'lz4' or 
+        'zlib') to offer the server, most preferred first. Calls and results
+        of at least COMPRESSION_THRESHOLD bytes are then compressed. None 
+        disables compression.
+        @type metrics: Metrics
+        @param metrics: The metrics to record the calls and the connection
+        in, e.g. Metrics('scproxy'). Only version 2 calls are recorded. None
+        turns metrics off.
+        @param cache: The cache to keep the results of calls in, or True for
+        a ResultCache of its own. Only the results the server marks as 
+        cacheable are kept (those of the functions it caches itself), and 
+        the server tells the proxy when they become stale. A cache may be 
+        shared by proxies connected to the same server. Version 6 servers
+        only; None turns caching off.
+        @type shared_memory: int
+        @param shared_memory: The size from which calls and results are 
+        passed in shared memory instead of through the connection, or True
+        for SHARED_MEMORY_THRESHOLD. Only servers on the same host that 
+        allow it (version 7) agree; others get everything through the 
+        connection. None turns shared memory off.
+        @raise ValueError: If a serializer or a codec is unknown.
+        """
         super(SCProxy, self).__init__()
         
         # Store member variables.
         self.__address = address
+        self.__max_protocol = protocol
+        self.__protocol = 1
+        self.__serializers = check_serializers(serializers)
+        self.__serializer = DEFAULT_SERIALIZER
+        self.__codecs = []
+        if compression != None:
+            self.__codecs = check_codecs(compression)
+        self.__codec = None
+        self.__call_id = 0
+        self.__lock = allocate_lock()
+        
+        # Calls that have been sent but not yet answered, and the streams in 
+        # progress, indexed by call id.
+        self.__pending = {}
+        self.__streams = {}
+        # The windows of the uploads in progress, indexed by upload id.
+        self.__uploads = {}
+        self.__pending_lock = allocate_lock()
+        # The measurements and sending times of the pending calls, indexed 
+        # by call id, if metrics are on.
+        self.__metrics = metrics
+        self.__records = {}
+        # The function names, arguments, cache keys (None until the call is
+        # known to be cacheable) and cache generations of the pending calls
+        # whose results may be cached, indexed by call id.
+        if cache == True:
+            cache = ResultCache()
+        self.__cache = cache
+        self.__caching = False
+        self.__cache_keys = {}
+        # The functions whose results the server has marked cacheable. Only
+        # their calls are looked up in the cache.
+        self.__cacheable = set()
+        # The shared payloads sent, if the server agreed to shared memory.
+        if shared_memory == True:
+            shared_memory = SHARED_MEMORY_THRESHOLD
+        self.__shared_memory = shared_memory
+        self.__shared = None
+        # The numbers of the functions of the server, indexed by name, if 
+        # the server numbers them (protocol version 9).
+        self.__function_numbers = {}
+        # Whether the server pushes values (protocol version 10), the 
+        # callbacks subscribed to each topic, indexed by topic, and the 
+        # values pushed waiting for the callbacks.
+        self.__pushing = False
+        self.__subscriptions = {}
+        self.__deliveries = None
 
         # Create a socket and connect to the server.
-        self.__sock = TimedSocket()
+        self.__sock = None
         self.__connected = False
         self.__connect()     
-        self.__lock = allocate_lock()       
     
     def __nonzero__(self):
         return True
@@ -45,12 +504,14 @@ class SCProxy(object):
         makes RPC calls to the server.
         @type attrname: str
         @param attrname: The attribute to search for. In this case it must 
-        be the name of a remote method on the RPC server. 
+        be the name of a remote method on the RPC server. The stub is kept,
+        so it is only built the first time.
         """
         if attrname == '':
             return self
-        else:
-            return partial(self.make_rpc_call, attrname)
+        stub = partial(self.make_rpc_call, attrname)
+        self.__dict__[attrname] = stub
+        return stub
     
     def set_address(self, address):
         """
@@ -63,121 +524,1041 @@ class SCProxy(object):
     
     def __connect(self):
         """Connects to an instance of SCRPC."""
+        # A closed socket cannot be reconnected, so every connection gets a
+        # fresh one.
         try:
-            self.__sock.connect(self.__address)
+            self.__sock = open_connection(self.__address)
         except Exception, excep:
             raise SCProxy.CommunicationError('Error connecting to RPC server.', excep)
         self.__connected = True
+        if self.__metrics != None:
+            self.__metrics.connection_opened()
+        self.__negotiate()
+        
+        # Replies to version 2 calls may arrive in any order. They are 
+        # received by a separate thread and matched to the pending calls.
+        if self.__protocol >= 2:
+            receiver = Thread(target=self.__receive, args=(self.__sock, self.__serializer, self.__codec,
+                                                           self.__shared, self.__function_numbers))
+            receiver.setDaemon(True)
+            receiver.start()
+        
+        # Subscriptions carry over to the new connection.
+        with self.__pending_lock:
+            topics = self.__subscriptions.keys()
+        if len(topics) != 0 and not self.__pushing:
+            logging.getLogger("SMRPC-Client").warning('Server does not push values, subscriptions are lost.')
+        elif len(topics) != 0:
+            try:
+                for topic in topics:
+                    self.__sock.send_lp(pack_frame(SUBSCRIBE, (topic, )))
+            except Exception, excep:
+                self.__disconnect(True)
+                raise SCProxy.CommunicationError('Error sending SUBSCRIBE request to server.', excep)
+    
+    def __negotiate(self):
+        """Negotiates the protocol version and serializer with the server."""
+        self.__protocol = 1
+        self.__serializer = DEFAULT_SERIALIZER
+        self.__codec = None
+        self.__caching = False
+        self.__cacheable = set()
+        self.__shared = None
+        # Numbers may differ after reconnecting, e.g. to a restarted server.
+        self.__function_numbers = {}
+        self.__pushing = False
+        if self.__max_protocol < 2:
+            self.__check_serializer()
+            return
+        
+        # Ask the server for the newest common protocol version. Version 1
+        # servers reply with a NACK, in which case version 1 is used.
+        probe = None
+        try:
+            options = {'serializers': ','.join(self.__serializers)}
+            if len(self.__codecs) != 0:
+                options['compression'] = ','.join(self.__codecs)
+            if self.__cache != None and self.__max_protocol >= 6:
+                options['cache'] = '1'
+            if self.__shared_memory != None and self.__max_protocol >= 7:
+                # Shared memory is only offered along with a file the server
+                # must reach (see protocol).
+                probe = create_probe()
+                if probe != None:
+                    options['shm'] = str(self.__shared_memory)
+                    options['shmprobe'] = probe
+            if self.__max_protocol >= 9:
+                options['ids'] = '1'
+            if self.__max_protocol >= 10:
+                options['push'] = '1'
+            self.__sock.send_lp(hello_request(self.__max_protocol, options))
+            response = self.__sock.recv_lp()
+        except Exception, excep:
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Error negotiating protocol with server.', excep)
+        finally:
+            # A server that has reached the probe has removed it.
+            remove_probe(probe)
+        
+        if response == '':
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Connection closed by server.')
+        elif response[:5] == HELLO:
+            try:
+                version, options = parse_hello(response[6:].split(' '))
+                # Servers that predate serializer negotiation use pickle.
+                self.__serializer = get_serializer(options.get('serializer', DEFAULT_SERIALIZER.name))
+                if options.has_key('compression'):
+                    self.__codec = get_codec(options['compression'])
+                self.__caching = options.get('cache') == '1'
+                if options.get('shm') == '1':
+                    self.__shared = SharedPayloads(self.__shared_memory)
+                self.__pushing = options.get('push') == '1'
+            except (ProtocolError, KeyError), excep:
+                self.__disconnect(True)
+                raise SCProxy.CommunicationError('Invalid negotiation reply from server.', excep)
+            self.__protocol = min(version, self.__max_protocol)
+            if options.get('ids') == '1':
+                self.__receive_function_numbers()
+        elif response[:4] == NACK and (response[5:].startswith(SERVER_BUSY) or \
+                                       response[5:].startswith(NO_COMMON_SERIALIZER)):
+            # The server refused the connection.
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError(response[5:])
+        self.__check_serializer()
+    
+    def __receive_function_numbers(self):
+        """Receives the function table the server sends after negotiating."""
+        try:
+            response = self.__sock.recv_lp()
+        except Exception, excep:
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Error negotiating protocol with server.', excep)
+        try:
+            verb, _, _, payload = parse_frame(response)
+            if verb != FUNCTIONS:
+                raise ProtocolError('Function table is missing.')
+            self.__function_numbers.update(parse_functions(payload))
+        except ProtocolError, excep:
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Invalid negotiation reply from server.', excep)
+
+    def __check_serializer(self):
+        """Makes sure the negotiated serializer is one we offered."""
+        if self.__serializer.name not in self.__serializers:
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Server does not support serializer %s.' % 
+                                             ' or '.join(self.__serializers))
         
     def __disconnect(self, quiet=False):
         """Disconnects from the server."""
+        if self.__connected and self.__metrics != None:
+            self.__metrics.connection_closed()
+        self.__connected = False
         try:
+            try:
+                # Wake up the receiver thread before closing the socket.
+                self.__sock.shutdown()
+            except Exception:
+                pass
             self.__sock.close()
         except Exception, excep:
             if not quiet:
                 raise SCProxy.CommunicationError('Error disconnecting from server.', excep)
-        self.__connected = False
+        finally:
+            # Calls still waiting for a reply will never get one.
+            with self.__pending_lock:
+                pending, self.__pending = self.__pending, {}
+                streams, self.__streams = self.__streams, {}
+                uploads, self.__uploads = self.__uploads, {}
+                records, self.__records = self.__records, {}
+                self.__cache_keys = {}
+            # Invalidations may have been missed while disconnected.
+            if self.__caching:
+                self.__cache.invalidate()
+            if self.__shared != None:
+                self.__shared.close()
+            for record, _ in records.itervalues():
+                self.__metrics.record_call(record)
+            for window in uploads.itervalues():
+                window.stop()
+            for future in pending.itervalues():
+                future.set_exception(SCProxy.CommunicationError('Connection to server lost.'))
+            for stream in streams.itervalues():
+                stream.finish(SCProxy.CommunicationError('Connection to server lost.'))
     
     def close(self):
-        """Publicly available disconnect method."""
-        self.__disconnect()
-    
-    def make_rpc_call(self, function_name, *function_input):
+        """
+        Publicly available disconnect method. Subscriptions end as well.
+        """
+        with self.__lock:
+            with self.__pending_lock:
+                deliveries, self.__deliveries = self.__deliveries, None
+                self.__subscriptions = {}
+            if deliveries != None:
+                deliveries.close()
+            self.__disconnect()
+
+    def connect(self):
+        """
+        Connects to the server again if the connection has been lost.
+        Calls do this by themselves, so it is only needed to find out
+        whether the server is reachable.
+        @raise SCProxy.CommunicationError: If the server cannot be reached.
+        """
+        with self.__lock:
+            if not self.__connected:
+                self.__connect()
+
+    def is_connected(self):
+        """Checks whether the proxy is connected to the server."""
+        return self.__connected
+
+    def make_rpc_call(self, function_name, *function_input, **options):
         """
         Perform a remote procedure call.
         @type function_name: str
         @param function_name: The name of the remote function to call.
         @type function_input: list
         @param function_input: The input for the remote function.
+        @param options: Either 'timeout', the number of seconds the call may
+        take, or 'deadline', the time (as returned by time.time) by which it
+        must be finished. Without either, a call made while a call is 
+        performed on a server inherits its deadline. Version 8 servers do 
+        not perform calls that have expired and tell the function when they
+        are cancelled (see cancellation). Version 1 servers cannot be told,
+        so the proxy stops waiting and disconnects when the deadline passes.
+        @return: The result of the remote function. For generator functions
+        this is an SCStream (or a list when the server cannot stream).
+        @raise SCProxy.DeadlineExceeded: If the deadline passes first.
+        @see: SCUpload
         """
-        logger = logging.getLogger("SMRPC-Client")
-        
+        deadline = call_deadline(options)
         with self.__lock:
             # Make sure that the proxy is connected to the server.
             if not self.__connected:
                 self.__connect()
             
-            # Marshal the function input.
-            try:
-                marshalled_input = dumps(function_input, -1)
-            except PicklingError, excep:
-                raise SCProxy.MarshalingError('Error marshaling function input', excep)
+            # Servers speaking protocol version 1 can only handle one call 
+            # at a time on a connection.
+            if self.__protocol < 2:
+                function_input, _ = split_uploads(function_input, False)
+                return self.__perform(function_name, self.__marshal(function_input), deadline)
+            
+            future = self.__send_call(function_name, function_input, deadline=deadline)
+        if not future.wait(SCProxy.MAX_CALL_LENGTH):
+            future.cancel(SCProxy.RemoteError('Timeout while performing remote function.'))
+        return future.result(0)
+    
+    def call_async(self, function_name, *function_input, **options):
+        """
+        Starts a remote procedure call without waiting for it to finish. Any
+        number of calls may be in flight on the connection at once, and the 
+        server may finish them in any order.
+        @type function_name: str
+        @param function_name: The name of the remote function to call.
+        @type function_input: list
+        @param function_input: The input for the remote function.
+        @param options: 'timeout' or 'deadline' (see make_rpc_call). The 
+        deadline applies when the future is waited for. Calls to version 1
+        servers are performed before call_async returns, within the 
+        deadline.
+        @rtype: SCFuture
+        @return: A future holding the outcome of the call.
+        """
+        deadline = call_deadline(options)
+        with self.__lock:
+            # Make sure that the proxy is connected to the server.
+            if not self.__connected:
+                self.__connect()
+            
+            if self.__protocol >= 2:
+                return self.__send_call(function_name, function_input, deadline=deadline)
             
-            # Send the PERFORM request to the server.
+            # Version 1 calls are performed synchronously.
+            future = SCFuture()
             try:
-                self.__sock.send_lp('PERFORM %s'%function_name)
+                function_input, _ = split_uploads(function_input, False)
+                future.set_result(self.__perform(function_name, self.__marshal(function_input),
+                                                deadline))
             except Exception, excep:
-                logger.info('Error sending PERFORM request to server.', exc_info=True)
-                self.__disconnect(True)
-                raise SCProxy.CommunicationError('Error sending PERFORM request to server.', excep)
-            
-            # Wait for the server to acknowledge the PERFORM request.
+                future.set_exception(excep)
+            return future
+    
+    def invalidate_cache(self, function_name=None, *argument_list):
+        """
+        Forgets results cached by the proxy. The server invalidates them by
+        itself when they become stale, so this is rarely needed.
+        @type function_name: str
+        @param function_name: The function whose results to forget, or None
+        for all functions.
+        @param argument_list: The arguments of the call whose result to 
+        forget. Without them, all results of the function are forgotten.
+        """
+        if self.__cache != None:
+            self.__cache.invalidate(function_name, argument_list or None)
+
+    def cache_stats(self):
+        """
+        @rtype: dict
+        @return: The statistics of the cache (see ResultCache.stats), or 
+        None if the proxy does not cache results.
+        """
+        if self.__cache == None:
+            return None
+        return self.__cache.stats()
+
+    def subscribe(self, topic, callback):
+        """
+        Subscribes to the values the server publishes on a topic (see 
+        SCRPC.publish). The server pushes the latest value right away, and
+        every value published after it. The callbacks are called one at a 
+        time by a thread of the proxy. If they fall behind, values of 
+        PUSH_QUEUE_SIZE topics wait for them and older values are skipped 
+        (see pubsub). Subscriptions are renewed when the proxy reconnects.
+        Version 10 servers only.
+        @type topic: str
+        @param topic: The topic. It must not contain newlines.
+        @type callback: function
+        @param callback: The function called with the topic and the value.
+        @raise ValueError: If the topic contains a newline.
+        @raise SCProxy.RemoteError: If the server does not push values.
+        """
+        if '\n' in topic:
+            raise ValueError('Invalid topic (%r)' % topic)
+        with self.__lock:
+            if not self.__connected:
+                self.__connect()
+            if not self.__pushing:
+                raise SCProxy.RemoteError('Server does not support subscriptions.')
+            with self.__pending_lock:
+                callbacks = self.__subscriptions.setdefault(topic, [])
+                callbacks.append(callback)
+                if self.__deliveries == None:
+                    self.__deliveries = PushQueue(SCProxy.PUSH_QUEUE_SIZE)
+                    deliverer = Thread(target=self.__deliver, args=(self.__deliveries, ))
+                    deliverer.setDaemon(True)
+                    deliverer.start()
+            # Further callbacks get the values published from now on.
+            if len(callbacks) == 1:
+                self.__send_subscription(SUBSCRIBE, topic)
+
+    def unsubscribe(self, topic, callback=None):
+        """
+        Ends a subscription.
+        @type topic: str
+        @param topic: The topic.
+        @type callback: function
+        @param callback: The callback to remove, or None to remove all 
+        callbacks of the topic.
+        """
+        with self.__lock:
+            with self.__pending_lock:
+                callbacks = self.__subscriptions.get(topic)
+                if callbacks == None:
+                    return
+                if callback == None:
+                    del callbacks[:]
+                elif callback in callbacks:
+                    callbacks.remove(callback)
+                if len(callbacks) != 0:
+                    return
+                self.__subscriptions.pop(topic, None)
+            if self.__connected and self.__pushing:
+                self.__send_subscription(UNSUBSCRIBE, topic)
+
+    def batch(self, parallel=False):
+        """
+        Starts a batch of calls, which are sent to the server in one frame
+        and answered in one frame. Servers that do not support batches get
+        the calls one by one, and may perform them concurrently.
+        @type parallel: bool
+        @param parallel: Whether the server may perform the calls 
+        concurrently rather than in order.
+        @rtype: SCBatch
+        """
+        return SCBatch(self.__send_batch, parallel)
+    
+    def __send_batch(self, calls, futures, parallel):
+        """
+        Sends the calls of a batch.
+        @type calls: list
+        @param calls: The function names and input of the calls.
+        @type futures: list
+        @param futures: The futures to complete with the outcomes.
+        """
+        try:
+            with self.__lock:
+                if not self.__connected:
+                    self.__connect()
+                if self.__protocol >= 5:
+                    calls = [(function_name, split_uploads(function_input, False)[0])
+                             for function_name, function_input in calls]
+                    batch_future = self.__send_call(parallel and 'parallel' or 'sequential', calls, BATCH)
+                    batch_future.add_done_callback(partial(complete_batch, futures, self.__serializer))
+                    return
+                for (function_name, function_input), future in zip(calls, futures):
+                    if self.__protocol >= 2:
+                        self.__send_call(function_name, function_input).add_done_callback(
+                            partial(copy_outcome, future))
+                        continue
+                    # Version 1 calls are performed synchronously.
+                    function_input, _ = split_uploads(function_input, False)
+                    try:
+                        future.set_result(self.__perform(function_name, self.__marshal(function_input)))
+                    except Exception, excep:
+                        future.set_exception(excep)
+        except Exception, excep:
+            for future in futures:
+                future.set_exception(excep)
+    
+    def __marshal(self, function_input):
+        """
+        Marshals the function input with the serializer of the connection.
+        @rtype: tuple
+        @return: The parts of the marshalled input.
+        """
+        try:
+            return self.__serializer.dumps(function_input)
+        except Exception, excep:
+            raise SCProxy.MarshalingError('Error marshaling function input', excep)
+    
+    def __send_call(self, function_name, function_input, verb=CALL, deadline=None):
+        """
+        Sends a version 2 CALL frame. Must be called with the lock held.
+        @type function_name: str
+        @param function_name: The name of the remote function to call.
+        @type function_input: tuple
+        @param function_input: The input for the remote function.
+        @type verb: str
+        @param verb: CALL, or BATCH to send the calls of a batch. In that
+        case function_name is the batch mode and function_input the calls.
+        @type deadline: float
+        @param deadline: The deadline of the call, or None.
+        @rtype: SCFuture
+        """
+        key = None
+        arguments = function_input
+        if self.__caching and verb == CALL and function_name in self.__cacheable:
+            key = cache_key(function_name, function_input)
+            if key != None:
+                payload = self.__cache.get(key, self.__serializer.name)
+                if payload != None:
+                    future = SCFuture()
+                    try:
+                        future.set_result(decode_reply(RESULT, payload, self.__serializer))
+                    except Exception, excep:
+                        future.set_exception(excep)
+                    return future
+        if deadline != None and deadline <= time.time():
+            future = SCFuture()
+            future.set_exception(SCProxy.DeadlineExceeded(DEADLINE_EXCEEDED))
+            return future
+        record = None
+        if self.__metrics != None and verb == CALL:
+            record = CallRecord(function_name)
+            started = time.time()
+        function_input, uploads = split_uploads(function_input, self.__protocol >= 4)
+        flags, marshalled_input = compress_payload(self.__codec, self.__marshal(function_input),
+                                                   self.COMPRESSION_THRESHOLD)
+        if self.__shared != None:
+            flags, marshalled_input = self.__shared.share(flags, marshalled_input)
+        
+        self.__call_id += 1
+        call_id = str(self.__call_id)
+        future = SCFuture(partial(self.__cancel_call, self.__sock, call_id), deadline)
+        function_field = function_name
+        if verb == CALL:
+            number = self.__function_numbers.get(function_name)
+            if number != None:
+                flags += FLAG_NUMBERED
+                function_field = str(number)
+        fields = (call_id, function_field)
+        if deadline != None and self.__protocol >= 8:
+            # Clocks differ between hosts, so the time left is sent.
+            flags += FLAG_DEADLINE
+            fields = (call_id, '%.6f' % max(deadline - time.time(), 0.0), function_field)
+        frame = pack_frame(verb, fields, marshalled_input, flags)
+        with self.__pending_lock:
+            self.__pending[call_id] = future
+            if self.__caching and verb == CALL:
+                self.__cache_keys[call_id] = (function_name, arguments, key, self.__cache.generation())
+            if record != None:
+                sending = time.time()
+                record.add_time('serialize', sending - started)
+                record.bytes_out = sum([len(part) for part in frame])
+                self.__records[call_id] = (record, sending)
+        
+        # Send the function name and input in one frame, preceded by the 
+        # positions of the streamed arguments.
+        try:
+            if len(uploads) != 0:
+                positions = ','.join([str(position) for position, _ in uploads])
+                self.__sock.send_lp(pack_frame(UPLOAD, (call_id, positions)))
+            self.__sock.send_lp(frame)
+        except Exception, excep:
+            logging.getLogger("SMRPC-Client").info('Error sending CALL request to server.', exc_info=True)
+            if self.__shared != None:
+                self.__shared.discard(flags, marshalled_input)
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Error sending CALL request to server.', excep)
+        
+        for position, upload in uploads:
+            self.__start_upload(upload_id(call_id, position), upload)
+        return future
+    
+    def __send_subscription(self, verb, topic):
+        """
+        Sends a SUBSCRIBE or UNSUBSCRIBE frame. Must be called with the lock
+        held.
+        """
+        try:
+            self.__sock.send_lp(pack_frame(verb, (topic, )))
+        except Exception, excep:
+            logging.getLogger("SMRPC-Client").info('Error sending %s request to server.' % verb, exc_info=True)
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Error sending %s request to server.' % verb, excep)
+
+    def __deliver(self, deliveries):
+        """Thread function calling the callbacks with the values pushed."""
+        while True:
+            entry = deliveries.get()
+            if entry == None:
+                return
+            topic, value = entry
+            with self.__pending_lock:
+                callbacks = list(self.__subscriptions.get(topic, ()))
+            for callback in callbacks:
+                try:
+                    callback(topic, value)
+                except Exception: #IGNORE:W0703
+                    logging.getLogger("SMRPC-Client").warning('Unhandled exception in subscription callback.',
+                                                              exc_info=True)
+
+    def __cancel_call(self, sock, call_id):
+        """
+        Forgets a call that has been cancelled, stops its uploads and asks
+        the server to stop performing it.
+        @type sock: TimedSocket
+        @param sock: The socket of the connection the call was made on.
+        """
+        with self.__pending_lock:
+            if sock is not self.__sock:
+                return
+            self.__pending.pop(call_id, None)
+            self.__cache_keys.pop(call_id, None)
+            record, _ = self.__records.pop(call_id, (None, None))
+            prefix = call_id + '.'
+            windows = [self.__uploads.pop(uid) for uid in self.__uploads.keys() if uid.startswith(prefix)]
+        if record != None:
+            self.__metrics.record_call(record)
+        for window in windows:
+            window.stop()
+        if self.__protocol >= 8:
             try:
-                response = self.__sock.recv_lp()
+                self.__send_frame(sock, pack_frame(CANCEL, (call_id, )))
+            except SCProxy.CommunicationError:
+                pass
+    
+    def __start_upload(self, uid, upload):
+        """
+        Starts a thread sending the chunks of an upload. Must be called with
+        the lock held.
+        """
+        window = StreamWindow()
+        with self.__pending_lock:
+            self.__uploads[uid] = window
+        sender = Thread(target=self.__upload, args=(uid, upload, window, self.__serializer, self.__codec,
+                                                    partial(self.__send_frame, self.__sock)))
+        sender.setDaemon(True)
+        sender.start()
+    
+    def __upload(self, uid, upload, window, serializer, codec, send):
+        """Thread function sending an upload."""
+        try:
+            send_upload(upload, uid, window, serializer, codec, send)
+        finally:
+            with self.__pending_lock:
+                self.__uploads.pop(uid, None)
+    
+    def __send_frame(self, sock, frame):
+        """
+        Sends a frame from a thread other than the caller's.
+        @type sock: TimedSocket
+        @param sock: The socket of the connection the frame belongs to.
+        @raise SCProxy.CommunicationError: If the connection has been lost.
+        """
+        with self.__lock:
+            if sock is not self.__sock or not self.__connected:
+                raise SCProxy.CommunicationError('Connection to server lost.')
+            try:
+                sock.send_lp(frame)
             except Exception, excep:
-                logger.info('Server did not respond to PERFORM request.', exc_info=True)
-                self.__disconnect(True)
-                raise SCProxy.CommunicationError('Server did not respond to PERFORM request.', excep)
-            
-            # Check the response from the server.
-            if response == '':
+                logging.getLogger("SMRPC-Client").info('Error sending frame to server.', exc_info=True)
                 self.__disconnect(True)
-                raise SCProxy.CommunicationError('Connection closed by server.')
-            elif response[:4] == 'NACK':
-                raise SCProxy.RemoteError('%s'%response[5:])
-            
-            # Now send the input to the function call.
+                raise SCProxy.CommunicationError('Error sending frame to server.', excep)
+    
+    def __receive(self, sock, serializer, codec, shared, function_numbers):
+        """
+        Receives replies from the server and completes the matching futures.
+        Runs in its own thread for as long as the connection is up.
+        @type sock: TimedSocket
+        @param sock: The socket of the connection.
+        @type serializer: Serializer
+        @param serializer: The serializer of the connection.
+        @type codec: Codec
+        @param codec: The compression codec of the connection or None.
+        @type shared: SharedPayloads
+        @param shared: The shared payloads of the connection or None.
+        @type function_numbers: dict
+        @param function_numbers: The numbers of the functions of the server.
+        """
+        logger = logging.getLogger("SMRPC-Client")
+        while True:
             try:
-                self.__sock.send_lp(marshalled_input)
+                response = sock.recv_lp_buffer(SCProxy.MAX_CALL_LENGTH)
+            except TimedSocket.Timeout:
+                continue
             except Exception, excep:
-                logger.info('Error sending function input to server.', exc_info=True)
-                self.__disconnect(True)
-                raise SCProxy.CommunicationError('Error sending function input to server.', excep)
+                self.__connection_lost(sock, excep)
+                return
+            if response == '':
+                self.__connection_lost(sock, None)
+                return
             
-            # Wait for the server to acknowledge the receipt of the input.
             try:
-                response = self.__sock.recv_lp()
-            except Exception, excep:
-                logger.info('Server did not ack receipt of input.', exc_info=True)
-                self.__disconnect(True)
-                raise SCProxy.CommunicationError('Server did not ack receipt of input.', excep)
+                verb, flags, fields, payload = parse_frame(response)
+            except ProtocolError, excep:
+                self.__connection_lost(sock, excep)
+                return
             
-            # Check the response.
-            if response == '':
-                self.__disconnect(True)
-                raise SCProxy.CommunicationError('Connection closed by server.')
-            elif response[:4] == 'NACK':
-                raise SCProxy.RemoteError('%s'%response[5:])
-            elif response[:9] == 'EXCEPTION':
+            if verb == MORE or verb == STOP:
+                # The server grants more chunks of an upload, or has no use
+                # for the rest of it.
+                with self.__pending_lock:
+                    if verb == MORE:
+                        window = self.__uploads.get(fields[0])
+                    else:
+                        window = self.__uploads.pop(fields[0], None)
+                if window == None:
+                    continue
+                if verb == MORE:
+                    window.grant(int(fields[1]))
+                else:
+                    window.stop()
+                continue
+            if verb == INVALIDATE:
+                self.__invalidate(fields, payload, serializer)
+                continue
+            if verb == PUBLISH:
+                # Topics may contain spaces.
+                self.__receive_value(' '.join(fields), flags, payload, serializer, codec)
+                continue
+            if verb == FUNCTIONS:
+                # Functions registered after the connection was made.
                 try:
-                    raise loads(response[10:])
-                except (UnpicklingError, ImportError), excep:
-                    raise SCProxy.RemoteError('Unknown exception raised on server.', excep)
+                    function_numbers.update(parse_functions(payload))
+                except ProtocolError:
+                    logger.debug('Ignoring malformed function table.', exc_info=True)
+                continue
             
-            # The input has successfully arrived at the server. Now wait for the 
-            # result - or an error indication.
+            # Replies to calls that have timed out on this side are dropped.
+            call_id = fields[0]
+            future = None
+            record = None
+            cached = None
+            with self.__pending_lock:
+                stream = self.__streams.get(call_id)
+                if stream == None:
+                    future = self.__pending.pop(call_id, None)
+                    cached = self.__cache_keys.pop(call_id, None)
+                    if self.__metrics != None:
+                        record, sending = self.__records.pop(call_id, (None, None))
+                elif verb != CHUNK:
+                    del self.__streams[call_id]
+            if record != None:
+                received = time.time()
+                record.add_time('network', received - sending)
+                record.verb = verb
+                record.bytes_in = len(response)
+            if stream != None:
+                feed_stream(stream, verb, flags, payload, serializer, codec, shared)
+                continue
+            if future == None:
+                logger.debug('Dropping reply to unknown call %s.' % call_id)
+                if FLAG_SHARED in flags:
+                    # Mapping the payload removes it.
+                    try:
+                        map_payload(shared, flags, payload)
+                    except SharedMemoryError:
+                        pass
+                continue
+            if verb == STREAM:
+                stream = SCStream(partial(self.__control_stream, sock, MORE, call_id),
+                                  partial(self.__control_stream, sock, STOP, call_id))
+                with self.__pending_lock:
+                    self.__streams[call_id] = stream
+                if record != None:
+                    self.__metrics.record_call(record)
+                future.set_result(stream)
+                continue
             try:
-                result = self.__sock.recv_lp(SCProxy.MAX_CALL_LENGTH)
-            except (TimedSocket.Timeout, TimedSocket.Exception), excep:
-                raise SCProxy.RemoteError('Timeout while performing remote function.', excep)
+                payload = decompress_payload(codec, flags, map_payload(shared, flags, payload))
+                outcome = decode_reply(verb, payload, serializer)
+                success = True
+                if cached != None and FLAG_CACHEABLE in flags:
+                    function_name, arguments, key, generation = cached
+                    self.__cacheable.add(function_name)
+                    if key == None:
+                        key = cache_key(function_name, arguments)
+                    if key != None:
+                        self.__cache.put(key, serializer.name, str(payload), generation)
+            except CompressionError, excep:
+                outcome = SCProxy.MarshalingError('Error decompressing reply.', excep)
+                success = False
+            except SharedMemoryError, excep:
+                outcome = SCProxy.MarshalingError('Error mapping reply.', excep)
+                success = False
             except Exception, excep:
-                logger.info('Error receiving remote function output.', exc_info=True)
+                outcome = excep
+                success = False
+            if record != None:
+                record.add_time('serialize', time.time() - received)
+                self.__metrics.record_call(record)
+            if success:
+                future.set_result(outcome)
+            else:
+                future.set_exception(outcome)
+    
+    def __receive_value(self, topic, flags, payload, serializer, codec):
+        """Hands a value pushed by the server over to the callbacks."""
+        deliveries = self.__deliveries
+        if deliveries == None:
+            return
+        try:
+            value = serializer.loads(decompress_payload(codec, flags, payload))
+        except (CompressionError, ImportError) + serializer.errors:
+            logging.getLogger("SMRPC-Client").debug('Dropping malformed value of %s.' % topic, exc_info=True)
+            return
+        deliveries.put(topic, value)
+
+    def __invalidate(self, fields, payload, serializer):
+        """
+        Forgets the cached results named by an INVALIDATE frame: those of
+        all functions, of one function or of one call.
+        """
+        if len(fields) == 0 or fields[0] == '':
+            self.__cache.invalidate()
+            return
+        argument_list = None
+        # Arguments that may have changed type on the way (e.g. str to 
+        # unicode) would not match the key of the call.
+        if len(payload) != 0 and serializer.exact:
+            try:
+                argument_list = serializer.loads_arguments(payload)
+            except serializer.errors:
+                pass
+        self.__cache.invalidate(fields[0], argument_list)
+
+    def __control_stream(self, sock, verb, call_id, count=None):
+        """
+        Sends a MORE or STOP frame for a stream.
+        @type sock: TimedSocket
+        @param sock: The socket of the connection the stream belongs to.
+        """
+        fields = (call_id, )
+        if verb == STOP:
+            with self.__pending_lock:
+                self.__streams.pop(call_id, None)
+        else:
+            fields = (call_id, count)
+        try:
+            self.__send_frame(sock, pack_frame(verb, fields))
+        except SCProxy.CommunicationError:
+            # The stream has failed with the connection.
+            pass
+    
+    def __connection_lost(self, sock, excep):
+        """Called by the receiver thread when the connection breaks."""
+        with self.__lock:
+            if sock is self.__sock and self.__connected:
+                logging.getLogger("SMRPC-Client").info('Connection to server lost: %s' % excep)
                 self.__disconnect(True)
-                raise SCProxy.CommunicationError('Error receiving remote function output.', excep)
-            
-            # Check the result.
-            if result == '':
+    
+    def __perform(self, function_name, marshalled_input, deadline=None):
+        """
+        Performs a remote call using the version 1 PERFORM handshake.
+        @type function_name: str
+        @param function_name: The name of the remote function to call.
+        @type marshalled_input: tuple
+        @param marshalled_input: The parts of the marshalled (pickled) input
+        for the remote function.
+        @type deadline: float
+        @param deadline: The time by which the call must be finished, or 
+        None. The server cannot be told, so a call that is not finished by
+        then is abandoned along with the connection, which would deliver 
+        its result to the next call.
+        @raise SCProxy.DeadlineExceeded: If the deadline passes first.
+        """
+        logger = logging.getLogger("SMRPC-Client")
+        if deadline != None and deadline <= time.time():
+            raise SCProxy.DeadlineExceeded(DEADLINE_EXCEEDED)
+        
+        # Send the PERFORM request to the server.
+        try:
+            self.__sock.send_lp('PERFORM %s'%function_name)
+        except Exception, excep:
+            logger.info('Error sending PERFORM request to server.', exc_info=True)
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Error sending PERFORM request to server.', excep)
+        
+        # Wait for the server to acknowledge the PERFORM request.
+        try:
+            response = self.__sock.recv_lp()
+        except Exception, excep:
+            logger.info('Server did not respond to PERFORM request.', exc_info=True)
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Server did not respond to PERFORM request.', excep)
+        
+        # Check the response from the server.
+        if response == '':
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Connection closed by server.')
+        elif response[:4] == 'NACK':
+            raise nack_error(str(response[5:]))
+        
+        # Now send the input to the function call.
+        try:
+            self.__sock.send_lp(marshalled_input)
+        except Exception, excep:
+            logger.info('Error sending function input to server.', exc_info=True)
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Error sending function input to server.', excep)
+        
+        # Wait for the server to acknowledge the receipt of the input.
+        try:
+            response = self.__sock.recv_lp()
+        except Exception, excep:
+            logger.info('Server did not ack receipt of input.', exc_info=True)
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Server did not ack receipt of input.', excep)
+        
+        # Check the response.
+        if response == '':
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Connection closed by server.')
+        elif response[:4] == 'NACK':
+            raise nack_error(str(response[5:]))
+        elif response[:9] == 'EXCEPTION':
+            try:
+                raise unmarshal(buffer(response, 10))
+            except (UnpicklingError, ImportError), excep:
+                raise SCProxy.RemoteError('Unknown exception raised on server.', excep)
+        
+        # The input has successfully arrived at the server. Now wait for the 
+        # result - or an error indication.
+        timeout = SCProxy.MAX_CALL_LENGTH
+        if deadline != None:
+            # A timeout of 0 would mean the default timeout of the socket.
+            timeout = min(timeout, max(deadline - time.time(), 0.001))
+        try:
+            result = self.__sock.recv_lp_buffer(timeout)
+        except TimedSocket.Timeout, excep:
+            if deadline != None and deadline <= time.time():
                 self.__disconnect(True)
-                raise SCProxy.CommunicationError('Connection closed by server.')
-            elif result[:9] == 'EXCEPTION':
-                try:
-                    raise loads(result[10:])
-                except (UnpicklingError, ImportError), excep:
-                    raise SCProxy.RemoteError('Unknown exception raised on server.', excep)
-            
-            # Return result.
+                raise SCProxy.DeadlineExceeded(DEADLINE_EXCEEDED)
+            raise SCProxy.RemoteError('Timeout while performing remote function.', excep)
+        except TimedSocket.Exception, excep:
+            raise SCProxy.RemoteError('Timeout while performing remote function.', excep)
+        except Exception, excep:
+            logger.info('Error receiving remote function output.', exc_info=True)
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Error receiving remote function output.', excep)
+        
+        # Check the result.
+        if result == '':
+            self.__disconnect(True)
+            raise SCProxy.CommunicationError('Connection closed by server.')
+        elif result[:4] == 'NACK':
+            raise nack_error(str(result[5:]))
+        elif result[:9] == 'EXCEPTION':
             try:
-                return loads(result[7:])
+                raise unmarshal(buffer(result, 10))
             except (UnpicklingError, ImportError), excep:
-                raise SCProxy.MarshalingError('Error unmarshalling result.', excep)
-            
+                raise SCProxy.RemoteError('Unknown exception raised on server.', excep)
+        
+        # Return result.
+        try:
+            return unmarshal(buffer(result, 7))
+        except (UnpicklingError, ImportError), excep:
+            raise SCProxy.MarshalingError('Error unmarshalling result.', excep)
+
+def nack_error(message):
+    """
+    Builds the exception raised for a NACK reply to a call.
+    @type message: str
+    @param message: The message of the NACK.
+    @rtype: SCProxy.RemoteError
+    """
+    if message == DEADLINE_EXCEEDED:
+        return SCProxy.DeadlineExceeded(message)
+    if message == CALL_CANCELLED:
+        return SCProxy.Cancelled(message)
+    if message.startswith(SERVER_OVERLOADED):
+        return SCProxy.Overloaded(message)
+    return SCProxy.RemoteError(message)
+
+def split_uploads(function_input, streamed):
+    """
+    Takes the SCUpload arguments out of the input of a call.
+    @type function_input: tuple
+    @param function_input: The input for the remote function.
+    @type streamed: bool
+    @param streamed: Whether the server accepts uploads. If not, the 
+    uploads are replaced by lists of their items.
+    @rtype: tuple
+    @return: The input with the uploads replaced, and a list of the 
+    positions and uploads to stream.
+    """
+    uploads = []
+    for position, argument in enumerate(function_input):
+        if isinstance(argument, SCUpload):
+            uploads.append((position, argument))
+    if len(uploads) == 0:
+        return function_input, uploads
+    function_input = list(function_input)
+    for position, upload in uploads:
+        if streamed:
+            function_input[position] = None
+        else:
+            function_input[position] = upload.collect()
+    if not streamed:
+        uploads = []
+    return tuple(function_input), uploads
+
+def send_upload(upload, uid, window, serializer, codec, send):
+    """
+    Sends the chunks of an upload as the server grants them. Runs in a 
+    thread of its own.
+    @type upload: SCUpload
+    @param upload: The upload.
+    @type uid: str
+    @param uid: The upload id.
+    @type window: StreamWindow
+    @param window: The chunks granted by the server.
+    @type send: function
+    @param send: Sends a frame to the server.
+    """
+    try:
+        try:
+            for chunk in upload.chunks():
+                if not window.acquire(SCProxy.MAX_CALL_LENGTH):
+                    # The call has finished or the server stopped reading.
+                    return
+                flags, payload = compress_payload(codec, serializer.dumps(chunk),
+                                                  SCProxy.COMPRESSION_THRESHOLD)
+                send(pack_frame(DATA, (uid, ), payload, flags))
+            payload = ''
+        except SCProxy.CommunicationError:
+            raise
+        except Exception, excep: #IGNORE:W0703
+            # Reading the source failed. The exception is raised on the 
+            # server when the function gets to it.
+            logging.getLogger("SMRPC-Client").debug('Error reading upload.', exc_info=True)
+            payload = serializer.dumps_exception(excep)
+        send(pack_frame(EOF, (uid, ), payload))
+    except SCProxy.CommunicationError:
+        logging.getLogger("SMRPC-Client").debug('Upload %s aborted.' % uid, exc_info=True)
+
+def feed_stream(stream, verb, flags, payload, serializer, codec, shared=None):
+    """
+    Passes a frame received for a stream on to the stream.
+    @type stream: SCStream
+    @param stream: The stream.
+    @type verb: str
+    @param verb: The frame verb (CHUNK, END, EXCEPTION or NACK).
+    @type shared: SharedPayloads
+    @param shared: The shared payloads of the connection or None.
+    """
+    if verb == END:
+        stream.finish()
+        return
+    try:
+        payload = decompress_payload(codec, flags, map_payload(shared, flags, payload))
+        if verb == CHUNK:
+            stream.feed(decode_reply(RESULT, payload, serializer))
+            return
+        decode_reply(verb, payload, serializer)
+        excep = SCProxy.CommunicationError('Unexpected reply (%s) from server.' % verb)
+    except CompressionError, excep:
+        excep = SCProxy.MarshalingError('Error decompressing reply.', excep)
+    except SharedMemoryError, excep:
+        excep = SCProxy.MarshalingError('Error mapping reply.', excep)
+    except Exception, excep:
+        pass
+    if verb == CHUNK:
+        stream.fail(excep)
+    else:
+        stream.finish(excep)
+
+def copy_outcome(target, future):
+    """Completes a future with the outcome of another, finished one."""
+    try:
+        target.set_result(future.result(0))
+    except Exception, excep:
+        target.set_exception(excep)
+
+def complete_batch(futures, serializer, batch_future):
+    """
+    Completes the futures of the calls of a batch once the batch has been
+    answered.
+    @type futures: list
+    @param futures: The futures of the calls.
+    @type serializer: Serializer
+    @param serializer: The serializer of the connection.
+    @type batch_future: SCFuture
+    @param batch_future: The future of the batch, holding the list of 
+    reply verbs and payloads.
+    """
+    try:
+        outcomes = batch_future.result(0)
+        if len(outcomes) != len(futures):
+            raise SCProxy.CommunicationError('Invalid batch reply from server.')
+    except Exception, excep:
+        for future in futures:
+            future.set_exception(excep)
+        return
+    for future, outcome in zip(futures, outcomes):
+        try:
+            verb, payload = outcome
+            future.set_result(decode_reply(verb, payload, serializer))
+        except Exception, excep:
+            future.set_exception(excep)
+
+def decode_reply(verb, payload, serializer=DEFAULT_SERIALIZER):
+    """
+    Decodes a version 2 reply frame.
+    @type verb: str
+    @param verb: The reply verb.
+    @type payload: str
+    @param payload: The reply payload.
+    @type serializer: Serializer
+    @param serializer: The serializer of the connection.
+    @return: The result of the remote call.
+    @raise Exception: The exception raised by the remote function.
+    """
+    if verb == NACK:
+        raise nack_error(str(payload))
+    elif verb == EXCEPTION:
+        try:
+            excep = serializer.loads_exception(payload)
+        except serializer.errors + (ImportError, ), excep:
+            raise SCProxy.RemoteError('Unknown exception raised on server.', excep)
+        raise excep
+    elif verb != RESULT:
+        raise SCProxy.CommunicationError('Unexpected reply (%s) from server.' % verb)
+    
+    try:
+        return serializer.loads(payload)
+    except serializer.errors + (ImportError, ), excep:
+        raise SCProxy.MarshalingError('Error unmarshalling result.', excep)
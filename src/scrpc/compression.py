@@ -0,0 +1,249 @@
+"""
+Compression of frame payloads. The codec used on a connection is
+negotiated along with the serializer (see protocol), and only payloads of
+at least a threshold size are compressed, so small calls pay nothing.
+Compressed frames are marked by the FLAG_COMPRESSED header flag.
+
+zlib is always available. lz4 and zstd are available when the lz4 and the
+zstandard (or zstd) modules are installed.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from protocol import FLAG_COMPRESSED
+import zlib
+import time
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    try:
+        import lz4
+    except ImportError:
+        lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import zstd
+except ImportError:
+    zstd = None
+
+# Codecs that depend on modules that may not be installed. Asking for them
+# is not an error; they are just left out when unavailable.
+OPTIONAL_CODECS = ('lz4', 'zstd')
+
+# Payloads smaller than this are never compressed.
+COMPRESSION_THRESHOLD = 8192
+
+class CompressionError(Exception):
+    """Raised when a compressed payload cannot be decompressed."""
+    def __init__(self, msg):
+        super(CompressionError, self).__init__(msg)
+
+class Codec(object):
+    """Base class of the compression codecs."""
+
+    name = None
+    # The exceptions raised by decompress when given invalid data.
+    errors = (ValueError, )
+
+    def compress(self, data):
+        """Compresses a str."""
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        """Decompresses a str or a buffer."""
+        raise NotImplementedError()
+
+class ZlibCodec(Codec):
+    """zlib. The level favours speed over ratio."""
+
+    name = 'zlib'
+    errors = (zlib.error, )
+    LEVEL = 1
+
+    def compress(self, data):
+        return zlib.compress(data, ZlibCodec.LEVEL)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+class Lz4Codec(Codec):
+    """lz4. Very fast with a moderate ratio."""
+
+    name = 'lz4'
+    errors = (ValueError, RuntimeError)
+
+    def compress(self, data):
+        return lz4.compress(data)
+
+    def decompress(self, data):
+        return lz4.decompress(str(data))
+
+class ZstdCodec(Codec):
+    """zstd. Fast with a good ratio."""
+
+    name = 'zstd'
+    errors = (ValueError, )
+    LEVEL = 3
+
+    def __init__(self):
+        super(ZstdCodec, self).__init__()
+        if zstandard != None:
+            ZstdCodec.errors = (zstandard.ZstdError, )
+
+    def compress(self, data):
+        if zstandard != None:
+            # Compressors are not thread-safe, so one is made per call.
+            return zstandard.ZstdCompressor(level=ZstdCodec.LEVEL).compress(data)
+        return zstd.compress(data, ZstdCodec.LEVEL)
+
+    def decompress(self, data):
+        if zstandard != None:
+            return zstandard.ZstdDecompressor().decompress(str(data))
+        return zstd.decompress(str(data))
+
+# The registry of codecs, indexed by name.
+CODECS = {}
+
+def register_codec(codec):
+    """
+    Makes a codec available for negotiation.
+    @type codec: Codec
+    @param codec: The codec to register.
+    """
+    CODECS[codec.name] = codec
+
+def get_codec(name):
+    """
+    Looks up a codec.
+    @rtype: Codec
+    @raise KeyError: If no codec of that name is registered.
+    """
+    return CODECS[name]
+
+def available_codecs():
+    """Returns the names of the registered codecs."""
+    return CODECS.keys()
+
+def check_codecs(names):
+    """
+    Checks a list of codec names given by the user.
+    @type names: list
+    @param names: The names. None means all registered codecs.
+    @rtype: list
+    @return: The names of the available codecs among them.
+    @raise ValueError: If a codec is unknown.
+    """
+    if names == None:
+        return available_codecs()
+    available = []
+    for name in names:
+        if CODECS.has_key(name):
+            available.append(name)
+        elif name not in OPTIONAL_CODECS:
+            raise ValueError('Unknown compression codec (%s)' % name)
+    return available
+
+def select_codec(offered, allowed):
+    """
+    Picks the codec of a connection during negotiation.
+    @type offered: list
+    @param offered: The codecs offered by the client, most preferred first.
+    @type allowed: list
+    @param allowed: The codecs allowed by the server.
+    @rtype: Codec
+    @return: The first offered codec that is allowed, or None.
+    """
+    for name in offered:
+        if name in allowed and CODECS.has_key(name):
+            return CODECS[name]
+    return None
+
+register_codec(ZlibCodec())
+if lz4 != None:
+    register_codec(Lz4Codec())
+if zstandard != None or zstd != None:
+    register_codec(ZstdCodec())
+
+# Compression statistics, indexed by codec name. Each entry holds the number
+# of payloads compressed, their size before and after compression and the
+# time spent compressing them.
+_stats = {}
+_stats_lock = allocate_lock()
+
+def compression_stats():
+    """
+    Returns the compression statistics of this process.
+    @rtype: dict
+    @return: A dict per codec with the keys 'payloads', 'bytes_in',
+    'bytes_out' and 'seconds'.
+    """
+    with _stats_lock:
+        return dict([(name, dict(stats)) for name, stats in _stats.iteritems()])
+
+def reset_compression_stats():
+    """Clears the compression statistics."""
+    with _stats_lock:
+        _stats.clear()
+
+def compress_payload(codec, payload, threshold=COMPRESSION_THRESHOLD):
+    """
+    Compresses a frame payload if it is large enough and compressible.
+    @type codec: Codec
+    @param codec: The codec of the connection. None disables compression.
+    @type payload: str or tuple
+    @param payload: The payload or the parts of it.
+    @type threshold: int
+    @param threshold: The size below which payloads are sent as they are.
+    @rtype: tuple
+    @return: The frame flags and the payload to send.
+    """
+    if codec == None:
+        return '', payload
+    if isinstance(payload, str):
+        payload = (payload, )
+    length = 0
+    for part in payload:
+        length += len(part)
+    if length < threshold:
+        return '', payload
+
+    start = time.time()
+    compressed = codec.compress(''.join(payload))
+    elapsed = time.time() - start
+    with _stats_lock:
+        stats = _stats.setdefault(codec.name, {'payloads': 0, 'bytes_in': 0,
+                                               'bytes_out': 0, 'seconds': 0.0})
+        stats['payloads'] += 1
+        stats['bytes_in'] += length
+        stats['bytes_out'] += min(len(compressed), length)
+        stats['seconds'] += elapsed
+    if len(compressed) >= length:
+        # Not worth it; the data is probably compressed already.
+        return '', payload
+    return FLAG_COMPRESSED, (compressed, )
+
+def decompress_payload(codec, flags, payload):
+    """
+    Decompresses a frame payload if its flags say it is compressed.
+    @type codec: Codec
+    @param codec: The codec of the connection.
+    @type flags: str
+    @param flags: The frame flags.
+    @type payload: buffer
+    @param payload: The payload received.
+    @return: The decompressed payload.
+    @raise CompressionError: If the payload cannot be decompressed.
+    """
+    if FLAG_COMPRESSED not in flags:
+        return payload
+    if codec == None:
+        raise CompressionError('Compressed frame received, but no compression was negotiated.')
+    try:
+        return codec.decompress(payload)
+    except codec.errors, excep:
+        raise CompressionError('Error decompressing payload (%s).' % excep)
@@ -0,0 +1,432 @@
+"""
+A minimal single-threaded event loop. All sockets are non-blocking and
+are watched by one poller (epoll, poll or select - whichever the platform
+offers), so an idle connection costs a file descriptor and a few objects
+rather than a thread.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from threading import Thread
+from socket import error as socket_error
+from timedsocket import pack_lp
+import select
+import struct
+import errno
+import fcntl
+import os
+import logging
+
+# Event masks. These match the poll and epoll constants on all platforms
+# we know of.
+READ = 0x001
+WRITE = 0x004
+ERROR = 0x008 | 0x010
+
+class SelectPoller(object):
+    """A poller built on select() for platforms without poll and epoll."""
+
+    def __init__(self):
+        super(SelectPoller, self).__init__()
+        self.__fds = {}
+
+    def register(self, fd, events):
+        self.__fds[fd] = events
+
+    modify = register
+
+    def unregister(self, fd):
+        del self.__fds[fd]
+
+    def poll(self, timeout=None):
+        readers = [fd for fd, events in self.__fds.iteritems() if events & READ]
+        writers = [fd for fd, events in self.__fds.iteritems() if events & WRITE]
+        readers, writers, _ = select.select(readers, writers, [], timeout)
+        ready = {}
+        for fd in readers:
+            ready[fd] = READ
+        for fd in writers:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return ready.items()
+
+    def close(self):
+        pass
+
+class PollPoller(object):
+    """A poller built on poll()."""
+
+    def __init__(self):
+        super(PollPoller, self).__init__()
+        self.__poll = select.poll()
+        self.register = self.__poll.register
+        self.modify = self.__poll.modify
+        self.unregister = self.__poll.unregister
+
+    def poll(self, timeout=None):
+        if timeout == None:
+            return self.__poll.poll()
+        return self.__poll.poll(timeout * 1000)
+
+    def close(self):
+        pass
+
+class EpollPoller(object):
+    """A poller built on epoll()."""
+
+    def __init__(self):
+        super(EpollPoller, self).__init__()
+        self.__epoll = select.epoll()
+        self.register = self.__epoll.register
+        self.modify = self.__epoll.modify
+        self.unregister = self.__epoll.unregister
+
+    def poll(self, timeout=None):
+        if timeout == None:
+            timeout = -1
+        return self.__epoll.poll(timeout)
+
+    def close(self):
+        """Closes the epoll file descriptor."""
+        self.__epoll.close()
+
+def make_poller():
+    """Creates the most scalable poller available on this platform."""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    elif hasattr(select, 'poll'):
+        return PollPoller()
+    else:
+        return SelectPoller()
+
+def set_nonblocking(fd):
+    """Puts a file descriptor in non-blocking mode."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class EventLoop(object):
+    """
+    The event loop. Handlers are objects with a fileno(), a handle_read(),
+    a handle_write() and a handle_close() method. Apart from
+    call_soon_threadsafe and stop, all methods must be called from the
+    thread running the loop.
+    """
+
+    def __init__(self):
+        super(EventLoop, self).__init__()
+        self.__poller = make_poller()
+        self.__handlers = {}
+        self.__running = False
+        # The buffer connections receive into while they have no partial
+        # frame pending, allocated on first use.
+        self.__receive_buffer = None
+
+        # Callbacks scheduled by other threads, and the pipe used to wake up
+        # the loop when one is scheduled.
+        self.__callbacks = []
+        self.__callbacks_lock = allocate_lock()
+        self.__wakeup_read, self.__wakeup_write = os.pipe()
+        set_nonblocking(self.__wakeup_read)
+        set_nonblocking(self.__wakeup_write)
+        self.__poller.register(self.__wakeup_read, READ)
+
+    def add_handler(self, handler, events):
+        """
+        Starts watching the file descriptor of a handler.
+        @type events: int
+        @param events: The events (READ and/or WRITE) to watch for.
+        """
+        fd = handler.fileno()
+        self.__handlers[fd] = handler
+        self.__poller.register(fd, events)
+
+    def update_handler(self, handler, events):
+        """Changes the events watched for a handler."""
+        self.__poller.modify(handler.fileno(), events)
+
+    def remove_handler(self, handler):
+        """Stops watching the file descriptor of a handler."""
+        fd = handler.fileno()
+        if self.__handlers.pop(fd, None) != None:
+            self.__poller.unregister(fd)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Schedules a callback to be called by the loop thread. This is the
+        only way for other threads to interact with the loop.
+        """
+        with self.__callbacks_lock:
+            self.__callbacks.append((callback, args))
+        try:
+            os.write(self.__wakeup_write, 'x')
+        except OSError, excep:
+            # A full pipe is as good as a written one.
+            if excep.errno != errno.EAGAIN:
+                raise
+
+    def run(self):
+        """Runs the loop until stop is called."""
+        logger = logging.getLogger('SCRPC (eventloop)')
+        self.__running = True
+        while self.__running:
+            try:
+                events = self.__poller.poll()
+            except (select.error, IOError), excep:
+                if excep.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, mask in events:
+                if fd == self.__wakeup_read:
+                    self.__run_callbacks()
+                    continue
+                handler = self.__handlers.get(fd)
+                if handler == None:
+                    # Removed by an earlier handler in this round.
+                    continue
+                try:
+                    if mask & READ:
+                        handler.handle_read()
+                    if mask & WRITE and self.__handlers.get(fd) is handler:
+                        handler.handle_write()
+                    if mask & ERROR and not mask & READ and self.__handlers.get(fd) is handler:
+                        handler.handle_close()
+                except Exception:
+                    logger.debug('Unhandled exception in event handler.', exc_info=True)
+                    self.remove_handler(handler)
+                    handler.handle_close()
+
+    def run_in_thread(self):
+        """
+        Runs the loop in a new daemon thread.
+        @rtype: Thread
+        @return: The thread running the loop.
+        """
+        thread = Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def receive_buffer(self, size):
+        """
+        Returns the receive buffer shared by the handlers of the loop. The
+        buffer only holds data for the duration of a handler call.
+        @type size: int
+        @param size: The minimum size of the buffer.
+        @rtype: bytearray
+        """
+        if self.__receive_buffer == None or len(self.__receive_buffer) < size:
+            self.__receive_buffer = bytearray(size)
+        return self.__receive_buffer
+
+    def stop(self):
+        """Makes the loop exit. May be called from any thread."""
+        self.call_soon_threadsafe(self.__stop)
+
+    def close(self):
+        """Releases the resources held by a stopped loop."""
+        self.__poller.close()
+        os.close(self.__wakeup_read)
+        os.close(self.__wakeup_write)
+
+    def __stop(self):
+        self.__running = False
+
+    def __run_callbacks(self):
+        """Runs the callbacks scheduled by other threads."""
+        try:
+            while os.read(self.__wakeup_read, 4096):
+                pass
+        except OSError, excep:
+            if excep.errno != errno.EAGAIN:
+                raise
+        with self.__callbacks_lock:
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                logging.getLogger('SCRPC (eventloop)').debug('Unhandled exception in callback.', exc_info=True)
+
+class FramedConnection(object):
+    """
+    A non-blocking connection exchanging length-prefixed frames (the format
+    used by TimedSocket.send_lp and TimedSocket.recv_lp) through an event
+    loop. Subclasses implement frame_received and connection_closed.
+    """
+
+    RECV_SIZE = 65536
+
+    def __init__(self, loop, sock, data=''):
+        """
+        Constructor.
+        @type loop: EventLoop
+        @param loop: The event loop driving the connection.
+        @type sock: socket
+        @param sock: A connected native socket.
+        @type data: str
+        @param data: Input that has already been read from the socket.
+        @see: TimedSocket.buffered
+        """
+        super(FramedConnection, self).__init__()
+        self.loop = loop
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.closed = False
+        self.__fd = sock.fileno()
+
+        # Input state. Small frames are received into the buffer shared by
+        # the connections of the loop, and only a partial frame left over is
+        # kept in an input buffer of the connection's own, so an idle
+        # connection holds no input buffer. Frames larger than the input
+        # buffer are received straight into a buffer of their own.
+        self.__input = None
+        self.__filled = 0
+        self.__frame = None
+        self.__frame_filled = 0
+        if len(data) != 0:
+            self.__input = bytearray(FramedConnection.RECV_SIZE)
+            self.__input[:len(data)] = data
+            self.__filled = len(data)
+
+        # Output state.
+        self.__output = []
+        self.__output_offset = 0
+        self.__writing = False
+
+        loop.add_handler(self, READ)
+        if self.__filled != 0:
+            loop.call_soon_threadsafe(self.__process_input)
+
+    def fileno(self):
+        return self.__fd
+
+    def frame_received(self, frame):
+        """Called by the loop for every complete frame received."""
+        raise NotImplementedError()
+
+    def connection_closed(self):
+        """Called once when the connection has been closed."""
+        pass
+
+    def send_frame(self, frame):
+        """
+        Queues a frame for sending. Must be called from the loop thread.
+        @type frame: str or tuple
+        @param frame: The frame or the parts of the frame to send.
+        @see: TimedSocket.send_lp
+        """
+        if self.closed:
+            return
+        self.__output.extend(pack_lp(frame))
+        if not self.__writing:
+            # Try to send right away; most frames fit in the socket buffer.
+            self.handle_write()
+            if len(self.__output) != 0 and not self.closed:
+                self.__writing = True
+                self.loop.update_handler(self, READ | WRITE)
+
+    def handle_read(self):
+        if self.__frame != None:
+            target = memoryview(self.__frame)[self.__frame_filled:]
+        elif self.__input != None:
+            target = memoryview(self.__input)[self.__filled:]
+        else:
+            self.__input = self.loop.receive_buffer(FramedConnection.RECV_SIZE)
+            target = memoryview(self.__input)[:FramedConnection.RECV_SIZE]
+        try:
+            received = self.sock.recv_into(target)
+        except socket_error, excep:
+            if excep.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.__release_input()
+                return
+            received = 0
+        if received == 0:
+            self.__input = None
+            self.handle_close()
+            return
+
+        if self.__frame != None:
+            self.__frame_filled += received
+            if self.__frame_filled == len(self.__frame):
+                frame, self.__frame = self.__frame, None
+                self.frame_received(frame)
+            return
+
+        self.__filled += received
+        self.__process_input()
+
+    def __process_input(self):
+        """Passes the complete frames received on and releases the input buffer."""
+        self.__split_input()
+        self.__release_input()
+
+    def __release_input(self):
+        """
+        Gives up the shared receive buffer, copying a partial frame left in
+        it to an input buffer of the connection's own, and drops an input
+        buffer that holds no data.
+        """
+        if self.__filled == 0 or self.closed:
+            self.__input = None
+            self.__filled = 0
+        elif self.__input is self.loop.receive_buffer(FramedConnection.RECV_SIZE):
+            private = bytearray(FramedConnection.RECV_SIZE)
+            private[:self.__filled] = self.__input[:self.__filled]
+            self.__input = private
+
+    def __split_input(self):
+        """Passes the complete frames in the input buffer on."""
+        start = 0
+        while not self.closed and self.__filled - start >= 4:
+            (length, ) = struct.unpack_from('!I', self.__input, start)
+            end = start + 4 + length
+            if end <= self.__filled:
+                frame = self.__input[start+4:end]
+                start = end
+                self.frame_received(frame)
+            else:
+                if 4 + length > FramedConnection.RECV_SIZE:
+                    # The frame does not fit in the input buffer. Move the 
+                    # part received so far to a buffer of its own.
+                    self.__frame = bytearray(length)
+                    self.__frame_filled = self.__filled - start - 4
+                    self.__frame[:self.__frame_filled] = self.__input[start+4:self.__filled]
+                    start = self.__filled
+                break
+
+        # Move the remaining data to the front of the input buffer.
+        if start != 0:
+            rest = self.__filled - start
+            self.__input[:rest] = self.__input[start:self.__filled]
+            self.__filled = rest
+
+    def handle_write(self):
+        while len(self.__output) != 0:
+            data = self.__output[0]
+            try:
+                sent = self.sock.send(buffer(data, self.__output_offset))
+            except socket_error, excep:
+                if excep.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                self.handle_close()
+                return
+            self.__output_offset += sent
+            if self.__output_offset < len(data):
+                return
+            self.__output.pop(0)
+            self.__output_offset = 0
+        if self.__writing:
+            self.__writing = False
+            self.loop.update_handler(self, READ)
+
+    def handle_close(self):
+        """Closes the connection."""
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_handler(self)
+        try:
+            self.sock.close()
+        except socket_error:
+            pass
+        self.connection_closed()
@@ -0,0 +1,280 @@
+"""
+Executors used by the RPC servers to run registered functions outside of
+the thread that handles the network traffic.
+"""
+
+from __future__ import with_statement
+from client import SCFuture
+from threading import Thread, Event, currentThread
+from thread import allocate_lock
+from Queue import Queue, Empty
+from functools import partial
+from multiprocessing import Pool
+from cPickle import dumps
+import logging
+
+def invoke(function, args):
+    """
+    Calls a function in a worker process. Exceptions are returned rather
+    than raised, and so are outcomes that cannot be sent back, so the pool
+    always reports back.
+    @rtype: tuple
+    @return: A success flag and the result or the exception.
+    """
+    try:
+        outcome = True, function(*args) #IGNORE:W0142
+    except Exception, excep: #IGNORE:W0703
+        outcome = False, excep
+    try:
+        dumps(outcome, -1)
+    except Exception, excep: #IGNORE:W0703
+        outcome = False, RuntimeError('Outcome cannot be sent back from the worker process: %r' % excep)
+    return outcome
+
+class ThreadPool(object):
+    """
+    A pool of threads executing submitted functions. The pool keeps a fixed
+    number of threads running and may grow up to a maximum size while all
+    threads are busy. Threads beyond the fixed number exit again after
+    being idle for IDLE_TIMEOUT seconds.
+    """
+
+    IDLE_TIMEOUT = 30.0
+
+    class Full(Exception):
+        """Raised by submit when the maximum number of queued calls is reached."""
+        def __init__(self, msg):
+            super(ThreadPool.Full, self).__init__(msg)
+
+    def __init__(self, size, max_size=None, max_queued=None):
+        """
+        Constructor.
+        @type size: int
+        @param size: The number of worker threads kept running.
+        @type max_size: int
+        @param max_size: The maximum number of worker threads. Defaults to 
+        size, i.e. a fixed-size pool.
+        @type max_queued: int
+        @param max_queued: The maximum number of calls waiting for a thread.
+        None means no limit.
+        @raise ValueError: If a size is invalid.
+        """
+        super(ThreadPool, self).__init__()
+        if max_size == None:
+            max_size = size
+        if size < 1 or max_size < size:
+            raise ValueError('Invalid pool size (%i, %i)' % (size, max_size))
+        self.__size = size
+        self.__max_size = max_size
+        self.__max_queued = max_queued
+        self.__queue = Queue()
+        self.__lock = allocate_lock()
+        self.__threads = []
+        self.__idle = 0
+        with self.__lock:
+            for _ in range(size):
+                self.__start_thread()
+
+    def submit(self, function, *args):
+        """
+        Schedules a function call on the pool.
+        @type function: function
+        @param function: The function to call.
+        @type args: tuple
+        @param args: The arguments for the function.
+        @rtype: SCFuture
+        @return: A future holding the outcome of the call.
+        @raise ThreadPool.Full: If too many calls are queued already.
+        """
+        with self.__lock:
+            # Calls not yet picked up by an idle thread.
+            waiting = self.__queue.qsize() - self.__idle
+            if waiting >= 0 and len(self.__threads) < self.__max_size:
+                self.__start_thread()
+            elif self.__max_queued != None and waiting >= self.__max_queued:
+                raise ThreadPool.Full('Too many queued calls (%i).' % waiting)
+        future = SCFuture()
+        self.__queue.put((future, function, args))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads once the queued calls have been performed.
+        @type wait: bool
+        @param wait: Whether to wait for the worker threads to exit.
+        """
+        with self.__lock:
+            threads = list(self.__threads)
+            self.__max_size = 0
+        for _ in threads:
+            self.__queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def __start_thread(self):
+        """Starts a worker thread. Must be called with the lock held."""
+        thread = Thread(target=self.__work)
+        thread.setDaemon(True)
+        self.__threads.append(thread)
+        self.__idle += 1
+        thread.start()
+
+    def __work(self):
+        """Thread function of the worker threads."""
+        this_thread = currentThread()
+        while True:
+            # Threads beyond the fixed number only wait a while for work.
+            with self.__lock:
+                elastic = len(self.__threads) > self.__size
+            try:
+                if elastic:
+                    job = self.__queue.get(True, ThreadPool.IDLE_TIMEOUT)
+                else:
+                    job = self.__queue.get()
+            except Empty:
+                with self.__lock:
+                    if len(self.__threads) > self.__size:
+                        self.__threads.remove(this_thread)
+                        self.__idle -= 1
+                        return
+                continue
+            if job == None:
+                return
+
+            with self.__lock:
+                self.__idle -= 1
+            future, function, args = job
+            try:
+                future.set_result(function(*args)) #IGNORE:W0142
+            except Exception, excep: #IGNORE:W0703
+                logging.getLogger('SCRPC (server)').debug('Exception in pooled call.', exc_info=True)
+                future.set_exception(excep)
+            with self.__lock:
+                self.__idle += 1
+
+class BrokenProcessPool(Exception):
+    """
+    The outcome of the calls pending when a worker process died. It is 
+    defined at module level, so that it can be sent to clients.
+    """
+    def __init__(self, msg):
+        super(BrokenProcessPool, self).__init__(msg)
+
+def discard_pool(pool):
+    """
+    Stops a broken multiprocessing Pool. Pool.terminate blocks for good if
+    a dead worker process holds the lock of the task queue, so it is left
+    to a thread of its own and the worker processes are stopped right away.
+    @type pool: Pool
+    """
+    terminator = Thread(target=pool.terminate)
+    terminator.setDaemon(True)
+    terminator.start()
+    for process in pool._pool: #IGNORE:W0212
+        if process.exitcode == None:
+            process.terminate()
+
+class ProcessPool(object):
+    """
+    A pool of worker processes executing submitted functions. Functions 
+    and their arguments and results must be picklable, so only module level
+    functions can be submitted.
+
+    The calls sent to a worker process that dies (e.g. is killed) would 
+    never finish. The pool is checked every WATCH_INTERVAL seconds. Once a
+    worker process has died the pool is broken: its pending calls fail with
+    ProcessPool.Broken and a new pool takes over. An idle worker process
+    may die holding the lock of the task queue, so a pool whose worker has
+    died is replaced even if no call is pending.
+    """
+
+    WATCH_INTERVAL = 0.5
+
+    Broken = BrokenProcessPool
+
+    def __init__(self, size=None):
+        """
+        Constructor.
+        @type size: int
+        @param size: The number of worker processes. None means one per CPU.
+        """
+        super(ProcessPool, self).__init__()
+        self.__size = size
+        self.__lock = allocate_lock()
+        # The futures of the pending calls, indexed by call number.
+        self.__pending = {}
+        self.__calls = 0
+        self.__closed = Event()
+        with self.__lock:
+            self.__start_pool()
+        watchdog = Thread(target=self.__watch)
+        watchdog.setDaemon(True)
+        watchdog.start()
+
+    def submit(self, function, *args):
+        """
+        Schedules a function call on the pool.
+        @see: ThreadPool.submit
+        """
+        future = SCFuture()
+        with self.__lock:
+            self.__calls += 1
+            number = self.__calls
+            self.__pending[number] = future
+            self.__pool.apply_async(invoke, (function, args), callback=partial(self.__done, number))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker processes.
+        @type wait: bool
+        @param wait: Whether to let the queued calls finish first.
+        """
+        self.__closed.set()
+        if wait:
+            self.__pool.close()
+            self.__pool.join()
+        else:
+            # A worker process may have died since the pool was checked.
+            discard_pool(self.__pool)
+
+    def __start_pool(self):
+        """Starts the worker processes. Must be called with the lock held."""
+        self.__pool = Pool(self.__size)
+        # Pool replaces worker processes that die, so a change of the 
+        # process ids tells that one has died.
+        self.__pids = self.__worker_pids()
+
+    def __worker_pids(self):
+        # Pool has no public way to list its worker processes.
+        return set([process.pid for process in self.__pool._pool]) #IGNORE:W0212
+
+    def __watch(self):
+        """Thread function checking that the worker processes are alive."""
+        while not self.__closed.wait(ProcessPool.WATCH_INTERVAL):
+            with self.__lock:
+                if self.__closed.isSet() or self.__worker_pids() == self.__pids:
+                    continue
+                pending, self.__pending = self.__pending, {}
+                broken = self.__pool
+                self.__start_pool()
+            logging.getLogger('SCRPC (server)').warning('A worker process died, restarting the process pool.')
+            discard_pool(broken)
+            # Calls submitted since the pool was last checked fail as well,
+            # though the worker may have died before they were.
+            for future in pending.itervalues():
+                future.set_exception(ProcessPool.Broken('A worker process died while performing the call.'))
+
+    def __done(self, number, outcome):
+        """Called in the result handler thread of the pool."""
+        with self.__lock:
+            future = self.__pending.pop(number, None)
+        if future == None:
+            # The call failed when the pool broke.
+            return
+        success, value = outcome
+        if success:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
@@ -0,0 +1,235 @@
+"""
+Metrics of SCRPC servers and SCProxy clients: per-function counters of
+calls, errors and bytes, latency histograms and a gauge of the open
+connections. Metrics are off unless a Metrics object is passed to the
+server or proxy, in which case the hot paths only compare it with None.
+
+The latencies are recorded in four histograms per function:
+
+    queue       the time a call waited for a thread to perform it (server)
+    serialize   the time spent marshalling and unmarshalling
+    execute     the time spent in the function (server)
+    network     the time spent sending the reply (server), or the time
+                from sending the call to receiving the reply (client)
+
+Servers serve their metrics to clients as the reserved function
+METRICS_FUNCTION, either as a snapshot dict or in the Prometheus text
+format.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from bisect import bisect_left
+from protocol import EXCEPTION, NACK
+
+# The upper bounds (in seconds) of the buckets of the latency histograms.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The names of the latency histograms.
+TIMINGS = ('queue', 'serialize', 'execute', 'network')
+
+# The reserved function name under which servers serve their metrics.
+METRICS_FUNCTION = '__scrpc_metrics__'
+
+class Histogram(object):
+    """A histogram with fixed buckets, like those of Prometheus."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """
+        @rtype: dict
+        @return: The cumulative 'buckets' as (upper bound, count) pairs, the
+        'sum' of the values and their 'count'.
+        """
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+class FunctionMetrics(object):
+    """The counters and histograms of one function."""
+
+    def __init__(self):
+        super(FunctionMetrics, self).__init__()
+        self.calls = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.timings = dict([(name, Histogram()) for name in TIMINGS])
+
+    def snapshot(self):
+        return {'calls': self.calls, 'errors': self.errors, 'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'seconds': dict([(name, histogram.snapshot())
+                                 for name, histogram in self.timings.iteritems()])}
+
+class CallRecord(object):
+    """The measurements of one call, taken while it is performed."""
+
+    def __init__(self, function_name, bytes_in=0):
+        super(CallRecord, self).__init__()
+        self.function_name = function_name
+        # The verb of the reply.
+        self.verb = None
+        self.timings = {}
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+
+    def add_time(self, name, seconds):
+        """Adds to one of the latencies (see TIMINGS) of the call."""
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+class MetricsHook(object):
+    """
+    Base class of the objects notified of everything recorded by a Metrics
+    object, e.g. to forward it to a monitoring system. Hooks are called
+    from the threads performing the calls and must not block.
+    """
+
+    def call_finished(self, record):
+        """
+        Called for every call recorded.
+        @type record: CallRecord
+        @param record: The measurements of the call.
+        """
+        pass
+
+    def connection_opened(self):
+        pass
+
+    def connection_closed(self):
+        pass
+
+class Metrics(object):
+    """
+    The metrics of one or more servers or proxies. All methods are
+    thread-safe.
+    """
+
+    def __init__(self, prefix='scrpc', hooks=()):
+        """
+        Constructor.
+        @type prefix: str
+        @param prefix: The prefix of the metric names in the Prometheus text
+        format.
+        @type hooks: list
+        @param hooks: MetricsHook objects to notify.
+        """
+        super(Metrics, self).__init__()
+        self.prefix = prefix
+        self.__hooks = list(hooks)
+        self.__functions = {}
+        self.__connections = 0
+        self.__lock = allocate_lock()
+
+    def add_hook(self, hook):
+        """Adds a MetricsHook to notify."""
+        with self.__lock:
+            self.__hooks = self.__hooks + [hook]
+
+    def record_call(self, record):
+        """
+        Records a finished call. Calls answered with EXCEPTION or NACK, or
+        not answered at all, count as errors.
+        @type record: CallRecord
+        @param record: The measurements of the call.
+        """
+        with self.__lock:
+            function = self.__functions.get(record.function_name)
+            if function == None:
+                function = self.__functions[record.function_name] = FunctionMetrics()
+            function.calls += 1
+            if record.verb in (EXCEPTION, NACK, None):
+                function.errors += 1
+            function.bytes_in += record.bytes_in
+            function.bytes_out += record.bytes_out
+            for name, seconds in record.timings.iteritems():
+                function.timings[name].observe(seconds)
+            hooks = self.__hooks
+        for hook in hooks:
+            hook.call_finished(record)
+
+    def connection_opened(self):
+        with self.__lock:
+            self.__connections += 1
+            hooks = self.__hooks
+        for hook in hooks:
+            hook.connection_opened()
+
+    def connection_closed(self):
+        with self.__lock:
+            self.__connections -= 1
+            hooks = self.__hooks
+        for hook in hooks:
+            hook.connection_closed()
+
+    def reset(self):
+        """Clears the counters and histograms. The gauges are kept."""
+        with self.__lock:
+            self.__functions = {}
+
+    def snapshot(self):
+        """
+        @rtype: dict
+        @return: The number of open 'connections' and the 'functions' dict
+        holding the counters ('calls', 'errors', 'bytes_in', 'bytes_out')
+        and the histograms ('seconds', see Histogram.snapshot) of each
+        function by name.
+        """
+        with self.__lock:
+            return {'connections': self.__connections,
+                    'functions': dict([(name, function.snapshot())
+                                       for name, function in self.__functions.iteritems()])}
+
+    def prometheus(self):
+        """
+        Formats the metrics in the Prometheus text exposition format.
+        @rtype: str
+        """
+        snapshot = self.snapshot()
+        functions = sorted(snapshot['functions'].items())
+        lines = []
+        def metric(name, kind, description):
+            lines.append('# HELP %s_%s %s' % (self.prefix, name, description))
+            lines.append('# TYPE %s_%s %s' % (self.prefix, name, kind))
+
+        metric('connections', 'gauge', 'Open connections.')
+        lines.append('%s_connections %i' % (self.prefix, snapshot['connections']))
+        for key, name, description in (('calls', 'calls_total', 'Calls performed.'),
+                                       ('errors', 'errors_total', 'Calls that failed.'),
+                                       ('bytes_in', 'received_bytes_total', 'Bytes received.'),
+                                       ('bytes_out', 'sent_bytes_total', 'Bytes sent.')):
+            metric(name, 'counter', description)
+            for function_name, function in functions:
+                lines.append('%s_%s{function="%s"} %i' % (self.prefix, name, _escape(function_name),
+                                                          function[key]))
+        for timing in TIMINGS:
+            name = '%s_%s_seconds' % (self.prefix, timing)
+            metric('%s_seconds' % timing, 'histogram', 'Latency of the %s phase of calls.' % timing)
+            for function_name, function in functions:
+                histogram = function['seconds'][timing]
+                label = 'function="%s"' % _escape(function_name)
+                for bound, count in histogram['buckets']:
+                    lines.append('%s_bucket{%s,le="%r"} %i' % (name, label, bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %i' % (name, label, histogram['count']))
+                lines.append('%s_sum{%s} %r' % (name, label, histogram['sum']))
+                lines.append('%s_count{%s} %i' % (name, label, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    """Escapes a Prometheus label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,410 @@
+"""
+A pool of SCProxy connections shared by the threads of a client. The pool
+keeps connections to one or more servers open, spreads calls across the
+servers and reconnects or closes connections in the background.
+"""
+
+from __future__ import with_statement
+from client import SCProxy, SCUpload
+from cache import ResultCache
+from cancellation import call_deadline
+from protocol import PROTOCOL_VERSION
+from serializers import check_serializers
+from compression import check_codecs
+from threading import Thread, Event
+from thread import allocate_lock
+from functools import partial
+import logging
+import time
+
+class SCPooledConnection(object):
+    """A connection of an SCProxyPool and its bookkeeping."""
+
+    def __init__(self, address, proxy):
+        super(SCPooledConnection, self).__init__()
+        self.address = address
+        self.proxy = proxy
+        # The number of calls in progress on the connection.
+        self.outstanding = 0
+        self.last_used = time.time()
+
+class SCProxyPool(object):
+    """
+    A thread-safe pool of connections to one or more SCRPC servers. It is
+    used like an SCProxy. Each call is made on an idle connection to the
+    server picked by the balancing policy, and a new connection is opened
+    if there is none (up to size connections per server).
+
+    Calls shed by an overloaded server are retried on the other servers,
+    which are preferred for OVERLOAD_BACKOFF seconds. Servers that cannot
+    be reached are left out until a health check finds them up again.
+    Health checks run every HEALTH_CHECK_INTERVAL seconds. They also
+    reconnect broken connections and close connections that have been
+    idle for max_idle_time seconds, keeping min_size per server.
+    """
+
+    HEALTH_CHECK_INTERVAL = 10.0
+    OVERLOAD_BACKOFF = 1.0
+    MAX_IDLE_TIME = 60.0
+    BALANCING = ('round-robin', 'least-outstanding')
+
+    def __init__(self, addresses, size=4, min_size=1, balancing='least-outstanding',
+                 max_idle_time=MAX_IDLE_TIME, protocol=PROTOCOL_VERSION, serializers=('pickle', ),
+                 compression=None, metrics=None, cache=None, shared_memory=None):
+        """
+        Constructor.
+        @type addresses: list
+        @param addresses: The addresses of the servers.
+        @type size: int
+        @param size: The maximum number of connections per server. Calls
+        share connections once all of them are busy.
+        @type min_size: int
+        @param min_size: The number of connections per server kept open.
+        @type balancing: str
+        @param balancing: 'round-robin' takes turns among the servers.
+        'least-outstanding' picks the server with the fewest calls in
+        progress.
+        @type max_idle_time: float
+        @param max_idle_time: The number of seconds after which idle
+        connections beyond min_size are closed.
+        @type metrics: Metrics
+        @param metrics: The metrics shared by all connections of the pool.
+        @param cache: The cache shared by all connections of the pool, or
+        True for a ResultCache of its own. The servers must serve the same
+        functions, and each of them invalidates the results it has changed.
+        @see: SCProxy.__init__
+        @raise ValueError: If a size, the balancing policy, a serializer or
+        a codec is invalid.
+        """
+        super(SCProxyPool, self).__init__()
+        if len(addresses) == 0:
+            raise ValueError('No server addresses given')
+        if size < 1 or min_size < 0 or min_size > size:
+            raise ValueError('Invalid pool size (%i, %i)' % (min_size, size))
+        if balancing not in SCProxyPool.BALANCING:
+            raise ValueError('Unknown balancing policy (%s)' % balancing)
+        self.__addresses = list(addresses)
+        self.__size = size
+        self.__min_size = min_size
+        self.__balancing = balancing
+        self.__max_idle_time = max_idle_time
+        self.__options = {'protocol': protocol, 'serializers': check_serializers(serializers)}
+        if compression != None:
+            self.__options['compression'] = check_codecs(compression)
+        if metrics != None:
+            self.__options['metrics'] = metrics
+        if cache == True:
+            cache = ResultCache()
+        if cache != None:
+            self.__options['cache'] = cache
+        if shared_memory != None:
+            self.__options['shared_memory'] = shared_memory
+        self.__lock = allocate_lock()
+
+        # The connections, the number of connections being opened and the
+        # time the server was found down, indexed by address.
+        self.__connections = dict([(address, []) for address in self.__addresses])
+        self.__opening = dict([(address, 0) for address in self.__addresses])
+        self.__down = {}
+        # The time until which overloaded servers are avoided, indexed by
+        # address.
+        self.__overloaded = {}
+        self.__next = 0
+        self.__closed = Event()
+
+        self.__fill()
+        checker = Thread(target=self.__check_health)
+        checker.setDaemon(True)
+        checker.start()
+
+    def __getattr__(self, attrname):
+        """
+        Forwards any unknown attribute requests to the make_rpc_call method.
+        @see: SCProxy.__getattr__
+        """
+        if attrname == '':
+            return self
+        stub = partial(self.make_rpc_call, attrname)
+        self.__dict__[attrname] = stub
+        return stub
+
+    def make_rpc_call(self, function_name, *function_input, **options):
+        """
+        Performs a remote procedure call on a pooled connection. A call shed
+        by an overloaded server is retried on each of the other servers, 
+        unless it has uploads, which cannot be sent twice.
+        @see: SCProxy.make_rpc_call
+        @raise SCProxy.Overloaded: If every server has shed the call.
+        """
+        # The retries share the deadline of the call.
+        deadline = call_deadline(options)
+        retry = not [argument for argument in function_input if isinstance(argument, SCUpload)]
+        tried = set()
+        while True:
+            connection = self.__acquire(tried)
+            try:
+                return connection.proxy.make_rpc_call(function_name, *function_input, #IGNORE:W0142
+                                                      deadline=deadline)
+            except SCProxy.Overloaded:
+                self.__mark_overloaded(connection.address)
+                tried.add(connection.address)
+                if not retry or len(tried) == len(self.__addresses):
+                    raise
+            finally:
+                self.__release(connection)
+
+    def call_async(self, function_name, *function_input, **options):
+        """
+        Starts a remote procedure call on a pooled connection. Calls shed by
+        an overloaded server are not retried.
+        @see: SCProxy.call_async
+        @rtype: SCFuture
+        """
+        connection = self.__acquire()
+        try:
+            future = connection.proxy.call_async(function_name, *function_input, **options) #IGNORE:W0142
+        except:
+            self.__release(connection)
+            raise
+        future.add_done_callback(lambda future: self.__release(connection))
+        return future
+
+    def stats(self):
+        """
+        Describes the state of the pool.
+        @rtype: dict
+        @return: A dict per address with the number of 'connections', the
+        number of calls in progress ('outstanding') and whether the server
+        is 'down' or avoided because it is 'overloaded'.
+        """
+        now = time.time()
+        with self.__lock:
+            return dict([(address, {'connections': len(connections),
+                                    'outstanding': sum([c.outstanding for c in connections]),
+                                    'down': self.__down.has_key(address),
+                                    'overloaded': self.__overloaded.get(address, 0) > now})
+                         for address, connections in self.__connections.iteritems()])
+
+    def close(self):
+        """Closes all connections and stops the health checks."""
+        self.__closed.set()
+        with self.__lock:
+            connections = []
+            for address in self.__addresses:
+                connections.extend(self.__connections[address])
+                self.__connections[address] = []
+        for connection in connections:
+            self.__close_proxy(connection.proxy)
+
+    def __acquire(self, excluded=()):
+        """
+        Picks the connection for a call, connecting if necessary.
+        @type excluded: set
+        @param excluded: The servers not to pick.
+        @rtype: SCPooledConnection
+        @raise SCProxy.CommunicationError: If no server can be reached.
+        """
+        tried = set(excluded)
+        while True:
+            with self.__lock:
+                if self.__closed.isSet():
+                    raise SCProxy.CommunicationError('Connection pool has been closed.')
+                address = self.__pick_address(tried)
+                if address == None:
+                    raise SCProxy.CommunicationError('No RPC server available.')
+                connection = self.__pick_connection(address)
+                if connection == None:
+                    self.__opening[address] += 1
+                else:
+                    connection.outstanding += 1
+
+            if connection == None:
+                connection = self.__open(address, 1)
+                if connection != None:
+                    return connection
+            else:
+                try:
+                    if not connection.proxy.is_connected():
+                        connection.proxy.connect()
+                    return connection
+                except SCProxy.CommunicationError:
+                    logging.getLogger("SMRPC-Client").info('Pooled connection to %s lost.' % (address, ),
+                                                           exc_info=True)
+                    self.__release(connection)
+                    self.__remove(connection)
+                    self.__mark_down(address)
+            tried.add(address)
+
+    def __release(self, connection):
+        with self.__lock:
+            connection.outstanding -= 1
+            connection.last_used = time.time()
+
+    def __pick_address(self, tried):
+        """
+        Picks the server for a call. Must be called with the lock held.
+        @type tried: set
+        @param tried: The servers that could not be reached for this call.
+        @return: The address of the server or None if all have been tried.
+        Servers that are down are only picked if all others have been tried,
+        and overloaded servers if all others are down.
+        """
+        candidates = [a for a in self.__addresses if a not in tried and not self.__down.has_key(a)]
+        if len(self.__overloaded) != 0:
+            now = time.time()
+            available = [a for a in candidates if self.__overloaded.get(a, 0) <= now]
+            if len(available) != 0:
+                candidates = available
+        if len(candidates) == 0:
+            candidates = [a for a in self.__addresses if a not in tried]
+            if len(candidates) == 0:
+                return None
+        if self.__balancing == 'round-robin':
+            for i in range(len(self.__addresses)):
+                index = (self.__next + i) % len(self.__addresses)
+                if self.__addresses[index] in candidates:
+                    self.__next = index + 1
+                    return self.__addresses[index]
+        outstanding = lambda address: sum([c.outstanding for c in self.__connections[address]])
+        return min(candidates, key=outstanding)
+
+    def __pick_connection(self, address):
+        """
+        Picks the connection to a server for a call. Must be called with the
+        lock held.
+        @return: The least busy connection, or None if it is busy and
+        another connection may be opened.
+        """
+        connections = self.__connections[address]
+        if len(connections) == 0:
+            connection = None
+        else:
+            connection = min(connections, key=lambda c: c.outstanding)
+        if (connection == None or connection.outstanding > 0) and \
+           len(connections) + self.__opening[address] < self.__size:
+            return None
+        return connection
+
+    def __open(self, address, outstanding=0):
+        """
+        Opens a new connection to a server. Must be called after counting
+        it in __opening.
+        @type outstanding: int
+        @param outstanding: The number of calls the connection is opened for.
+        @rtype: SCPooledConnection
+        @return: The connection, which has been added to the pool, or None
+        if the server cannot be reached or the pool has been closed.
+        """
+        try:
+            proxy = SCProxy(address, **self.__options) #IGNORE:W0142
+        except SCProxy.CommunicationError:
+            logging.getLogger("SMRPC-Client").info('Error connecting to %s.' % (address, ), exc_info=True)
+            with self.__lock:
+                self.__opening[address] -= 1
+            self.__mark_down(address)
+            return None
+        connection = SCPooledConnection(address, proxy)
+        connection.outstanding = outstanding
+        with self.__lock:
+            self.__opening[address] -= 1
+            self.__down.pop(address, None)
+            self.__connections[address].append(connection)
+            closed = self.__closed.isSet()
+        if closed:
+            self.__remove(connection)
+            return None
+        return connection
+
+    def __remove(self, connection):
+        """Removes a connection from the pool and closes it."""
+        with self.__lock:
+            try:
+                self.__connections[connection.address].remove(connection)
+            except ValueError:
+                return
+        self.__close_proxy(connection.proxy)
+
+    def __close_proxy(self, proxy):
+        try:
+            proxy.close()
+        except SCProxy.CommunicationError:
+            pass
+
+    def __mark_down(self, address):
+        with self.__lock:
+            if not self.__down.has_key(address):
+                logging.getLogger("SMRPC-Client").warning('RPC server %s is down.' % (address, ))
+                self.__down[address] = time.time()
+
+    def __mark_overloaded(self, address):
+        with self.__lock:
+            logging.getLogger("SMRPC-Client").info('RPC server %s is overloaded.' % (address, ))
+            self.__overloaded[address] = time.time() + SCProxyPool.OVERLOAD_BACKOFF
+
+    def __fill(self):
+        """Opens connections until each server that is up has min_size."""
+        for address in self.__addresses:
+            while True:
+                with self.__lock:
+                    if self.__closed.isSet() or self.__down.has_key(address) or \
+                       len(self.__connections[address]) + self.__opening[address] >= self.__min_size:
+                        break
+                    self.__opening[address] += 1
+                if self.__open(address) == None:
+                    break
+
+    def __check_health(self):
+        """
+        Thread function closing idle connections, reconnecting broken ones
+        and looking for servers that are up again.
+        """
+        while not self.__closed.isSet():
+            self.__closed.wait(SCProxyPool.HEALTH_CHECK_INTERVAL)
+            if self.__closed.isSet():
+                return
+            try:
+                self.__evict_idle()
+                self.__reconnect_broken()
+                with self.__lock:
+                    self.__down.clear()
+                    now = time.time()
+                    for address, until in self.__overloaded.items():
+                        if until <= now:
+                            del self.__overloaded[address]
+                self.__fill()
+            except:
+                logging.getLogger("SMRPC-Client").warning('Unhandled exception in health check.',
+                                                          exc_info=True)
+
+    def __evict_idle(self):
+        """Closes connections that have been idle for too long."""
+        evicted = []
+        now = time.time()
+        with self.__lock:
+            for connections in self.__connections.itervalues():
+                keep = self.__min_size
+                for connection in sorted(connections, key=lambda c: c.last_used, reverse=True):
+                    if connection.outstanding == 0 and keep <= 0 and \
+                       now - connection.last_used > self.__max_idle_time:
+                        evicted.append(connection)
+                    keep -= 1
+            # The connections leave the pool before the lock is released, so
+            # they cannot be picked for a call while they are closed.
+            for connection in evicted:
+                self.__connections[connection.address].remove(connection)
+        for connection in evicted:
+            self.__close_proxy(connection.proxy)
+
+    def __reconnect_broken(self):
+        """Reconnects idle connections that have lost their server."""
+        with self.__lock:
+            broken = []
+            for connections in self.__connections.itervalues():
+                for connection in connections:
+                    if connection.outstanding == 0 and not connection.proxy.is_connected():
+                        broken.append(connection)
+        for connection in broken:
+            try:
+                connection.proxy.connect()
+            except SCProxy.CommunicationError:
+                self.__remove(connection)
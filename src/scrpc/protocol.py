@@ -0,0 +1,362 @@
+"""
+Wire protocol definitions shared by the SCRPC server and the SCProxy client.
+
+Protocol version 1 is the original four message handshake:
+
+    client: PERFORM <name>          server: ACK | NACK <msg>
+    client: <marshalled input>      server: ACK | NACK <msg> | EXCEPTION <exc>
+                                    server: RESULT <res> | EXCEPTION <exc>
+
+Protocol version 2 sends the function name and its input in one frame and
+gets exactly one frame back:
+
+    client: CALL <id> <name>\\n<marshalled input>
+    server: RESULT <id>\\n<res> | EXCEPTION <id>\\n<exc> | NACK <id>\\n<msg>
+
+Protocol version 3 adds streamed results. A generator function is answered
+with a sequence of frames, and the client controls how fast they come:
+
+    server: STREAM <id>\n
+    server: CHUNK <id>\n<items> (any number of times)
+    server: END <id>\n | EXCEPTION <id>\n<exc>
+    client: MORE <id> <count>\n (grants count more chunks)
+    client: STOP <id>\n (ends the stream early)
+
+Version 1 and 2 clients get the items of a generator function as a list.
+
+Protocol version 4 adds streamed arguments (uploads). The client announces
+the positions of the streamed arguments before the CALL frame, passes None
+in their place, and then sends their items in chunks. Each upload is 
+identified by <id>.<position>, and the server grants chunks like the
+client does for streamed results:
+
+    client: UPLOAD <id> <position>,<position>...\n
+    client: CALL <id> <name>\n<marshalled input>
+    client: DATA <id>.<position>\n<items> (any number of times)
+    client: EOF <id>.<position>\n[<exc>]
+    server: MORE <id>.<position> <count>\n
+    server: STOP <id>.<position>\n (the call is over before EOF)
+
+Protocol version 5 adds batches of calls, which are sent in one frame and
+answered in one frame:
+
+    client: BATCH <id> sequential|parallel\n<marshalled list of calls>
+    server: RESULT <id>\n<outcomes> | NACK <id>\n<msg>
+
+Each call is a pair of the function name and its argument tuple. The 
+outcomes are a list of (verb, payload) pairs, one per call in the order of
+the calls, where verb and payload are those of the frame that would have
+answered the call on its own (RESULT, EXCEPTION or NACK). Sequential 
+batches are performed in order, parallel ones concurrently.
+
+Protocol version 6 lets clients cache results. A client that keeps a
+cache offers cache=1 during negotiation, and a server that agrees answers
+with cache=1. The server then flags the RESULT frames of the functions it
+caches itself with FLAG_CACHEABLE, and pushes an INVALIDATE frame whenever
+such results have become stale:
+
+    server: INVALIDATE <name>\n[<marshalled argument tuple>]
+    server: INVALIDATE \n (all results are stale)
+
+Without arguments all results of the function are stale.
+
+Protocol version 7 passes large payloads between a client and a server on
+the same host through shared memory. A client offers shm=<threshold> 
+during negotiation, along with shmprobe=<file name>, an empty file it has
+created in SHARED_MEMORY_DIR. A server that can open and remove the file,
+and runs as the user owning it, answers with shm=1; otherwise payloads are
+sent over the connection as usual. Payloads of at least threshold bytes are then written to a
+file in SHARED_MEMORY_DIR, and the frame (flagged FLAG_SHARED) carries
+only the name and the size of the file:
+
+    client: CALL+s <id> <name>\n<file name> <size>
+    server: RESULT+s <id>\n<file name> <size>
+
+The receiver maps the file and removes it. Files that never reach the 
+receiver are removed by the sender when the connection is closed.
+
+Protocol version 8 adds deadlines and cancellation. A call flagged with
+FLAG_DEADLINE carries the number of seconds the client is willing to wait
+for it, which the server counts from the arrival of the frame. A client
+that gives up on a call cancels it:
+
+    client: CALL+d <id> <seconds> <name>\n<marshalled input>
+    client: CANCEL <id>\n
+
+Calls that have expired or have been cancelled before they are performed
+are answered with NACK <id>\n<DEADLINE_EXCEEDED or CALL_CANCELLED>. A call
+in progress is told through its cancellation token (see cancellation), and
+is answered as usual. The client drops replies to cancelled calls.
+
+Protocol version 9 lets clients call functions by number instead of by
+name. A client offers ids=1 during negotiation, and a server that agrees
+answers with ids=1 and follows its HELLO frame with a FUNCTIONS frame 
+numbering the functions registered so far. Functions registered later are
+announced with further FUNCTIONS frames. A call flagged with FLAG_NUMBERED
+carries the number of the function in place of its name:
+
+    server: FUNCTIONS \n<number> <name>\n<number> <name>...
+    client: CALL+n <id> <number>\n<marshalled input>
+
+Numbers are never reused for another function while the server runs.
+
+Protocol version 10 lets servers push values to clients. A client offers
+push=1 during negotiation, and a server that agrees answers with push=1.
+The client may then subscribe to topics, and the server pushes the values
+published on them (see pubsub), starting with the latest one:
+
+    client: SUBSCRIBE <topic>\n
+    client: UNSUBSCRIBE <topic>\n
+    server: PUBLISH <topic>\n<marshalled value>
+
+Topics may contain spaces, but not newlines.
+
+A server that sheds load answers calls it has not performed with a NACK
+whose message starts with SERVER_OVERLOADED, in any protocol version. The
+call has had no effect, so the client may retry it on another server.
+
+The verb of a version 2 frame may be followed by flags, separated by a
+'+'. FLAG_COMPRESSED means that the payload has been compressed with the
+codec negotiated for the connection. FLAG_CACHEABLE marks results that a
+client may cache. FLAG_SHARED marks payloads passed in shared memory; a
+payload may be compressed before it is shared. FLAG_DEADLINE marks calls 
+with a deadline, and FLAG_NUMBERED calls by function number.
+
+The protocol version is negotiated right after connecting. The client
+performs a version 1 call of the reserved function HELLO_FUNCTION. A
+version 1 server answers with a NACK (unknown function), in which case the
+client falls back to version 1. Newer servers answer with a HELLO frame
+holding the agreed protocol version.
+
+Negotiation frames may carry options as key=value fields after the
+version. The client offers the serializers it accepts, in order of
+preference, as serializers=<name>,<name>,... and the server names the one
+chosen for the connection as serializer=<name>. Compression codecs are
+negotiated the same way with compression=<name>,... in the request and 
+compression=<name> in the reply. Servers ignore options they do not know.
+"""
+
+from cPickle import load
+from cStringIO import StringIO
+
+# The newest protocol version spoken by this implementation.
+PROTOCOL_VERSION = 10
+
+# The reserved function name used for protocol negotiation.
+HELLO_FUNCTION = '__scrpc_hello__'
+
+# Frame verbs.
+PERFORM = 'PERFORM'
+HELLO = 'HELLO'
+CALL = 'CALL'
+RESULT = 'RESULT'
+EXCEPTION = 'EXCEPTION'
+ACK = 'ACK'
+NACK = 'NACK'
+STREAM = 'STREAM'
+CHUNK = 'CHUNK'
+END = 'END'
+MORE = 'MORE'
+STOP = 'STOP'
+UPLOAD = 'UPLOAD'
+DATA = 'DATA'
+EOF = 'EOF'
+BATCH = 'BATCH'
+INVALIDATE = 'INVALIDATE'
+CANCEL = 'CANCEL'
+FUNCTIONS = 'FUNCTIONS'
+SUBSCRIBE = 'SUBSCRIBE'
+UNSUBSCRIBE = 'UNSUBSCRIBE'
+PUBLISH = 'PUBLISH'
+
+# Frame flags.
+FLAG_COMPRESSED = 'z'
+FLAG_CACHEABLE = 'c'
+FLAG_SHARED = 's'
+FLAG_DEADLINE = 'd'
+FLAG_NUMBERED = 'n'
+
+# Prefix of the NACK messages sent when a server refuses work because one of
+# its limits has been reached.
+SERVER_BUSY = 'Server busy'
+
+# Prefix of the NACK messages sent instead of performing calls when a server
+# sheds load.
+SERVER_OVERLOADED = 'Server overloaded'
+
+# Message of the NACK sent when client and server share no serializer.
+NO_COMMON_SERIALIZER = 'No common serializer'
+
+# Messages of the NACKs sent instead of performing calls that are no longer
+# wanted.
+DEADLINE_EXCEEDED = 'Deadline exceeded'
+CALL_CANCELLED = 'Call cancelled'
+
+class ProtocolError(Exception):
+    """Raised when a malformed frame is received."""
+    def __init__(self, msg):
+        super(ProtocolError, self).__init__(msg)
+
+def format_options(options):
+    """Formats negotiation options as key=value fields."""
+    if not options:
+        return ''
+    return ''.join([' %s=%s' % item for item in sorted(options.items())])
+
+def hello_request(version=PROTOCOL_VERSION, options=None):
+    """
+    Builds the negotiation request sent by the client.
+    @type version: int
+    @param version: The highest protocol version supported by the client.
+    @type options: dict
+    @param options: Negotiation options, e.g. the serializers offered.
+    @rtype: str
+    """
+    return '%s %s %i%s' % (PERFORM, HELLO_FUNCTION, version, format_options(options))
+
+def hello_reply(version, options=None):
+    """
+    Builds the negotiation reply sent by the server.
+    @type version: int
+    @param version: The protocol version agreed upon.
+    @type options: dict
+    @param options: Negotiation options, e.g. the serializer chosen.
+    @rtype: str
+    """
+    return '%s %i%s' % (HELLO, version, format_options(options))
+
+def parse_hello(fields):
+    """
+    Parses the fields of a negotiation request or reply.
+    @type fields: list
+    @param fields: The space separated fields following the verb and (in the
+    case of a request) the reserved function name.
+    @rtype: tuple
+    @return: The protocol version and a dict of the options contained in 
+    the fields.
+    @raise ProtocolError: If the fields are malformed.
+    """
+    try:
+        version = int(fields[0])
+    except (IndexError, ValueError):
+        raise ProtocolError('Invalid negotiation frame.')
+    options = {}
+    for field in fields[1:]:
+        key, sep, value = field.partition('=')
+        if sep != '':
+            options[key] = value
+    return version, options
+
+def upload_id(call_id, position):
+    """Builds the id of an upload from its call id and argument position."""
+    return '%s.%i' % (call_id, position)
+
+def split_deadline(flags, field):
+    """
+    Splits the seconds of a call flagged with FLAG_DEADLINE off the last
+    header field of its CALL frame.
+    @type flags: str
+    @param flags: The frame flags.
+    @type field: str
+    @param field: The last header field.
+    @rtype: tuple
+    @return: The seconds the client waits for the call (None if the call 
+    has no deadline) and the function name.
+    @raise ValueError: If the seconds are missing or invalid.
+    """
+    if FLAG_DEADLINE not in flags:
+        return None, field
+    seconds, function_name = field.split(' ', 1)
+    return float(seconds), function_name
+
+def pack_functions(functions):
+    """
+    Builds a FUNCTIONS frame.
+    @type functions: list
+    @param functions: The numbers and names of the functions.
+    @rtype: tuple
+    """
+    return pack_frame(FUNCTIONS, ('', ), ''.join(['%i %s\n' % function for function in functions]))
+
+def parse_functions(payload):
+    """
+    Parses the payload of a FUNCTIONS frame.
+    @rtype: dict
+    @return: The numbers of the functions indexed by name.
+    @raise ProtocolError: If the payload is malformed.
+    """
+    functions = {}
+    try:
+        for line in str(payload).splitlines():
+            number, function_name = line.split(' ', 1)
+            functions[function_name] = int(number)
+    except ValueError:
+        raise ProtocolError('Invalid function table.')
+    return functions
+
+def busy_message(reason):
+    """
+    Builds the message of a NACK refusing work.
+    @type reason: str
+    @param reason: Which limit has been reached.
+    @rtype: str
+    """
+    return '%s: %s.' % (SERVER_BUSY, reason)
+
+def overloaded_message(reason):
+    """
+    Builds the message of a NACK shedding a call.
+    @type reason: str
+    @param reason: Which limit has been reached.
+    @rtype: str
+    """
+    return '%s: %s.' % (SERVER_OVERLOADED, reason)
+
+def unmarshal(data):
+    """
+    Unpickles data held in a str, a buffer or a bytearray without copying it.
+    @raise UnpicklingError: If the data cannot be unpickled.
+    """
+    return load(StringIO(data))
+
+def pack_frame(verb, fields, payload='', flags=''):
+    """
+    Builds a version 2 frame. The frame is returned as a header and the 
+    payload parts, which TimedSocket.send_lp sends without joining them.
+    @type verb: str
+    @param verb: The frame verb, e.g. CALL or RESULT.
+    @type fields: tuple
+    @param fields: Header fields. These must not contain newlines, and only the
+    last field may contain spaces.
+    @type payload: str or tuple
+    @param payload: The frame payload or the parts of it.
+    @type flags: str
+    @param flags: The frame flags, e.g. FLAG_COMPRESSED.
+    @rtype: tuple
+    """
+    if flags != '':
+        verb = '%s+%s' % (verb, flags)
+    header = '%s %s\n' % (verb, ' '.join([str(f) for f in fields]))
+    if isinstance(payload, tuple):
+        return (header, ) + payload
+    return header, payload
+
+def parse_frame(frame, maxsplit=-1):
+    """
+    Splits a version 2 frame into its parts.
+    @type frame: str or bytearray
+    @param frame: The frame received from the peer.
+    @type maxsplit: int
+    @param maxsplit: The maximal number of header fields to split off. The
+    last field holds the remainder of the header.
+    @rtype: tuple
+    @return: The verb, the frame flags, the list of header fields and the
+    payload. The payload is a buffer referring to the memory of the frame.
+    @raise ProtocolError: If the frame has no header.
+    """
+    header_end = frame.find('\n')
+    if header_end == -1:
+        raise ProtocolError('Frame header is missing.')
+    header = str(frame[:header_end]).split(' ', maxsplit)
+    verb, _, flags = header[0].partition('+')
+    return verb, flags, header[1:], buffer(frame, header_end+1)
@@ -0,0 +1,101 @@
+"""
+Support for pushing published values to subscribers. A server publishes
+values on topics, and pushes each value to the connections subscribed to
+its topic in a PUBLISH frame, so clients need not poll for them.
+
+Pushes wait in a PushQueue per subscriber, which a thread of its own
+drains, so a slow subscriber holds up neither the publisher nor the other
+subscribers. Values are state, so a new value replaces the value of the
+same topic still waiting to be pushed (the older value is coalesced into
+the newer one), and a subscriber that falls behind skips values rather 
+than lagging further and further behind. The queue is bounded by the 
+number of topics waiting: once it is full, the oldest value waiting on 
+another topic is dropped.
+"""
+
+from __future__ import with_statement
+from threading import Condition
+from collections import OrderedDict
+
+# The number of topics whose values may wait to be pushed to a subscriber.
+PUSH_QUEUE_SIZE = 256
+
+class PushQueue(object):
+    """
+    A bounded queue of the values waiting to be pushed to a subscriber,
+    holding the latest value of each topic. All methods are thread-safe.
+    """
+
+    def __init__(self, size=PUSH_QUEUE_SIZE):
+        """
+        Constructor.
+        @type size: int
+        @param size: The maximum number of topics with a value waiting.
+        @raise ValueError: If the size is invalid.
+        """
+        super(PushQueue, self).__init__()
+        if size < 1:
+            raise ValueError('Invalid queue size (%i)' % size)
+        self.__size = size
+        # The values waiting by topic, oldest first.
+        self.__entries = OrderedDict()
+        self.__closed = False
+        self.__pushed = 0
+        self.__coalesced = 0
+        self.__dropped = 0
+        self.__condition = Condition()
+
+    def put(self, topic, value):
+        """
+        Queues a value to be pushed. Values put after the queue has been
+        closed are ignored.
+        @type topic: str
+        @param topic: The topic the value has been published on.
+        @param value: The value, e.g. the marshalled value.
+        """
+        with self.__condition:
+            if self.__closed:
+                return
+            if topic in self.__entries:
+                # The value waiting is replaced in place, so the topic keeps
+                # its turn.
+                self.__entries[topic] = value
+                self.__coalesced += 1
+                return
+            if len(self.__entries) >= self.__size:
+                self.__entries.popitem(False)
+                self.__dropped += 1
+            self.__entries[topic] = value
+            self.__condition.notify()
+
+    def get(self):
+        """
+        Waits for the next value to push.
+        @rtype: tuple
+        @return: The topic and the value, or None once the queue has been
+        closed.
+        """
+        with self.__condition:
+            while len(self.__entries) == 0 and not self.__closed:
+                self.__condition.wait()
+            if self.__closed:
+                return None
+            self.__pushed += 1
+            return self.__entries.popitem(False)
+
+    def close(self):
+        """Drops the values waiting and wakes up the thread draining the queue."""
+        with self.__condition:
+            self.__closed = True
+            self.__entries.clear()
+            self.__condition.notifyAll()
+
+    def stats(self):
+        """
+        @rtype: dict
+        @return: The number of values 'queued' now, and the numbers of
+        values 'pushed', 'coalesced' and 'dropped' so far.
+        """
+        with self.__condition:
+            return {'queued': len(self.__entries), 'pushed': self.__pushed, 'coalesced': self.__coalesced,
+                    'dropped': self.__dropped}
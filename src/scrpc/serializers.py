@@ -0,0 +1,248 @@
+"""
+The serializers used to marshal function input, results and exceptions.
+The serializer used on a connection is negotiated when the connection is
+set up. Connections that do not negotiate one (e.g. protocol version 1
+clients) use 'pickle'.
+
+Serializers marshal values into a tuple of str parts, which are sent
+without being joined, and unmarshal from a str, a buffer or a bytearray.
+"""
+
+from cPickle import Pickler, Unpickler, dumps, UnpicklingError
+from cStringIO import StringIO
+from types import ListType
+import marshal
+import struct
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class Serializer(object):
+    """
+    Base class of the serializers. Serializers that cannot represent
+    exceptions natively send the exception class and its arguments, and
+    the exception is re-created on the receiving side if its class can be
+    imported.
+    """
+
+    name = None
+    # The exceptions raised by loads when given invalid data.
+    errors = (ValueError, TypeError, EOFError)
+    # Whether values are unmarshalled with the types they had, e.g. str and
+    # tuple rather than unicode and list.
+    exact = False
+
+    def dumps(self, value):
+        """
+        Marshals a value.
+        @rtype: tuple
+        @return: The parts of the marshalled value.
+        """
+        raise NotImplementedError()
+
+    def loads(self, data):
+        """Unmarshals a value."""
+        raise NotImplementedError()
+
+    def loads_arguments(self, data):
+        """Unmarshals the argument tuple of a call."""
+        return self.loads(data)
+
+    def dumps_exception(self, excep):
+        """Marshals an exception raised by a remote function."""
+        args = []
+        for arg in excep.args:
+            try:
+                self.dumps(arg)
+                args.append(arg)
+            except Exception:
+                args.append(str(arg))
+        return self.dumps((excep.__class__.__module__, excep.__class__.__name__, args))
+
+    def loads_exception(self, data):
+        """
+        Unmarshals an exception raised by a remote function. Only classes
+        from modules that have already been imported are considered, so the
+        peer cannot make us import anything.
+        @raise ImportError: If the exception class is unknown on this side.
+        """
+        module_name, class_name, args = self.loads(data)
+        cls = getattr(sys.modules.get(module_name), class_name, None)
+        if not isinstance(cls, type) or not issubclass(cls, BaseException):
+            raise ImportError('Unknown exception class %s.%s' % (module_name, class_name))
+        return cls(*args) #IGNORE:W0142
+
+class PickleSerializer(Serializer):
+    """cPickle with the highest protocol. The only choice for version 1."""
+
+    name = 'pickle'
+    errors = (UnpicklingError, ImportError)
+    exact = True
+
+    def dumps(self, value):
+        return (dumps(value, -1), )
+
+    def loads(self, data):
+        return Unpickler(StringIO(data)).load()
+
+    def dumps_exception(self, excep):
+        return self.dumps(excep)
+
+    def loads_exception(self, data):
+        return self.loads(data)
+
+class OutOfBandPickleSerializer(PickleSerializer):
+    """
+    cPickle where large strings are kept out of the pickle stream. They are
+    sent as parts of their own straight from the memory of the original
+    objects, which saves copying them into the pickle on the sending side.
+
+    The format is a header with the number of strings and the length of
+    the pickle, the length of each string, the pickle and the strings.
+    """
+
+    name = 'pickle-oob'
+    THRESHOLD = 65536 # Strings of at least this length are sent out of band.
+
+    def dumps(self, value):
+        buffers = []
+        def persistent_id(obj):
+            if type(obj) is str and len(obj) >= OutOfBandPickleSerializer.THRESHOLD:
+                buffers.append(obj)
+                return str(len(buffers) - 1)
+            return None
+        output = StringIO()
+        pickler = Pickler(output, -1)
+        pickler.persistent_id = persistent_id
+        pickler.dump(value)
+        data = output.getvalue()
+
+        header = [struct.pack('!II', len(buffers), len(data))]
+        for buf in buffers:
+            header.append(struct.pack('!Q', len(buf)))
+        return (''.join(header), data) + tuple(buffers)
+
+    def loads(self, data):
+        try:
+            count, length = struct.unpack_from('!II', data, 0)
+            offset = 8 + 8 * count
+            data_offset = offset + length
+            buffers = []
+            for i in range(count):
+                (buf_length, ) = struct.unpack_from('!Q', data, 8 + 8 * i)
+                buffers.append(str(buffer(data, data_offset, buf_length)))
+                data_offset += buf_length
+        except struct.error, excep:
+            raise UnpicklingError(str(excep))
+        unpickler = Unpickler(StringIO(buffer(data, offset, length)))
+        unpickler.persistent_load = lambda pid: buffers[int(pid)]
+        return unpickler.load()
+
+class MarshalSerializer(Serializer):
+    """
+    The stdlib marshal module. It is fast but supports builtin types only.
+    Like pickle, it is not secure against malicious data, so it must not be
+    used with untrusted peers.
+    """
+
+    name = 'marshal'
+    exact = True
+
+    def dumps(self, value):
+        return (marshal.dumps(value), )
+
+    def loads(self, data):
+        return marshal.loads(buffer(data))
+
+class MsgpackSerializer(Serializer):
+    """
+    msgpack. Safe to use with untrusted peers and compact for primitive
+    values. Only available when the msgpack module is installed. msgpack
+    has no tuples, so sequences are unmarshalled as lists.
+    """
+
+    name = 'msgpack'
+
+    def dumps(self, value):
+        return (msgpack.packb(value, use_bin_type=False), )
+
+    def loads(self, data):
+        if not isinstance(data, str):
+            data = str(data)
+        try:
+            return msgpack.unpackb(data, raw=True)
+        except TypeError:
+            # Releases of msgpack older than 0.5.2 have no raw option.
+            return msgpack.unpackb(data)
+
+    def loads_arguments(self, data):
+        argument_list = self.loads(data)
+        if type(argument_list) == ListType:
+            argument_list = tuple(argument_list)
+        return argument_list
+
+# The registry of serializers, indexed by name.
+SERIALIZERS = {}
+
+def register_serializer(serializer):
+    """
+    Makes a serializer available for negotiation.
+    @type serializer: Serializer
+    @param serializer: The serializer to register.
+    """
+    SERIALIZERS[serializer.name] = serializer
+
+def get_serializer(name):
+    """
+    Looks up a serializer.
+    @rtype: Serializer
+    @raise KeyError: If no serializer of that name is registered.
+    """
+    return SERIALIZERS[name]
+
+def available_serializers():
+    """Returns the names of the registered serializers."""
+    return SERIALIZERS.keys()
+
+def check_serializers(names):
+    """
+    Checks a list of serializer names given by the user.
+    @type names: list
+    @param names: The names. None means all registered serializers.
+    @rtype: list
+    @raise ValueError: If a serializer is unknown.
+    """
+    if names == None:
+        return available_serializers()
+    for name in names:
+        if not SERIALIZERS.has_key(name):
+            raise ValueError('Unknown serializer (%s)' % name)
+    return list(names)
+
+def select_serializer(offered, allowed):
+    """
+    Picks the serializer of a connection during negotiation.
+    @type offered: list
+    @param offered: The serializers offered by the client, most preferred 
+    first.
+    @type allowed: list
+    @param allowed: The serializers allowed by the server.
+    @rtype: Serializer
+    @return: The first offered serializer that is allowed, or None.
+    """
+    for name in offered:
+        if name in allowed and SERIALIZERS.has_key(name):
+            return SERIALIZERS[name]
+    return None
+
+register_serializer(PickleSerializer())
+register_serializer(OutOfBandPickleSerializer())
+register_serializer(MarshalSerializer())
+if msgpack != None:
+    register_serializer(MsgpackSerializer())
+
+# The serializer used when none has been negotiated.
+DEFAULT_SERIALIZER = get_serializer('pickle')
@@ -3,42 +3,542 @@ single-threaded, persistent (as in holds a persistent TCP connection
 between the client and the server) RPC server."""
 
 from __future__ import with_statement
-from timedsocket import TimedSocket
-from threading import Thread
-from types import FunctionType, StringType, TupleType, MethodType
-from cPickle import loads, dumps, UnpicklingError, PicklingError
+from timedsocket import TimedSocket, address_type, format_address
+from eventloop import EventLoop, READ
+from threading import Thread, BoundedSemaphore
+from types import FunctionType, StringType, TupleType, ListType, MethodType, GeneratorType
+from cPickle import dumps, PicklingError
 from thread import allocate_lock
+from executor import ProcessPool
+from client import SCStream
+from serializers import DEFAULT_SERIALIZER, get_serializer, check_serializers, select_serializer
+from compression import COMPRESSION_THRESHOLD, CompressionError, check_codecs, select_codec, \
+    compress_payload, decompress_payload
+from sharedmemory import SharedMemoryError, SharedPayloads, check_probe, is_local, map_payload
+from streaming import STREAM_BATCH, StreamWindow
+from metrics import METRICS_FUNCTION, CallRecord
+from cache import ResultCache, cache_key
+from cancellation import CancellationToken, set_current_token
+from admission import AdmissionControl
+from pubsub import PUSH_QUEUE_SIZE, PushQueue
+from protocol import PROTOCOL_VERSION, HELLO_FUNCTION, CALL, RESULT, EXCEPTION, \
+    NACK, STREAM, CHUNK, END, MORE, STOP, UPLOAD, DATA, EOF, BATCH, INVALIDATE, CANCEL, FLAG_CACHEABLE, \
+    SUBSCRIBE, UNSUBSCRIBE, PUBLISH, FLAG_NUMBERED, NO_COMMON_SERIALIZER, ProtocolError, busy_message, \
+    hello_reply, parse_hello, pack_frame, parse_frame, pack_functions, split_deadline, upload_id
+from functools import partial
+from socket import error as socket_error, SHUT_RD
 import logging
+import time
 
-class SCWorker(Thread):
-    POLL_PERIOD = 1.0
+def marshal_outcome(serializer, success, value):
+    """
+    Marshals the outcome of a call.
+    @type serializer: Serializer
+    @param serializer: The serializer of the connection.
+    @type success: bool
+    @param success: Whether value is the result or the exception raised.
+    @rtype: tuple
+    @return: The reply verb (RESULT or EXCEPTION) and the parts of the 
+    marshalled result or exception, or NACK and the reason if the function
+    gave up because the call was cancelled.
+    """
+    if not success:
+        if isinstance(value, CancellationToken.Cancelled):
+            return NACK, str(value)
+        return EXCEPTION, serializer.dumps_exception(value)
+    try:
+        return RESULT, serializer.dumps(value)
+    except Exception, excep: #IGNORE:W0703
+        # The result could not be marshaled. Return the exception to 
+        # the caller.
+        logging.getLogger('SCRPC (server)').debug('Marshaling error', exc_info=True)
+        return EXCEPTION, serializer.dumps_exception(excep)
+
+def run_function(function, argument_list, serializer_name='pickle', stream=False, timings=None,
+                 token=None):
+    """
+    Calls a registered function and marshals the outcome.
+    @type function: function
+    @param function: The function to call.
+    @type argument_list: tuple
+    @param argument_list: The unmarshalled function input.
+    @type serializer_name: str
+    @param serializer_name: The serializer to marshal the outcome with. It
+    is passed by name, so the call can be sent to a worker process.
+    @type stream: bool
+    @param stream: Whether the items of a generator may be streamed. If
+    not, they are collected and returned as a list.
+    @type timings: dict
+    @param timings: If given, the 'execute' and 'serialize' times of the
+    call are added to it (see CallRecord).
+    @type token: CancellationToken
+    @param token: The cancellation token of the call. The function is not
+    called if the call is no longer wanted, and finds the token with 
+    current_token while it runs.
+    @rtype: tuple
+    @return: The reply verb (RESULT or EXCEPTION) and the marshalled result 
+    or exception, STREAM and the generator to stream, or NACK and the 
+    reason the call was not performed.
+    """
+    if token != None:
+        reason = token.reason()
+        if reason != None:
+            return NACK, reason
+        previous = set_current_token(token)
+        try:
+            return run_function(function, argument_list, serializer_name, stream, timings)
+        finally:
+            set_current_token(previous)
+    serializer = get_serializer(serializer_name)
+    if timings != None:
+        started = time.time()
+    try:
+        cmd_output = function(*argument_list) #IGNORE:W0142
+        if isinstance(cmd_output, GeneratorType):
+            if stream:
+                if timings != None:
+                    timings['execute'] = time.time() - started
+                return STREAM, cmd_output
+            cmd_output = list(cmd_output)
+        success = True
+    except Exception, excep: #IGNORE:W0703
+        # An exception occurred executing the function. Send the 
+        # exception back to the caller.
+        success, cmd_output = False, excep
+    if timings == None:
+        return marshal_outcome(serializer, success, cmd_output)
+    executed = time.time()
+    timings['execute'] = executed - started
+    outcome = marshal_outcome(serializer, success, cmd_output)
+    timings['serialize'] = timings.get('serialize', 0.0) + time.time() - executed
+    return outcome
+
+# The number of seconds between checks of the cancellation token of a call
+# performed in the process pool.
+PROCESS_CHECK_INTERVAL = 0.1
+
+def wait_for_process(future, serializer, token=None):
+    """
+    Waits for the outcome of a call sent to the process pool.
+    @type future: SCFuture
+    @param future: The future returned by ProcessPool.submit.
+    @type serializer: Serializer
+    @param serializer: The serializer to marshal a failure with.
+    @type token: CancellationToken
+    @param token: The cancellation token of the call, or None. The call is
+    given up once it is no longer wanted, although the worker process 
+    performs it to the end.
+    @rtype: tuple
+    @return: The outcome (see run_function). A failure of the pool, e.g. a
+    worker process dying, is answered with an EXCEPTION.
+    """
+    if token != None:
+        while True:
+            interval = PROCESS_CHECK_INTERVAL
+            if token.deadline != None:
+                interval = min(interval, token.remaining())
+            if future.wait(interval):
+                break
+            reason = token.reason()
+            if reason != None:
+                return NACK, reason
+    try:
+        return future.result()
+    except Exception, excep: #IGNORE:W0703
+        logging.getLogger('SCRPC (server)').debug('Process pool failure', exc_info=True)
+        return marshal_outcome(serializer, False, excep)
+
+def next_chunk(generator, serializer_name='pickle'):
+    """
+    Pulls the next batch of items out of a streamed generator and marshals
+    it.
+    @type generator: generator
+    @param generator: The generator returned by a registered function.
+    @type serializer_name: str
+    @param serializer_name: The serializer to marshal the items with.
+    @rtype: tuple
+    @return: The frame verb (CHUNK, END or EXCEPTION) and payload.
+    """
+    serializer = get_serializer(serializer_name)
+    items = []
+    try:
+        for item in generator:
+            items.append(item)
+            if len(items) >= STREAM_BATCH:
+                break
+    except Exception, excep: #IGNORE:W0703
+        return marshal_outcome(serializer, False, excep)
+    if len(items) == 0:
+        return END, ''
+    verb, payload = marshal_outcome(serializer, True, items)
+    if verb == RESULT:
+        verb = CHUNK
+    return verb, payload
+
+# The number of threads performing the calls of a parallel batch.
+BATCH_THREADS = 8
+
+def check_batch(calls):
+    """
+    Checks the unmarshalled input of a batch.
+    @rtype: list
+    @return: The function names and argument tuples of the calls, or None
+    if the input is not a list of calls.
+    """
+    if type(calls) not in (ListType, TupleType):
+        return None
+    checked = []
+    for call in calls:
+        if type(call) not in (ListType, TupleType) or len(call) != 2:
+            return None
+        function_name, argument_list = call
+        if type(argument_list) == ListType:
+            # Serializers without tuples (msgpack) return lists.
+            argument_list = tuple(argument_list)
+        if type(function_name) != StringType or type(argument_list) != TupleType:
+            return None
+        checked.append((function_name, argument_list))
+    return checked
+
+def run_batch(server, serializer, calls, parallel=False, metrics=None):
+    """
+    Performs the calls of a batch and marshals their outcomes.
+    @type server: SCRPC or AsyncSCRPC
+    @param server: The server whose functions are called.
+    @type serializer: Serializer
+    @param serializer: The serializer of the connection.
+    @type calls: list
+    @param calls: The function names and argument tuples of the calls.
+    @type parallel: bool
+    @param parallel: Whether the calls may be performed concurrently, by
+    up to BATCH_THREADS threads.
+    @type metrics: Metrics
+    @param metrics: The metrics to record the calls in, or None.
+    @rtype: tuple
+    @return: The reply verb and the parts of the marshalled list of 
+    outcomes.
+    """
+    outcomes = [None] * len(calls)
+    def perform(index):
+        function_name, argument_list = calls[index]
+        dispatch = server.get_record(function_name)
+        if dispatch == None:
+            outcomes[index] = (NACK, 'Function (%s) does not exist.' % function_name)
+            return
+        # <HACK> See SCWorker.__perform_rpc.
+        if dispatch.intent != None: dispatch.intent(False)
+        # </HACK>
+        if metrics == None:
+            verb, payload = server.perform(dispatch, argument_list, serializer)
+        else:
+            record = CallRecord(function_name)
+            verb, payload = server.perform(dispatch, argument_list, serializer, timings=record.timings)
+        if isinstance(payload, tuple):
+            payload = ''.join(payload)
+        outcomes[index] = (verb, payload)
+        if metrics != None:
+            record.verb = verb
+            record.bytes_out = len(payload)
+            metrics.record_call(record)
+
+    if not parallel or len(calls) < 2:
+        for index in xrange(len(calls)):
+            perform(index)
+    else:
+        indices = iter(xrange(len(calls)))
+        lock = allocate_lock()
+        def work():
+            while True:
+                with lock:
+                    index = next(indices, None)
+                if index == None:
+                    return
+                perform(index)
+        threads = [Thread(target=work) for _ in xrange(min(BATCH_THREADS, len(calls)) - 1)]
+        for thread in threads:
+            thread.start()
+        work()
+        for thread in threads:
+            thread.join()
+    return marshal_outcome(serializer, True, outcomes)
+
+class SCDispatchRecord(object):
+    """
+    Everything needed to perform the calls of a registered function, 
+    resolved once when it is registered rather than on every call.
+    """
+
+    def __init__(self, number, name, function, executor='thread', cache=None):
+        super(SCDispatchRecord, self).__init__()
+        # The number the function may be called by (protocol version 9).
+        self.number = number
+        self.name = name
+        self.function = function
+        self.executor = executor
+        self.cache = cache
+        # <HACK> The intent function of the function, if one is registered
+        # (see SCWorker.__perform_rpc).
+        self.intent = None
+        # </HACK>
+
+    def __repr__(self):
+        return repr(self.function)
+
+class SCFunctionTable(object):
+    """The table of functions registered with an RPC server."""
+
+    EXECUTORS = ('thread', 'process')
+
+    def __init__(self):
+        super(SCFunctionTable, self).__init__()
+        # The dispatch records indexed by name and by number.
+        self.__records = {}
+        self.__numbered = []
+
+    def __repr__(self):
+        return repr(self.__records)
+
+    def get(self, function_name):
+        """
+        Looks up a registered function.
+        @type function_name: str
+        @param function_name: The name of the function.
+        @return: The function or None if no such function is registered.
+        """
+        record = self.__records.get(function_name)
+        if record == None:
+            return None
+        return record.function
+
+    def get_record(self, function_name):
+        """
+        Looks up the dispatch record of a registered function.
+        @rtype: SCDispatchRecord
+        @return: The record or None if no such function is registered.
+        """
+        return self.__records.get(function_name)
+
+    def get_numbered(self, number):
+        """
+        Looks up the dispatch record of a registered function by number.
+        @type number: int
+        @rtype: SCDispatchRecord
+        @return: The record or None if no function has the number.
+        """
+        if 0 <= number < len(self.__numbered):
+            return self.__numbered[number]
+        return None
+
+    def numbers(self):
+        """
+        @rtype: list
+        @return: The numbers and names of the registered functions, for the
+        function table sent to clients. Names that cannot be sent in a 
+        frame header are left out.
+        """
+        return [(record.number, record.name) for record in self.__numbered if '\n' not in record.name]
+
+    def get_executor(self, function_name):
+        """
+        Looks up the executor a function was registered with.
+        @type function_name: str
+        @param function_name: The name of the function.
+        @rtype: str
+        @return: 'thread' or 'process'.
+        """
+        record = self.__records.get(function_name)
+        if record == None:
+            return 'thread'
+        return record.executor
+
+    def get_cache(self, function_name):
+        """
+        Looks up the result cache of a function.
+        @rtype: ResultCache
+        @return: The cache or None if the results are not cached.
+        """
+        record = self.__records.get(function_name)
+        if record == None:
+            return None
+        return record.cache
+
+    def caches(self):
+        """Returns the result caches indexed by function name."""
+        return dict([(name, record.cache) for name, record in self.__records.iteritems()
+                     if record.cache != None])
+
+    def register(self, rpc_function, rpc_name='', executor='thread', cache=None):
+        """
+        Adds a function to the table.
+        @see: SCRPC.register_function
+        @rtype: SCDispatchRecord
+        @return: The dispatch record of the function.
+        """
+        # Do simple type-checking.
+        if not type(rpc_function) in (FunctionType, MethodType) or type(rpc_name) != StringType:
+            raise TypeError('Arguments of invalid type given.')
+        if executor not in SCFunctionTable.EXECUTORS:
+            raise ValueError('Unknown executor (%s)' % executor)
+        if cache == True:
+            cache = ResultCache()
+        elif cache == False:
+            cache = None
+        elif cache != None and not isinstance(cache, ResultCache):
+            raise TypeError('Arguments of invalid type given.')
+        if executor == 'process':
+            # The function is sent to the worker processes by reference.
+            try:
+                dumps(rpc_function, -1)
+            except (PicklingError, TypeError):
+                raise TypeError('Only module level functions can be run in a process pool.')
+        
+        # Check that the name is not already taken.
+        if rpc_name == '':
+            rpc_name = rpc_function.__name__
+        if self.__records.has_key(rpc_name):
+            raise SCRPC.Error('The function name %s is already taken.' % rpc_name)
+        
+        # Add the function to the table. The record is complete before it is
+        # published, since calls look it up without a lock.
+        record = SCDispatchRecord(len(self.__numbered), rpc_name, rpc_function, executor, cache)
+        # <HACK> Intent functions may be registered before or after the 
+        # functions they belong to.
+        intent = self.__records.get('%s_intent' % rpc_name)
+        if intent != None:
+            record.intent = intent.function
+        if rpc_name.endswith('_intent'):
+            owner = self.__records.get(rpc_name[:-len('_intent')])
+            if owner != None:
+                owner.intent = rpc_function
+        # </HACK>
+        self.__numbered.append(record)
+        self.__records[rpc_name] = record
+        return record
+
+class SCWorker(object):
+    IDLE_TIMEOUT = 1.0 # The number of seconds without requests after which a connection is parked.
+    MAX_PIPELINED_CALLS = 16 # The maximum number of concurrent calls per connection.
+    STREAM_STALL_TIMEOUT = 600.0 # The maximum number of seconds a stream waits for the client.
 
     def __init__(self, sock, rpcserver):
         super(SCWorker, self).__init__()
         self.__client_sock = sock
         self.__server = rpcserver
+        self.__metrics = rpcserver.get_metrics()
+        self.__fd = sock.sock.fileno()
+        # Whether the connection is parked on the poller of the server, 
+        # waiting for requests without a thread.
+        self.__parked = False
+        self.__park_lock = allocate_lock()
+        # Connections start out speaking protocol version 1 until the client
+        # negotiates something newer.
+        self.__protocol = 1
+        # Pickle is used until the client negotiates something else. It is
+        # None if the server does not allow pickle.
+        self.__serializer = rpcserver.default_serializer()
+        # The compression codec. None until the client negotiates one.
+        self.__codec = None
+        # Whether the client caches results (protocol version 6).
+        self.__client_caching = False
+        # The shared payloads sent, if the client passes large payloads in
+        # shared memory (protocol version 7).
+        self.__shared = None
+        # Whether the client calls functions by number (protocol version 9).
+        self.__numbered = False
+        # Whether the client may subscribe to topics (protocol version 10), 
+        # and the values waiting to be pushed once it has subscribed.
+        self.__pushing = False
+        self.__pushes = None
+        # Version 2 calls run concurrently, so replies must not interleave.
+        self.__send_lock = allocate_lock()
+        self.__call_slots = BoundedSemaphore(SCWorker.MAX_PIPELINED_CALLS)
+        # The windows of the streams in progress, indexed by call id.
+        self.__streams = {}
+        # The iterators of the uploads in progress, indexed by upload id, and
+        # the uploads of each call, indexed by call id.
+        self.__uploads = {}
+        self.__upload_calls = {}
+        # The cancellation tokens of the calls in progress, indexed by call
+        # id (protocol version 8).
+        self.__tokens = {}
+        self.__streams_lock = allocate_lock()
 
     def disconnect_client(self):
         """Closes the current client connection."""
+        with self.__streams_lock:
+            for window in self.__streams.itervalues():
+                window.stop()
+            for upload in self.__uploads.itervalues():
+                upload.finish(SCRPC.Error('Connection to client lost.'))
+            pushes = self.__pushes
+        if pushes != None:
+            self.__server.unsubscribe(self)
+            pushes.close()
+        if self.__shared != None:
+            self.__shared.close()
         try:
             self.__server.remove_connection(self)
+        except:
+            pass
+        try:
             self.__client_sock.close()
         except:
             pass
 
+    def fileno(self):
+        return self.__fd
+
+    def start(self):
+        """Starts a thread serving the requests of the client."""
+        Thread(target=self.run).start()
+
+    def handle_read(self):
+        """
+        Called by the poller of the server when a request arrives on a
+        parked connection. Must be called from the thread of the server.
+        """
+        self.__server.unpark(self)
+        with self.__park_lock:
+            self.__parked = False
+        self.start()
+
+    def handle_write(self):
+        pass
+
+    def handle_close(self):
+        # The thread finds out what went wrong.
+        self.handle_read()
+
+    def interrupt(self):
+        """Makes the worker leave because the server is shutting down."""
+        with self.__park_lock:
+            parked = self.__parked
+            if not parked:
+                # Wakes up the thread waiting for the next request.
+                try:
+                    self.__client_sock.shutdown(SHUT_RD)
+                except socket_error:
+                    pass
+        if parked:
+            self.disconnect_client()
+
     def run(self):
-        """Waits for a request from the client to arrive."""
+        """
+        Serves requests until the client has sent none for IDLE_TIMEOUT
+        seconds, and then parks the connection.
+        """
         logger = logging.getLogger('SCRPC (server)')
-        logger.debug('SCRPC worker spawned, port=%i.' % self.__client_sock.addr[1])
         while not self.__server.shutdown():
             # Wait for a command to arrive from the client.
             try:
-                cmd = self.__client_sock.recv_lp(SCWorker.POLL_PERIOD)
+                cmd = self.__client_sock.recv_lp_buffer(SCWorker.IDLE_TIMEOUT)
                 if cmd == '':
                     # The connection has been closed.
                     logger.debug('Connection closed by peer.')
                     break
             except TimedSocket.Timeout:
+                if self.__park():
+                    return
                 continue
             except TimedSocket.Exception:
                 # The connection is probably broken.
@@ -46,9 +546,42 @@ class SCWorker(Thread):
                 break
         
             # A command has arrived. Check what it is!
-            if cmd[:7] == 'PERFORM':
+            if (cmd[:4] == CALL and self.__protocol >= 2) or (cmd[:5] == BATCH and self.__protocol >= 5):
+                # Version 2 calls are performed concurrently and answered in 
+                # the order they finish. Reading stops while the maximum 
+                # number of calls are in progress, except for calls with 
+                # uploads, which depend on reading going on. Calls that would
+                # be shed are refused before they take a thread.
+                if cmd[:4] == CALL and self.__server.sheds_calls() and self.__shed(cmd):
+                    continue
+                slot = not self.__has_uploads(cmd)
+                received = None
+                if self.__metrics != None:
+                    received = time.time()
+                token = None
+                if self.__protocol >= 8 and cmd[:4] == CALL:
+                    token = self.__register_call(cmd)
+                if slot:
+                    self.__call_slots.acquire()
+                Thread(target=self.__run_call, args=(cmd, slot, received, token)).start()
+            elif cmd[:6] == CANCEL and self.__protocol >= 8:
+                self.__cancel_call(cmd)
+            elif (cmd[:9] == SUBSCRIBE or cmd[:11] == UNSUBSCRIBE) and self.__pushing:
+                self.__subscribe(cmd)
+            elif (cmd[:4] == MORE or cmd[:4] == STOP) and self.__protocol >= 3:
+                self.__control_stream(cmd)
+            elif cmd[:6] == UPLOAD and self.__protocol >= 4:
+                self.__announce_uploads(cmd)
+            elif (cmd[:4] == DATA or cmd[:3] == EOF) and self.__protocol >= 4:
+                self.__receive_upload(cmd)
+            elif cmd[:7] == 'PERFORM':
                 try:
-                    if self.__perform_rpc(cmd[8:]) == False:
+                    request = str(cmd[8:])
+                    if request.split(' ')[0] == HELLO_FUNCTION:
+                        success = self.__negotiate(request)
+                    else:
+                        success = self.__perform_rpc(request)
+                    if success == False:
                         # An error occurred - close down the thread.
                         logger.debug('Error performing RPC.')
                         break
@@ -57,9 +590,613 @@ class SCWorker(Thread):
                     break
 
         # Shutdown.
-        logger.debug('SCRPC worker leaving, port=%i.' % self.__client_sock.addr[1])
+        logger.debug('SCRPC worker leaving, peer=%s.' % format_address(self.__client_sock.addr))
         self.disconnect_client()
+
+    def invalidate(self, function_name=None, argument_list=None):
+        """
+        Tells a client that caches results which of them have become stale.
+        @see: ResultCache.invalidate
+        """
+        if not self.__client_caching:
+            return
+        fields = ()
+        payload = ''
+        if function_name != None:
+            fields = (function_name, )
+            if argument_list != None:
+                try:
+                    payload = self.__serializer.dumps(argument_list)
+                except Exception: #IGNORE:W0703
+                    # All results of the function are stale then.
+                    pass
+        try:
+            with self.__send_lock:
+                self.__client_sock.send_lp(pack_frame(INVALIDATE, fields, payload))
+        except (TimedSocket.Timeout, TimedSocket.Exception):
+            # The connection is probably broken.
+            logging.getLogger('SCRPC (server)').debug('invalidate', exc_info=True)
+            self.disconnect_client()
+
+    def push(self, topic, value, payloads):
+        """
+        Queues a value published on a topic the client has subscribed to.
+        @type topic: str
+        @param topic: The topic.
+        @param value: The value published.
+        @type payloads: dict
+        @param payloads: The value marshalled so far, indexed by serializer
+        name, so that it is marshalled once per serializer.
+        """
+        serializer = self.__serializer
+        if self.__pushes == None or serializer == None:
+            return
+        payload = payloads.get(serializer.name)
+        if payload == None:
+            try:
+                payload = serializer.dumps(value)
+            except Exception: #IGNORE:W0703
+                logging.getLogger('SCRPC (server)').warning('Error marshaling the value of %s.' % topic,
+                                                            exc_info=True)
+                return
+            payloads[serializer.name] = payload
+        self.__pushes.put(topic, payload)
+
+    def push_stats(self):
+        """
+        @rtype: dict
+        @return: The statistics of the values pushed (see PushQueue.stats), 
+        or None if the client has not subscribed to anything.
+        """
+        pushes = self.__pushes
+        if pushes == None:
+            return None
+        return pushes.stats()
+
+    def announce(self, record):
+        """
+        Tells a client that calls functions by number the number of a 
+        function registered after it connected.
+        @type record: SCDispatchRecord
+        """
+        if '\n' in record.name:
+            return
+        try:
+            with self.__send_lock:
+                # The client learns of the numbers when it negotiates them.
+                if not self.__numbered:
+                    return
+                self.__client_sock.send_lp(pack_functions([(record.number, record.name)]))
+        except (TimedSocket.Timeout, TimedSocket.Exception):
+            # The connection is probably broken.
+            logging.getLogger('SCRPC (server)').debug('announce', exc_info=True)
+            self.disconnect_client()
+
+    def __park(self):
+        """
+        Hands the idle connection over to the poller of the server, so that
+        it costs no thread until the next request arrives. Nothing has been 
+        read ahead of that request, since the read timed out.
+        @rtype: bool
+        @return: False if the server is shutting down.
+        """
+        with self.__park_lock:
+            if self.__server.shutdown():
+                return False
+            self.__parked = True
+        self.__server.park(self)
+        return True
                     
+    def __negotiate(self, request):
+        """
+        Handles a protocol negotiation request from the client.
+        @type request: str
+        @param request: The negotiation request (without the PERFORM verb).
+        """
+        logger = logging.getLogger('SCRPC (server)')
+        try:
+            try:
+                version, options = parse_hello(request.split(' ')[1:])
+            except ProtocolError:
+                self.__client_sock.send_lp('NACK Invalid negotiation request.')
+                return True
+            reply_options = {}
+            if options.has_key('serializers'):
+                serializer = select_serializer(options['serializers'].split(','),
+                                               self.__server.allowed_serializers())
+                if serializer == None:
+                    self.__client_sock.send_lp('%s %s.' % (NACK, NO_COMMON_SERIALIZER))
+                    return True
+                self.__serializer = serializer
+                reply_options['serializer'] = serializer.name
+            if options.has_key('compression'):
+                # Without a common codec frames are just not compressed.
+                self.__codec = select_codec(options['compression'].split(','),
+                                            self.__server.allowed_codecs())
+                if self.__codec != None:
+                    reply_options['compression'] = self.__codec.name
+            self.__protocol = min(version, PROTOCOL_VERSION)
+            if options.get('cache') == '1' and self.__protocol >= 6:
+                self.__client_caching = True
+                reply_options['cache'] = '1'
+            if options.has_key('shm') and self.__protocol >= 7 and self.__server.allows_shared_memory() \
+               and is_local(self.__client_sock.addr) and check_probe(options.get('shmprobe')):
+                try:
+                    self.__shared = SharedPayloads(int(options['shm']))
+                    reply_options['shm'] = '1'
+                except ValueError:
+                    pass
+            if options.get('push') == '1' and self.__protocol >= 10:
+                self.__pushing = True
+                reply_options['push'] = '1'
+            if options.get('ids') == '1' and self.__protocol >= 9:
+                reply_options['ids'] = '1'
+                with self.__send_lock:
+                    # Functions registered from now on are announced, so the
+                    # table is taken after numbering is turned on.
+                    self.__numbered = True
+                    self.__client_sock.send_lp(hello_reply(self.__protocol, reply_options))
+                    self.__client_sock.send_lp(pack_functions(self.__server.function_numbers()))
+                return True
+            self.__client_sock.send_lp(hello_reply(self.__protocol, reply_options))
+        except (TimedSocket.Timeout, TimedSocket.Exception):
+            # The connection is probably broken.
+            logger.debug('negotiate', exc_info=True)
+            self.disconnect_client()
+            return False
+        return True
+
+    def __shed(self, frame):
+        """
+        Refuses a version 2 call right away if the server is overloaded, 
+        without unmarshalling it.
+        @rtype: bool
+        @return: Whether the call has been refused.
+        """
+        try:
+            _, flags, (call_id, field), _ = parse_frame(frame, 2)
+            _, field = split_deadline(flags, field)
+            record = self.__lookup(flags, field)
+        except (ProtocolError, ValueError):
+            # Malformed frames are dealt with when the call is performed.
+            return False
+        if record == None:
+            return False
+        message = self.__server.overloaded(record.name)
+        if message == None:
+            return False
+        self.__end_uploads(call_id)
+        self.__reply(NACK, call_id, message)
+        return True
+
+    def __lookup(self, flags, field):
+        """
+        Looks up the dispatch record of the function named in a CALL frame.
+        @type flags: str
+        @param flags: The frame flags.
+        @type field: str
+        @param field: The name of the function, or its number if the call
+        is flagged with FLAG_NUMBERED.
+        @rtype: SCDispatchRecord
+        @return: The record or None if no such function is registered.
+        @raise ValueError: If the number is invalid.
+        """
+        if FLAG_NUMBERED in flags:
+            return self.__server.get_numbered(int(field))
+        return self.__server.get_record(field)
+
+    def __register_call(self, frame):
+        """
+        Creates the cancellation token of a version 8 call as soon as it
+        arrives, so that its deadline counts from then and the call can be
+        cancelled while it waits for a thread.
+        @rtype: CancellationToken
+        @return: The token, or None if the frame is malformed.
+        """
+        try:
+            _, flags, (call_id, field), _ = parse_frame(frame, 2)
+            seconds, _ = split_deadline(flags, field)
+        except (ProtocolError, ValueError):
+            # Malformed frames are dealt with when the call is performed.
+            return None
+        token = CancellationToken()
+        if seconds != None:
+            token.deadline = time.time() + seconds
+        with self.__streams_lock:
+            self.__tokens[call_id] = token
+        return token
+
+    def __subscribe(self, frame):
+        """
+        Handles a SUBSCRIBE or UNSUBSCRIBE frame of the client. The values
+        are pushed by a thread of their own, which is started with the first
+        subscription.
+        """
+        try:
+            verb, _, (topic, ), _ = parse_frame(frame, 1)
+        except (ProtocolError, ValueError):
+            logging.getLogger('SCRPC (server)').debug('Malformed subscription frame.', exc_info=True)
+            return
+        if verb == UNSUBSCRIBE:
+            self.__server.unsubscribe(self, topic)
+            return
+        with self.__streams_lock:
+            start = self.__pushes == None
+            if start:
+                self.__pushes = PushQueue(self.__server.PUSH_QUEUE_SIZE)
+        if start:
+            pusher = Thread(target=self.__push_values, args=(self.__pushes, ))
+            pusher.setDaemon(True)
+            pusher.start()
+        self.__server.subscribe(self, topic)
+
+    def __push_values(self, pushes):
+        """Thread function sending the values pushed to the client."""
+        while True:
+            entry = pushes.get()
+            if entry == None:
+                return
+            topic, payload = entry
+            flags, payload = compress_payload(self.__codec, payload, self.__server.COMPRESSION_THRESHOLD)
+            try:
+                with self.__send_lock:
+                    self.__client_sock.send_lp(pack_frame(PUBLISH, (topic, ), payload, flags))
+            except (TimedSocket.Timeout, TimedSocket.Exception):
+                # The connection is probably broken.
+                logging.getLogger('SCRPC (server)').debug('push', exc_info=True)
+                self.disconnect_client()
+                return
+
+    def __cancel_call(self, frame):
+        """Handles a CANCEL frame of the client."""
+        try:
+            _, _, (call_id, ), _ = parse_frame(frame)
+        except (ProtocolError, ValueError):
+            logging.getLogger('SCRPC (server)').debug('Malformed CANCEL frame.', exc_info=True)
+            return
+        with self.__streams_lock:
+            token = self.__tokens.get(call_id)
+        if token != None:
+            token.cancel()
+
+    def __run_call(self, frame, slot=True, received=None, token=None):
+        """
+        Thread function performing a single version 2 call.
+        @type frame: str
+        @param frame: The CALL frame.
+        @type slot: bool
+        @param slot: Whether the call holds a call slot.
+        @type received: float
+        @param received: When the frame was received, if metrics are on.
+        @type token: CancellationToken
+        @param token: The cancellation token of the call (version 8).
+        """
+        try:
+            if self.__perform_call(frame, received, token) == False:
+                logging.getLogger('SCRPC (server)').debug('Error performing RPC.')
+        except:
+            logging.getLogger('SCRPC (server)').debug('Unhandled exception while performing RPC.', exc_info=True)
+            self.disconnect_client()
+        finally:
+            if slot:
+                self.__call_slots.release()
+
+    def __reply(self, verb, call_id, payload, record=None, cacheable=False):
+        """
+        Sends a single version 2 reply frame to the client.
+        @type verb: str
+        @param verb: The reply verb (RESULT, EXCEPTION or NACK).
+        @type call_id: str
+        @param call_id: The id of the call being answered.
+        @type payload: str or tuple
+        @param payload: The reply payload or the parts of it.
+        @type record: CallRecord
+        @param record: The measurements of the call, if metrics are on.
+        @type cacheable: bool
+        @param cacheable: Whether the client may cache the result.
+        """
+        if record != None:
+            started = time.time()
+        flags, payload = compress_payload(self.__codec, payload, self.__server.COMPRESSION_THRESHOLD)
+        if self.__shared != None:
+            flags, payload = self.__shared.share(flags, payload)
+        if cacheable:
+            flags += FLAG_CACHEABLE
+        frame = pack_frame(verb, (call_id,), payload, flags)
+        if record != None:
+            compressed = time.time()
+            record.add_time('serialize', compressed - started)
+            record.verb = verb
+            record.bytes_out = sum([len(part) for part in frame])
+        try:
+            with self.__send_lock:
+                self.__client_sock.send_lp(frame)
+            if record != None:
+                record.add_time('network', time.time() - compressed)
+        except (TimedSocket.Timeout, TimedSocket.Exception):
+            # The connection is probably broken.
+            logging.getLogger('SCRPC (server)').debug('reply(%s)' % verb, exc_info=True)
+            if self.__shared != None:
+                self.__shared.discard(flags, payload)
+            self.disconnect_client()
+            return False
+        return True
+
+    def __perform_call(self, frame, received=None, token=None):
+        """
+        Performs an RPC call received as a single version 2 CALL frame.
+        @type frame: str
+        @param frame: The CALL frame holding the function name and input.
+        @type received: float
+        @param received: When the frame was received, if metrics are on.
+        @type token: CancellationToken
+        @param token: The cancellation token of the call (version 8).
+        """
+        logger = logging.getLogger('SCRPC (server)')
+
+        # Split the frame into call id, function name and input.
+        try:
+            verb, flags, (call_id, function_name), cmd_input = parse_frame(frame, 2)
+            if verb == CALL:
+                _, function_name = split_deadline(flags, function_name)
+                dispatch = self.__lookup(flags, function_name)
+        except (ProtocolError, ValueError):
+            logger.debug('Malformed CALL frame.', exc_info=True)
+            self.disconnect_client()
+            return False
+        if verb == BATCH:
+            return self.__call_batch(call_id, function_name == 'parallel', flags, cmd_input)
+        record = None
+        if self.__metrics != None and dispatch != None:
+            record = CallRecord(dispatch.name, len(frame))
+            record.add_time('queue', time.time() - received)
+        try:
+            if dispatch == None:
+                return self.__reply(NACK, call_id, 'Function (%s) does not exist.' % function_name, record)
+            return self.__call_function(call_id, dispatch, flags, cmd_input, record, token)
+        finally:
+            # A generator may go on reading its uploads while it streams.
+            with self.__streams_lock:
+                streaming = self.__streams.has_key(call_id)
+                if token != None:
+                    self.__tokens.pop(call_id, None)
+            if not streaming:
+                self.__end_uploads(call_id)
+            if record != None:
+                self.__metrics.record_call(record)
+
+    def __call_function(self, call_id, dispatch, flags, cmd_input, record=None, token=None):
+        """
+        Performs a version 2 call and sends the outcome to the client.
+        @type dispatch: SCDispatchRecord
+        @param dispatch: The dispatch record of the function called.
+        @type record: CallRecord
+        @param record: The measurements of the call, if metrics are on.
+        @type token: CancellationToken
+        @param token: The cancellation token of the call (version 8).
+        """
+        logger = logging.getLogger('SCRPC (server)')
+
+        function_name = dispatch.name
+        serializer = self.__serializer
+        if serializer == None:
+            return self.__reply(NACK, call_id, 'No serializer has been negotiated.', record)
+        # Calls nobody waits for any more are not worth unmarshalling.
+        if token != None and token.reason() != None:
+            return self.__reply(NACK, call_id, token.reason(), record)
+        if record != None:
+            started = time.time()
+        try:
+            cmd_input = decompress_payload(self.__codec, flags, map_payload(self.__shared, flags, cmd_input))
+        except (CompressionError, SharedMemoryError), excep:
+            return self.__reply(NACK, call_id, str(excep), record)
+
+        # <HACK> See __perform_rpc.
+        intent_function = dispatch.intent
+        if intent_function != None: intent_function(False)
+        # </HACK>
+
+        # Unmarshal the input.
+        try:
+            argument_list = serializer.loads_arguments(cmd_input)
+        except serializer.errors + (ImportError, ), excep:
+            logger.debug('Unmarshaling error', exc_info=True)
+            # <HACK>
+            if intent_function: intent_function(True)
+            # </HACK>
+            return self.__reply(EXCEPTION, call_id, serializer.dumps_exception(excep), record)
+
+        if record != None:
+            record.add_time('serialize', time.time() - started)
+
+        # Do simple type checking.
+        if type(argument_list) != TupleType:
+            # <HACK>
+            if intent_function: intent_function(True)
+            # </HACK>
+            return self.__reply(NACK, call_id, 'Argument must be a tuple.', record)
+
+        # Put the iterators of the uploads in place of their arguments.
+        with self.__streams_lock:
+            uploads = self.__upload_calls.get(call_id, ())
+        if len(uploads) != 0:
+            if not self.__server.accepts_uploads(function_name):
+                # <HACK>
+                if intent_function: intent_function(True)
+                # </HACK>
+                return self.__reply(NACK, call_id, 'Function (%s) cannot take uploads.' % function_name,
+                                    record)
+            argument_list = list(argument_list)
+            for position, upload in uploads:
+                if position >= len(argument_list):
+                    return self.__reply(NACK, call_id, 'Invalid upload position.', record)
+                argument_list[position] = upload
+            argument_list = tuple(argument_list)
+
+        # Call the RPC function and send the outcome to the caller.
+        timings = None
+        if record != None:
+            timings = record.timings
+        verb, payload = self.__server.perform(dispatch, argument_list, serializer, self.__protocol >= 3,
+                                              timings, token)
+        if verb == STREAM:
+            return self.__start_stream(call_id, payload, serializer, record)
+        cacheable = self.__client_caching and verb == RESULT and len(uploads) == 0 and \
+            dispatch.cache != None
+        return self.__reply(verb, call_id, payload, record, cacheable)
+
+    def __call_batch(self, call_id, parallel, flags, cmd_input):
+        """Performs a batch of calls and sends their outcomes to the client."""
+        serializer = self.__serializer
+        if serializer == None:
+            return self.__reply(NACK, call_id, 'No serializer has been negotiated.')
+        try:
+            calls = serializer.loads(decompress_payload(self.__codec, flags,
+                                                        map_payload(self.__shared, flags, cmd_input)))
+        except (CompressionError, SharedMemoryError), excep:
+            return self.__reply(NACK, call_id, str(excep))
+        except serializer.errors + (ImportError, ), excep:
+            logging.getLogger('SCRPC (server)').debug('Unmarshaling error', exc_info=True)
+            return self.__reply(EXCEPTION, call_id, serializer.dumps_exception(excep))
+        calls = check_batch(calls)
+        if calls == None:
+            return self.__reply(NACK, call_id, 'Batch must be a list of calls.')
+        verb, payload = run_batch(self.__server, serializer, calls, parallel, self.__metrics)
+        return self.__reply(verb, call_id, payload)
+
+    def __start_stream(self, call_id, generator, serializer, record=None):
+        """
+        Starts streaming the items of a generator to the client. The 
+        stream gets a thread of its own, so it does not take up one of the
+        call slots while waiting for the client.
+        """
+        window = StreamWindow()
+        with self.__streams_lock:
+            self.__streams[call_id] = window
+        if not self.__reply(STREAM, call_id, '', record):
+            return False
+        thread = Thread(target=self.__stream, args=(call_id, generator, serializer, window))
+        thread.setDaemon(True)
+        thread.start()
+        return True
+
+    def __stream(self, call_id, generator, serializer, window):
+        """Thread function sending the chunks of a stream."""
+        try:
+            while window.acquire(SCWorker.STREAM_STALL_TIMEOUT):
+                verb, payload = next_chunk(generator, serializer.name)
+                if not self.__reply(verb, call_id, payload) or verb != CHUNK:
+                    break
+        finally:
+            with self.__streams_lock:
+                self.__streams.pop(call_id, None)
+            generator.close()
+            self.__end_uploads(call_id)
+
+    def __has_uploads(self, frame):
+        """Checks whether uploads have been announced for a CALL frame."""
+        with self.__streams_lock:
+            if len(self.__upload_calls) == 0:
+                return False
+        try:
+            _, _, fields, _ = parse_frame(frame, 2)
+        except ProtocolError:
+            return False
+        with self.__streams_lock:
+            return self.__upload_calls.has_key(fields[0])
+
+    def __announce_uploads(self, frame):
+        """Handles an UPLOAD frame announcing the uploads of a call."""
+        try:
+            _, _, (call_id, positions), _ = parse_frame(frame)
+            positions = [int(position) for position in positions.split(',')]
+        except (ProtocolError, ValueError):
+            logging.getLogger('SCRPC (server)').debug('Malformed UPLOAD frame.', exc_info=True)
+            return
+        uploads = []
+        with self.__streams_lock:
+            for position in positions:
+                uid = upload_id(call_id, position)
+                upload = SCStream(partial(self.__grant_upload, uid), lambda: None)
+                self.__uploads[uid] = upload
+                uploads.append((position, upload))
+            self.__upload_calls[call_id] = uploads
+
+    def __receive_upload(self, frame):
+        """Handles the DATA and EOF frames of an upload."""
+        try:
+            verb, flags, fields, payload = parse_frame(frame)
+            with self.__streams_lock:
+                upload = self.__uploads.get(fields[0])
+        except (ProtocolError, IndexError):
+            logging.getLogger('SCRPC (server)').debug('Malformed upload frame.', exc_info=True)
+            return
+        if upload == None:
+            # The call has finished already.
+            return
+        serializer = self.__serializer
+        try:
+            payload = decompress_payload(self.__codec, flags, payload)
+            if verb == DATA:
+                upload.feed(serializer.loads(payload))
+                return
+            with self.__streams_lock:
+                self.__uploads.pop(fields[0], None)
+            if len(payload) == 0:
+                upload.finish()
+            else:
+                upload.finish(serializer.loads_exception(payload))
+        except Exception, excep: #IGNORE:W0703
+            logging.getLogger('SCRPC (server)').debug('Error receiving upload.', exc_info=True)
+            upload.finish(excep)
+
+    def __grant_upload(self, uid, count):
+        """Lets the client send count more chunks of an upload."""
+        try:
+            with self.__send_lock:
+                self.__client_sock.send_lp(pack_frame(MORE, (uid, count)))
+        except (TimedSocket.Timeout, TimedSocket.Exception):
+            logging.getLogger('SCRPC (server)').debug('grant_upload', exc_info=True)
+            self.disconnect_client()
+
+    def __end_uploads(self, call_id):
+        """
+        Forgets the uploads of a finished call, and stops the client 
+        sending those that are not complete.
+        """
+        incomplete = []
+        with self.__streams_lock:
+            uploads = self.__upload_calls.pop(call_id, ())
+            for position, upload in uploads:
+                uid = upload_id(call_id, position)
+                if self.__uploads.pop(uid, None) != None:
+                    incomplete.append(uid)
+        for _, upload in uploads:
+            upload.finish()
+        try:
+            with self.__send_lock:
+                for uid in incomplete:
+                    self.__client_sock.send_lp(pack_frame(STOP, (uid, )))
+        except (TimedSocket.Timeout, TimedSocket.Exception):
+            logging.getLogger('SCRPC (server)').debug('end_uploads', exc_info=True)
+            self.disconnect_client()
+
+    def __control_stream(self, frame):
+        """Handles the MORE and STOP frames of the client."""
+        try:
+            verb, _, fields, _ = parse_frame(frame)
+            with self.__streams_lock:
+                window = self.__streams.get(fields[0])
+            if window == None:
+                # The stream has ended already.
+                return
+            if verb == MORE:
+                window.grant(int(fields[1]))
+            else:
+                window.stop()
+        except (ProtocolError, IndexError, ValueError):
+            logging.getLogger('SCRPC (server)').debug('Malformed stream control frame.', exc_info=True)
+
     def __perform_rpc(self, function_name):
         """
         Performs an RPC call.
@@ -69,14 +1206,18 @@ class SCWorker(Thread):
         logger = logging.getLogger('SCRPC (server)') 
 
         # Check that the function exists.
-        function = None
+        dispatch = None
         try:
-            function = self.__server.get_function(function_name)
-            if function != None:
-                self.__client_sock.send_lp('ACK')
-            else:
+            dispatch = self.__server.get_record(function_name)
+            if dispatch == None:
                 self.__client_sock.send_lp('NACK Function (%s) does not exist.' % function_name)
                 return True
+            elif self.__server.default_serializer() == None:
+                # Version 1 input is always pickled.
+                self.__client_sock.send_lp('NACK Pickled input is not accepted.')
+                return True
+            else:
+                self.__client_sock.send_lp('ACK')
         except (TimedSocket.Timeout, TimedSocket.Exception):
             # The connection has somehow failed.
             logger.debug('perform_rpc(1)', exc_info=True)
@@ -90,13 +1231,14 @@ class SCWorker(Thread):
         # will be called now to show the intent of the client to call the function.
         # The argument to the intent function is a boolean signaling failure. In 
         # this initial case we only know of the intent and there is no error.
-        intent_function = self.__server.get_function('%s_intent' % function_name)
+        # The intent function is looked up when the functions are registered.
+        intent_function = dispatch.intent
         if intent_function != None: intent_function(False)
         # </HACK>
 
         # The function exists - wait for the client to send the input.
         try:
-            cmd_input = self.__client_sock.recv_lp()
+            cmd_input = self.__client_sock.recv_lp_buffer()
             if cmd_input == '':
                 # The connection has been closed.
                 logger.debug('Client did not send input')
@@ -113,8 +1255,8 @@ class SCWorker(Thread):
         
         # The command input has been received. Unmarshal it.
         try:
-            argument_list = loads(cmd_input)
-        except (UnpicklingError, ImportError), excep:
+            argument_list = DEFAULT_SERIALIZER.loads(cmd_input)
+        except DEFAULT_SERIALIZER.errors, excep:
             # An error occurred unmarshalling the input. Return the 
             # exception to the caller.
             logger.debug('Unpickling error', exc_info=True)
@@ -122,7 +1264,7 @@ class SCWorker(Thread):
             if intent_function: intent_function(True)
             # </HACK>
             try:
-                self.__client_sock.send_lp('EXCEPTION %s' % dumps(excep, -1))
+                self.__client_sock.send_lp(('EXCEPTION ', ) + DEFAULT_SERIALIZER.dumps_exception(excep))
                 return True
             except (TimedSocket.Timeout, TimedSocket.Exception):
                 # The connection is probably broken.
@@ -149,45 +1291,18 @@ class SCWorker(Thread):
             self.disconnect_client()
             return False
         
-        # Call the RPC function.
-        try:
-            cmd_output = function(*argument_list) #IGNORE:W0142
-        except Exception, excep: #IGNORE:W0703
-            # An exception occurred executing the function. Send the 
-            # exception back to the caller.
-            try:
-                self.__client_sock.send_lp('EXCEPTION %s' % dumps(excep, -1))
-                return True
-            except (TimedSocket.Timeout, TimedSocket.Exception), excep:
-                # The connection is probably broken.
-                logger.debug('perform_rpc(5)', exc_info=True)
-                self.disconnect_client()
-                return False
+        # Call the RPC function. The outcome is either the marshaled result
+        # or the exception raised by the function.
+        verb, payload = self.__server.perform(dispatch, argument_list, DEFAULT_SERIALIZER)
+        if isinstance(payload, str):
+            payload = (payload, )
            
-        # The command has been successfully executed. Now return the 
-        # output to the caller.
-        # Start by marshaling it.
-        try:
-            marshalled_result = dumps(cmd_output, -1)
-        except PicklingError, excep:
-            # The result could not be marshaled. Return the exception to 
-            # the caller.
-            logger.debug('Pickling error', exc_info=True)
-            try:
-                self.__client_sock.send_lp('EXCEPTION %s' % dumps(excep, -1))
-                return True
-            except (TimedSocket.Timeout, TimedSocket.Exception):
-                # The connection is probably broken.
-                logger.debug('perform_rpc(6)', exc_info=True)
-                self.disconnect_client()
-                return False
-            
-        # Send the marshaled result to the caller.
+        # Send the outcome to the caller.
         try:
-            self.__client_sock.send_lp('RESULT %s' % marshalled_result)
+            self.__client_sock.send_lp(('%s ' % verb, ) + payload)
         except (TimedSocket.Timeout, TimedSocket.Exception):
             # The connection is probably broken.
-            logger.debug('perform_rpc(7)', exc_info=True)
+            logger.debug('perform_rpc(5)', exc_info=True)
             self.disconnect_client()
             return False
         
@@ -196,6 +1311,10 @@ class SCWorker(Thread):
 
 class SCRPC(Thread):
     """The single-connection RPC server."""
+
+    PROCESS_POOL_SIZE = None # The number of worker processes. None means one per CPU.
+    COMPRESSION_THRESHOLD = COMPRESSION_THRESHOLD # Replies smaller than this are not compressed.
+    PUSH_QUEUE_SIZE = PUSH_QUEUE_SIZE # The number of topics whose values may wait to be pushed to a client.
     
     class Error(Exception):
         """
@@ -205,42 +1324,238 @@ class SCRPC(Thread):
         def __init__(self, msg):
             super(SCRPC.Error, self).__init__(msg)
 
-    def __init__(self, address=('', 0)):
+    def __init__(self, address=('', 0), max_connections=None, serializers=None, compression=None,
+                 metrics=None, shared_memory=True, max_calls=None, max_queued=None, queue_timeout=None):
         """
         Constructor.
         @type address: tuple
         @param address: The address that the RPC server should listen on for
-        incoming connection requests. 
+        incoming connection requests, or the path of a Unix domain socket.
+        @type max_connections: int
+        @param max_connections: The maximum number of client connections. 
+        Connections beyond this are refused with a NACK. None means no limit.
+        @type serializers: list
+        @param serializers: The names of the serializers clients may 
+        negotiate. None means all available serializers. Only 'msgpack' is
+        safe with untrusted clients, as 'pickle' and 'marshal' input can be
+        malicious; leaving out 'pickle' also refuses protocol version 1 
+        clients.
+        @type compression: list
+        @param compression: The names of the compression codecs clients may
+        negotiate. None means all available codecs. Clients decide whether
+        to use compression at all.
+        @type metrics: Metrics
+        @param metrics: The metrics to record the calls and connections of
+        the server in. They are also served to clients as METRICS_FUNCTION.
+        None turns metrics off.
+        @type shared_memory: bool
+        @param shared_memory: Whether clients on the same host may pass 
+        large payloads in shared memory (see SCProxy).
+        @type max_calls: int
+        @param max_calls: The maximum number of calls performed at once. 
+        Further calls wait in a queue. None means no limit. Functions may
+        have limits of their own (see register_function).
+        @type max_queued: int
+        @param max_queued: The maximum number of calls waiting in the queue.
+        Calls beyond this are shed: they are refused with an overloaded NACK,
+        which SCProxyPool retries on another server. None means no limit.
+        @type queue_timeout: float
+        @param queue_timeout: The maximum number of seconds a call waits in
+        the queue before it is shed. None means no limit.
+        @raise ValueError: If a serializer, a codec or a limit is invalid.
         """
         # Initialize super class.
         super(SCRPC, self).__init__()
         
         # Create server socket listening for incoming requests.
-        self.__server_sock = TimedSocket()
+        self.__server_sock = TimedSocket(type=address_type(address))
         self.__server_sock.bind(address)
         self.__server_sock.listen(5)
         
         # Set member variables.
-        self.__functions = {}
+        self.__functions = SCFunctionTable()
+        self.__serializers = check_serializers(serializers)
+        self.__codecs = check_codecs(compression)
+        self.__process_pool = None
+        self.__process_pool_lock = allocate_lock()
+        self.__connections = []
+        self.__connections_lock = allocate_lock()
+        self.__max_connections = max_connections
+        self.__shared_memory = shared_memory
+        self.__admission = AdmissionControl(max_calls, max_queued, queue_timeout)
         self.__shutdown = False
         self.__shutdown_signal = allocate_lock()
+        # The connections subscribed to each topic and the latest value 
+        # published on each topic, indexed by topic.
+        self.__subscribers = {}
+        self.__published = {}
+        self.__topics_lock = allocate_lock()
+        self.__metrics = metrics
+        if metrics != None:
+            self.__functions.register(self.__serve_metrics, METRICS_FUNCTION)
+
+        # The poller watching the server socket and the parked connections.
+        self.__loop = EventLoop()
+
+    def fileno(self):
+        return self.__server_sock.sock.fileno()
 
     def shutdown(self):
         return self.__shutdown
 
+    def get_metrics(self):
+        return self.__metrics
+
+    def get_cache(self, function_name):
+        return self.__functions.get_cache(function_name)
+
+    def sheds_calls(self):
+        """Returns whether calls may be shed before they are performed."""
+        return self.__admission.sheds()
+
+    def overloaded(self, function_name):
+        """
+        Checks whether a call would be shed, so that the workers can refuse
+        it before unmarshalling it.
+        @rtype: str
+        @return: None or the message to refuse the call with.
+        """
+        return self.__admission.check(function_name)
+
+    def park(self, connection):
+        """Starts watching a connection that has no thread serving it."""
+        self.__loop.call_soon_threadsafe(self.__loop.add_handler, connection, READ)
+
+    def unpark(self, connection):
+        """
+        Stops watching a connection. Must be called from the thread of the
+        server.
+        """
+        self.__loop.remove_handler(connection)
+
     def get_function(self, function_name):
-        if self.__functions.has_key(function_name):
-            return self.__functions[function_name]
-        else:
-            return None
+        return self.__functions.get(function_name)
+
+    def get_record(self, function_name):
+        return self.__functions.get_record(function_name)
+
+    def get_numbered(self, number):
+        return self.__functions.get_numbered(number)
+
+    def function_numbers(self):
+        return self.__functions.numbers()
+
+    def accepts_uploads(self, function_name):
+        """
+        Checks whether a function may be passed uploads. Uploads cannot be
+        sent to worker processes.
+        """
+        return self.__functions.get_executor(function_name) != 'process'
+
+    def allowed_serializers(self):
+        return self.__serializers
+
+    def allowed_codecs(self):
+        return self.__codecs
+
+    def allows_shared_memory(self):
+        return self.__shared_memory
+
+    def default_serializer(self):
+        """Returns the serializer of connections that negotiate none."""
+        if DEFAULT_SERIALIZER.name in self.__serializers:
+            return DEFAULT_SERIALIZER
+        return None
+
+    def perform(self, record, argument_list, serializer, stream=False, timings=None, token=None):
+        """
+        Calls a registered function using the executor it was registered 
+        with. Called by the workers.
+        @type record: SCDispatchRecord
+        @param record: The dispatch record of the function.
+        @type serializer: Serializer
+        @param serializer: The serializer to marshal the outcome with.
+        @type stream: bool
+        @param stream: Whether the client can receive streamed results. 
+        Generators do not survive the trip back from a worker process, so 
+        functions run in the process pool never stream.
+        @type timings: dict
+        @param timings: If given, the latencies of the call are added to it.
+        For functions run in the process pool, the marshalling of the 
+        outcome counts as executing.
+        @type token: CancellationToken
+        @param token: The cancellation token of the call. Functions run in
+        the process pool do not get it, but are not run once the call is no
+        longer wanted either.
+        @rtype: tuple
+        @return: The reply verb and payload parts, or NACK and the message
+        if the call has been shed.
+        @see: run_function
+        """
+        cache = record.cache
+        if cache == None:
+            return self.__admit(record, argument_list, serializer, stream, timings, token)
+
+        # Results are cached as marshalled by the serializer, and the results
+        # of generators differ depending on whether they may be streamed.
+        key = cache_key(record.name, argument_list)
+        variant = (serializer.name, stream)
+        if key != None:
+            payload = cache.get(key, variant)
+            if payload != None:
+                return RESULT, payload
+        generation = cache.generation()
+        verb, payload = self.__admit(record, argument_list, serializer, stream, timings, token)
+        if key != None and verb == RESULT:
+            cache.put(key, variant, payload, generation)
+        return verb, payload
+
+    def __admit(self, record, argument_list, serializer, stream, timings, token):
+        """
+        Calls a registered function once admission control admits the call.
+        Calls count as in flight until the function returns, so a stream
+        counts until its generator has been created.
+        @see: SCRPC.perform
+        """
+        message = self.__admission.enter(record.name, token)
+        if message != None:
+            return NACK, message
+        try:
+            return self.__perform(record, argument_list, serializer, stream, timings, token)
+        finally:
+            self.__admission.leave(record.name)
+
+    def __perform(self, record, argument_list, serializer, stream, timings, token):
+        """
+        Calls a registered function, bypassing its cache.
+        @see: SCRPC.perform
+        """
+        function = record.function
+        if record.executor == 'process':
+            if token != None and token.reason() != None:
+                return NACK, token.reason()
+            with self.__process_pool_lock:
+                if self.__process_pool == None:
+                    self.__process_pool = ProcessPool(SCRPC.PROCESS_POOL_SIZE)
+            started = time.time()
+            future = self.__process_pool.submit(run_function, function, argument_list, serializer.name)
+            outcome = wait_for_process(future, serializer, token)
+            if timings != None:
+                timings['execute'] = time.time() - started
+            return outcome
+        return run_function(function, argument_list, serializer.name, stream, timings, token)
     
     def remove_connection(self, connection):
         with self.__connections_lock:
             self.__connections.remove(connection)
+        if self.__metrics != None:
+            self.__metrics.connection_closed()
     
     def add_connection(self, connection):
         with self.__connections_lock:
             self.__connections.append(connection)
+        if self.__metrics != None:
+            self.__metrics.connection_opened()
         
     def get_address(self):
         return self.__server_sock.addr
@@ -248,7 +1563,7 @@ class SCRPC(Thread):
     def debug_print(self):
         print 'Registered functions:', self.__functions
 
-    def register_function(self, rpc_function, rpc_name=''):
+    def register_function(self, rpc_function, rpc_name='', executor='thread', cache=None, max_calls=None):
         """
         Registers a new function with the RPC server. This function may 
         afterwards be called by remote clients.
@@ -257,20 +1572,163 @@ class SCRPC(Thread):
         @type rpc_name: str
         @param rpc_name: An (optional) name to use for the function. If this is not
         given the functions original name is used.
+        @type executor: str
+        @param executor: Where the function is performed. 'thread' (the 
+        default) calls it in the thread serving the connection. 'process' 
+        sends the call to a pool of PROCESS_POOL_SIZE worker processes, which
+        lets CPU-bound functions use more than one core. Such functions must
+        be defined at module level.
+        @type cache: ResultCache
+        @param cache: The cache to keep the results of the function in, or 
+        True for a ResultCache of its own with the default size. Only cache
+        functions whose results depend on nothing but their arguments. Calls
+        with unhashable arguments (e.g. lists) or uploads are not cached.
+        Clients that keep a cache (see SCProxy) cache the results as well,
+        until they are invalidated.
+        @type max_calls: int
+        @param max_calls: The maximum number of calls of the function 
+        performed at once, or None for no limit. Further calls wait in the
+        queue of the server (see __init__).
         """
-        # Do simple type-checking.
-        if not type(rpc_function) in (FunctionType, MethodType) or type(rpc_name) != StringType:
-            raise TypeError('Arguments of invalid type given.')
-        
-        # Check that the name is not already taken.
-        if rpc_name == '':
-            rpc_name = rpc_function.__name__
-        if self.__functions.has_key(rpc_name):
-            raise SCRPC.Error('The function name %s is already taken.' % rpc_name)
+        if max_calls != None and max_calls < 1:
+            raise ValueError('Invalid maximum number of calls (%i)' % max_calls)
+        record = self.__functions.register(rpc_function, rpc_name, executor, cache)
+        self.__admission.set_limit(record.name, max_calls)
         
-        # Add the function to the list.
-        self.__functions[rpc_name] = rpc_function
+        # Clients calling functions by number learn the number of the new one.
+        with self.__connections_lock:
+            connections = list(self.__connections)
+        for connection in connections:
+            connection.announce(record)
+
+    def invalidate_cache(self, function_name=None, *argument_list):
+        """
+        Forgets cached results, e.g. after the data behind a function has
+        changed. The clients that cache results are told to forget them too.
+        @type function_name: str
+        @param function_name: The function whose results to forget, or None
+        for all cached functions.
+        @param argument_list: The arguments of the call whose result to 
+        forget. Without them, all results of the function are forgotten.
+        """
+        argument_list = argument_list or None
+        if function_name == None:
+            for cache in self.__functions.caches().itervalues():
+                cache.invalidate()
+        else:
+            cache = self.__functions.get_cache(function_name)
+            if cache == None:
+                return
+            cache.invalidate(function_name, argument_list)
+        with self.__connections_lock:
+            connections = list(self.__connections)
+        for connection in connections:
+            connection.invalidate(function_name, argument_list)
+
+    def publish(self, topic, value):
+        """
+        Publishes a value on a topic. The value is pushed to the clients 
+        subscribed to the topic (see SCProxy.subscribe), and to those that
+        subscribe later, until another value is published. Clients that 
+        fall behind skip values (see pubsub).
+        @type topic: str
+        @param topic: The topic. It must not contain newlines.
+        @param value: The value. It is marshalled right away.
+        @rtype: int
+        @return: The number of clients the value has been pushed to.
+        @raise TypeError: If the topic is not a str.
+        @raise ValueError: If the topic contains a newline.
+        """
+        if type(topic) != StringType:
+            raise TypeError('Arguments of invalid type given.')
+        if '\n' in topic:
+            raise ValueError('Invalid topic (%r)' % topic)
+        # Values are queued with the lock held, so that every client gets 
+        # the values of a topic in the order they were published.
+        payloads = {}
+        with self.__topics_lock:
+            self.__published[topic] = value
+            subscribers = self.__subscribers.get(topic, ())
+            for connection in subscribers:
+                connection.push(topic, value, payloads)
+            return len(subscribers)
+
+    def subscribe(self, connection, topic):
+        """
+        Subscribes a connection to a topic, and pushes the latest value 
+        published on it. Called by the workers.
+        """
+        with self.__topics_lock:
+            self.__subscribers.setdefault(topic, set()).add(connection)
+            if self.__published.has_key(topic):
+                connection.push(topic, self.__published[topic], {})
+
+    def unsubscribe(self, connection, topic=None):
+        """
+        Unsubscribes a connection from a topic, or from all topics if topic
+        is None. Called by the workers.
+        """
+        with self.__topics_lock:
+            if topic == None:
+                topics = self.__subscribers.keys()
+            else:
+                topics = [topic]
+            for topic in topics:
+                subscribers = self.__subscribers.get(topic)
+                if subscribers == None:
+                    continue
+                subscribers.discard(connection)
+                if len(subscribers) == 0:
+                    del self.__subscribers[topic]
+
+    def subscription_stats(self):
+        """
+        @rtype: dict
+        @return: The number of subscribers per topic, and the values pushed
+        to the subscribed clients ('pushed', 'coalesced' and 'dropped', see
+        PushQueue.stats) in total.
+        """
+        with self.__topics_lock:
+            topics = dict([(topic, len(subscribers)) for topic, subscribers in self.__subscribers.iteritems()])
+        with self.__connections_lock:
+            connections = list(self.__connections)
+        totals = {'pushed': 0, 'coalesced': 0, 'dropped': 0}
+        for connection in connections:
+            stats = connection.push_stats()
+            if stats != None:
+                for key in totals:
+                    totals[key] += stats[key]
+        totals['topics'] = topics
+        return totals
+
+    def admission_stats(self):
+        """
+        @rtype: dict
+        @return: The calls in flight, queued and shed (see 
+        AdmissionControl.stats).
+        """
+        return self.__admission.stats()
+
+    def cache_stats(self):
+        """
+        @rtype: dict
+        @return: The statistics (see ResultCache.stats) of the cache of each
+        cached function, indexed by function name.
+        """
+        return dict([(function_name, cache.stats())
+                     for function_name, cache in self.__functions.caches().iteritems()])
             
+    def __serve_metrics(self, format='snapshot'): #IGNORE:W0622
+        """
+        The function serving the metrics of the server as METRICS_FUNCTION.
+        @type format: str
+        @param format: 'snapshot' for the dict returned by Metrics.snapshot,
+        or 'prometheus' for the Prometheus text format.
+        """
+        if format == 'prometheus':
+            return self.__metrics.prometheus()
+        return self.__metrics.snapshot()
+
     def stop(self, block=False):
         """Stop the RPC server thread.
         @type block: bool
@@ -278,6 +1736,7 @@ class SCRPC(Thread):
         closed down properly.
         """
         self.__shutdown = True
+        self.__loop.stop()
         
         if block:
             self.__shutdown_signal.acquire()
@@ -289,28 +1748,80 @@ class SCRPC(Thread):
         making the SCRPC object unusable.
         """
         self.__server_sock.close()
+        self.__loop.close()
+        if self.__process_pool != None:
+            self.__process_pool.shutdown(False)
 
     def run(self):
         """
-        Main thread function.
+        Main thread function. Accepts connections and watches the parked 
+        ones until stop is called.
         """
         self.__shutdown_signal.acquire()
         self.__shutdown = False
-        
-        while not self.__shutdown:
-        # Wait for an incoming connection attempt.
-            try:
-                # Accept an incoming connection attempt.
-                new_sock = self.__server_sock.accept()
-                # Create a new worker thread and start it.
-                connection = SCWorker(new_sock, self)
-                connection.start()
-            except TimedSocket.Timeout:
-                continue
+
+        self.__loop.add_handler(self, READ)
+        self.__loop.run()
+        self.__loop.remove_handler(self)
+
+        # Make the workers leave.
+        with self.__connections_lock:
+            connections = list(self.__connections)
+        for connection in connections:
+            connection.interrupt()
                     
         # Reset the shutdown indicator.
         self.__shutdown_signal.release()
 
+    def handle_read(self):
+        """Accepts pending connections on the server socket."""
+        while not self.__shutdown:
+            try:
+                new_sock = TimedSocket(type=self.__server_sock.socket_type, 
+                                       wrap=self.__server_sock.sock.accept())
+            except socket_error:
+                return
+            self.__serve(new_sock)
+
+    def add_socket(self, sock):
+        """
+        Serves a connection that was not accepted by the server, e.g. one end
+        of a socket.socketpair shared with a child process, whose other end
+        is passed to SCProxy as the address.
+        @type sock: socket
+        @param sock: The connected native socket.
+        """
+        peer = sock.getpeername()
+        self.__serve(TimedSocket(type=address_type(peer), wrap=(sock, peer)))
+
+    def __serve(self, new_sock):
+        """Starts a worker serving a new connection."""
+        if self.__max_connections != None and \
+           len(self.__connections) >= self.__max_connections:
+            self.__refuse_connection(new_sock)
+            return
+        # Create a new worker and start it.
+        logging.getLogger('SCRPC (server)').debug('SCRPC worker spawned, peer=%s.' %
+                                                  format_address(new_sock.addr))
+        connection = SCWorker(new_sock, self)
+        self.add_connection(connection)
+        connection.start()
+
+    def handle_write(self):
+        pass
+
+    def handle_close(self):
+        pass
+
+    def __refuse_connection(self, sock):
+        """Tells a new client that the server is busy and disconnects it."""
+        logging.getLogger('SCRPC (server)').debug('Refusing connection, peer=%s.' % format_address(sock.addr))
+        try:
+            sock.send_lp('%s %s' % (NACK, busy_message('too many connections')), 1.0)
+        except:
+            pass
+        sock.close()
+
     def __wait_for_connection(self):
         """Waits for a connection to arrive on the server socket."""
         # Wait for an incoming connection attempt.
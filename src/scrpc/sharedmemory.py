@@ -0,0 +1,225 @@
+"""
+Shared memory transfer of large frame payloads between a client and a
+server on the same host (see protocol). A payload is written to a file in
+SHARED_MEMORY_DIR, which is a memory file system where there is one, and
+only the name and the size of the file are sent over the connection. The
+receiver maps the file without copying it, so the payload is copied once
+instead of being pushed through the socket.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from protocol import FLAG_SHARED
+from errno import ENOENT
+import tempfile
+import logging
+import mmap
+import os
+import re
+
+# Payloads smaller than this are sent over the connection.
+SHARED_MEMORY_THRESHOLD = 1048576
+
+# The directory holding the payloads in transfer.
+if os.path.isdir('/dev/shm'):
+    SHARED_MEMORY_DIR = '/dev/shm'
+else:
+    SHARED_MEMORY_DIR = tempfile.gettempdir()
+
+# The prefix of the payload files. Peers cannot name any other files.
+_PREFIX = 'scrpc-'
+_NAME = re.compile(r'^%s[A-Za-z0-9_]+$' % _PREFIX)
+
+# The number of payloads sent after which those that have been received
+# are no longer tracked.
+_PRUNE_LIMIT = 64
+
+class SharedMemoryError(Exception):
+    """Raised when a shared payload cannot be mapped."""
+    def __init__(self, msg):
+        super(SharedMemoryError, self).__init__(msg)
+
+def is_local(address):
+    """
+    Checks whether the peer at an address may be on this host: it is 
+    connected over a Unix domain socket (or a socketpair) or the loopback
+    interface. A local peer may still not be able to reach our files, 
+    which check_probe tells.
+    """
+    if not isinstance(address, tuple):
+        return True
+    host = address[0]
+    return host.startswith('127.') or host in ('::1', 'localhost') or host.startswith('::ffff:127.')
+
+def create_probe():
+    """
+    Creates the empty file a peer checks that it can reach our payloads
+    with during negotiation.
+    @rtype: str
+    @return: The name of the file, or None if it cannot be created.
+    """
+    try:
+        handle, path = tempfile.mkstemp(prefix=_PREFIX, dir=SHARED_MEMORY_DIR)
+        os.close(handle)
+    except EnvironmentError:
+        logging.getLogger('SCRPC (shm)').debug('probe', exc_info=True)
+        return None
+    return os.path.basename(path)
+
+def remove_probe(name):
+    """Removes a probe file the peer has not removed."""
+    if name != None:
+        _remove(name)
+
+def check_probe(name):
+    """
+    Checks that the payloads of a peer can be passed through shared memory
+    in both directions. The probe file created by the peer is opened and
+    removed the way payloads are mapped, and it must be owned by our user,
+    as payload files can only be read by their owner.
+    @type name: str
+    @param name: The name of the probe file, or None if the peer has sent
+    none.
+    @rtype: bool
+    """
+    if name == None or _NAME.match(name) == None:
+        return False
+    path = os.path.join(SHARED_MEMORY_DIR, name)
+    try:
+        handle = os.open(path, os.O_RDONLY)
+    except OSError:
+        logging.getLogger('SCRPC (shm)').debug('probe', exc_info=True)
+        return False
+    try:
+        os.unlink(path)
+        return os.fstat(handle).st_uid == os.geteuid()
+    except OSError:
+        logging.getLogger('SCRPC (shm)').debug('probe', exc_info=True)
+        return False
+    finally:
+        os.close(handle)
+
+class SharedPayloads(object):
+    """
+    The shared payloads sent on one connection. Payloads are removed by
+    the receiver; close removes those that never got there.
+    """
+
+    def __init__(self, threshold=SHARED_MEMORY_THRESHOLD):
+        """
+        Constructor.
+        @type threshold: int
+        @param threshold: The size from which payloads are shared. Empty
+        payloads are never shared.
+        """
+        super(SharedPayloads, self).__init__()
+        self.threshold = max(threshold, 1)
+        self.__sent = set()
+        self.__lock = allocate_lock()
+
+    def share(self, flags, payload):
+        """
+        Writes a payload to shared memory if it is large enough.
+        @type flags: str
+        @param flags: The frame flags of the payload.
+        @type payload: str or tuple
+        @param payload: The payload or the parts of it.
+        @rtype: tuple
+        @return: The frame flags and the payload to send.
+        """
+        if isinstance(payload, str):
+            payload = (payload, )
+        length = 0
+        for part in payload:
+            length += len(part)
+        if length < self.threshold:
+            return flags, payload
+
+        try:
+            handle, path = tempfile.mkstemp(prefix=_PREFIX, dir=SHARED_MEMORY_DIR)
+        except EnvironmentError:
+            # The payload is sent over the connection instead.
+            logging.getLogger('SCRPC (shm)').debug('share', exc_info=True)
+            return flags, payload
+        name = os.path.basename(path)
+        try:
+            output = os.fdopen(handle, 'wb')
+            try:
+                for part in payload:
+                    output.write(part)
+            finally:
+                output.close()
+        except EnvironmentError:
+            # The file system is probably full.
+            logging.getLogger('SCRPC (shm)').debug('share', exc_info=True)
+            _remove(name)
+            return flags, payload
+        with self.__lock:
+            if len(self.__sent) >= _PRUNE_LIMIT:
+                self.__sent = set([sent for sent in self.__sent
+                                   if os.path.exists(os.path.join(SHARED_MEMORY_DIR, sent))])
+            self.__sent.add(name)
+        return flags + FLAG_SHARED, ('%s %i' % (name, length), )
+
+    def discard(self, flags, payload):
+        """Removes a shared payload that could not be sent."""
+        if FLAG_SHARED not in flags:
+            return
+        name = payload[0].split(' ')[0]
+        with self.__lock:
+            self.__sent.discard(name)
+        _remove(name)
+
+    def close(self):
+        """Removes the payloads sent that have not been received."""
+        with self.__lock:
+            sent, self.__sent = self.__sent, set()
+        for name in sent:
+            _remove(name)
+
+def map_payload(shared, flags, payload):
+    """
+    Maps a frame payload if its flags say it is shared. The file is removed
+    once it is mapped, and the memory is freed with the payload returned.
+    @type shared: SharedPayloads
+    @param shared: The shared payloads of the connection, or None if 
+    shared memory has not been negotiated.
+    @type flags: str
+    @param flags: The frame flags.
+    @type payload: buffer
+    @param payload: The payload received.
+    @return: The payload.
+    @raise SharedMemoryError: If the payload cannot be mapped.
+    """
+    if FLAG_SHARED not in flags:
+        return payload
+    if shared == None:
+        raise SharedMemoryError('Shared payload received, but no shared memory was negotiated.')
+    try:
+        name, length = str(payload).split(' ')
+        length = int(length)
+    except ValueError:
+        raise SharedMemoryError('Invalid shared payload.')
+    if _NAME.match(name) == None or length <= 0:
+        raise SharedMemoryError('Invalid shared payload.')
+    path = os.path.join(SHARED_MEMORY_DIR, name)
+    try:
+        handle = os.open(path, os.O_RDONLY)
+    except OSError, excep:
+        raise SharedMemoryError('Error opening shared payload (%s).' % excep)
+    try:
+        os.unlink(path)
+        if os.fstat(handle).st_size != length:
+            raise SharedMemoryError('Shared payload has the wrong size.')
+        return buffer(mmap.mmap(handle, length, access=mmap.ACCESS_READ))
+    except EnvironmentError, excep:
+        raise SharedMemoryError('Error mapping shared payload (%s).' % excep)
+    finally:
+        os.close(handle)
+
+def _remove(name):
+    try:
+        os.unlink(os.path.join(SHARED_MEMORY_DIR, name))
+    except OSError, excep:
+        if excep.errno != ENOENT:
+            logging.getLogger('SCRPC (shm)').debug('remove', exc_info=True)
@@ -0,0 +1,59 @@
+"""
+Support for streaming the items produced by generator functions. Instead
+of one RESULT frame, the server answers a call of a generator function
+with a STREAM frame, CHUNK frames holding batches of items and an END
+frame (or an EXCEPTION frame if the generator raises). The server never
+has more than STREAM_WINDOW chunks in flight: the client grants another
+chunk with a MORE frame whenever it has consumed one, and may end the
+stream early with a STOP frame.
+"""
+
+from __future__ import with_statement
+from threading import Condition
+
+# The maximum number of items sent in one chunk.
+STREAM_BATCH = 64
+
+# The number of chunks the server may send before the client grants more.
+STREAM_WINDOW = 8
+
+class StreamWindow(object):
+    """
+    Counts the chunks a server thread may still send on a stream before it
+    has to wait for the client.
+    """
+
+    def __init__(self, size=STREAM_WINDOW):
+        super(StreamWindow, self).__init__()
+        self.__credits = size
+        self.__stopped = False
+        self.__condition = Condition()
+
+    def grant(self, count):
+        """Allows count more chunks to be sent. Called for MORE frames."""
+        with self.__condition:
+            self.__credits += count
+            self.__condition.notify()
+
+    def stop(self):
+        """Ends the stream. Called for STOP frames and on disconnect."""
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+
+    def acquire(self, timeout):
+        """
+        Waits until another chunk may be sent.
+        @type timeout: float
+        @param timeout: The maximum number of seconds to wait.
+        @rtype: bool
+        @return: False if the stream has been stopped or the client has not
+        granted a chunk within the timeout.
+        """
+        with self.__condition:
+            if self.__credits == 0 and not self.__stopped:
+                self.__condition.wait(timeout)
+            if self.__stopped or self.__credits == 0:
+                return False
+            self.__credits -= 1
+            return True
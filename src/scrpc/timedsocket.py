@@ -1,13 +1,125 @@
 """
 A socket wrapper that offers timed (semi-blocking) calls
-to all required socket functions. Essentially this is just 
-a socket class using select() to see if anything is available 
-_before_ entering the blocking socket calls.
+to all required socket functions. The native socket is kept in 
+non-blocking mode. Every call first tries the socket operation and only
+waits for the socket (with poll, or select where poll is unavailable) if
+the operation would block, so transfers take one system call per buffer
+while data keeps flowing.
+
+Addresses are (host, port) tuples for TCP, or the path of a Unix domain
+socket, which spares calls between processes on the same host the TCP
+loopback stack.
 """
 
-from socket import socket, SOCK_DGRAM, SOCK_STREAM, AF_INET
-from select import select
+from socket import socket, error as socket_error, SOCK_DGRAM, SOCK_STREAM, AF_INET, SHUT_RDWR
+from errno import EAGAIN, EWOULDBLOCK, EINTR, ECONNREFUSED, ENOENT
+import select
 import struct
+import stat
+import time
+import os
+
+# Unix domain sockets are not available on every platform.
+try:
+    from socket import AF_UNIX
+except ImportError:
+    AF_UNIX = None
+
+# Message parts smaller than this are joined before sending.
+LP_COPY_LIMIT = 65536
+
+# Unlike select, poll is not limited to file descriptors below FD_SETSIZE.
+if hasattr(select, 'poll'):
+    _POLL_READ = select.POLLIN | select.POLLPRI
+    _POLL_WRITE = select.POLLOUT
+else:
+    _POLL_READ = _POLL_WRITE = None
+
+# The errors meaning that a non-blocking operation has to be retried later.
+_RETRY_ERRORS = (EAGAIN, EWOULDBLOCK, EINTR)
+
+def pack_lp(msg):
+    """
+    Prefixes a message with its length for sending. Small parts are joined
+    with the prefix, while large parts are left in their own memory.
+    @type msg: str or tuple
+    @param msg: The message or the parts of the message.
+    @rtype: list
+    @return: The buffers to send, in order.
+    """
+    if isinstance(msg, str):
+        parts = (msg, )
+    else:
+        parts = msg
+    length = 0
+    for part in parts:
+        length += len(part)
+    
+    pending = [struct.pack('!I', length)]
+    buffers = []
+    for part in parts:
+        if len(part) < LP_COPY_LIMIT:
+            pending.append(part)
+        else:
+            buffers.append(''.join(pending))
+            buffers.append(part)
+            pending = []
+    if len(pending) != 0:
+        buffers.append(''.join(pending))
+    return buffers
+
+def address_type(address):
+    """
+    @rtype: str
+    @return: The socket type of an address: 'unix' for a path, else 'tcp'.
+    """
+    if isinstance(address, basestring):
+        return 'unix'
+    return 'tcp'
+
+def format_address(address):
+    """Formats the address of a socket for log messages."""
+    if isinstance(address, tuple):
+        return '%s:%i' % address[:2]
+    return address or 'unnamed'
+
+def open_connection(address):
+    """
+    Connects to a server.
+    @param address: The (host, port) address or the Unix domain socket
+    path of the server, or a connected native socket (e.g. one end of a
+    socket.socketpair), which is wrapped.
+    @rtype: TimedSocket
+    """
+    if hasattr(address, 'fileno'):
+        peer = address.getpeername()
+        return TimedSocket(type=address_type(peer), wrap=(address, peer))
+    sock = TimedSocket(type=address_type(address))
+    try:
+        sock.connect(address)
+    except:
+        sock.close()
+        raise
+    return sock
+
+def remove_stale_socket(path):
+    """
+    Removes the Unix domain socket at path if no server is listening on it
+    any more, so that it can be bound again.
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except OSError:
+        return
+    probe = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket_error, excep:
+        if excep.args[0] in (ECONNREFUSED, ENOENT):
+            os.unlink(path)
+    finally:
+        probe.close()
 
 class TimedSocket(object):
     """
@@ -27,15 +139,20 @@ class TimedSocket(object):
 
     # Constants.
     TIMEOUT = 10
-    LP_RECV_CHUNK_TIMEOUT = 60
+    # The maximum number of seconds the transfer of a length-prefixed 
+    # message may take once it has begun.
+    LP_TIMEOUT = 600
+    # The size of the buffer that length-prefixed messages are read ahead
+    # into. Larger messages are received into a buffer of their own.
+    RECV_SIZE = 65536
 
     def __init__(self, **args):
         """
         Constructor.
         @type args: Keyword argument(s).
         @param args: Keyword args are accepted. Allowed keywords are 'type' and
-        'timeout'. 'type' designates the type of socket (udp or tcp) and 'timeout'
-        sets the default timeout period for blocking calls.
+        'timeout'. 'type' designates the type of socket (udp, tcp or unix) and 
+        'timeout' sets the default timeout period for blocking calls.
         @raise ValueError: If the timeout period or the socket type is invalid.
         """
         super(TimedSocket, self).__init__()
@@ -56,6 +173,8 @@ class TimedSocket(object):
                 self.sock = socket(AF_INET, SOCK_STREAM, 0)
             elif self.socket_type == 'udp':
                 self.sock = socket(AF_INET, SOCK_DGRAM, 0)
+            elif self.socket_type == 'unix' and AF_UNIX != None:
+                self.sock = socket(AF_UNIX, SOCK_STREAM, 0)
             else:
                 raise ValueError('Unknown socket type (%s)'%self.socket_type)
             self.addr = None
@@ -68,14 +187,88 @@ class TimedSocket(object):
                 raise ValueError('Invalid timeout period (%f)'%self.timeout)
         else:
             self.timeout = TimedSocket.TIMEOUT
-        self.sock.settimeout(self.timeout)
+        self.sock.setblocking(0)
+        # The path of the Unix domain socket bound, removed on close.
+        self.__path = None
+
+        # The read-ahead buffer and the start and end of the data in it
+        # that has not been consumed yet.
+        self.__input = None
+        self.__start = 0
+        self.__filled = 0
+    
+    def __deadline(self, timeout):
+        """
+        Computes the deadline of a call.
+        @type timeout: float
+        @param timeout: The timeout period of the call. None (or 0) means the
+        default timeout period.
+        @rtype: float
+        @raise ValueError: If the timeout value is invalid.
+        """
+        if not timeout:
+            timeout = self.timeout
+        elif timeout < 0:
+            raise ValueError('Invalid timeout period (%f)'%timeout)
+        return time.time() + timeout
+    
+    def __wait(self, writing, deadline):
+        """
+        Waits until the socket is ready for reading or writing.
+        @type writing: bool
+        @param writing: Whether to wait for writing rather than reading.
+        @type deadline: float
+        @param deadline: The time at which to give up.
+        @raise Timeout: If the deadline is reached.
+        """
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimedSocket.Timeout()
+            try:
+                if _POLL_READ != None:
+                    poller = select.poll()
+                    poller.register(self.sock, writing and _POLL_WRITE or _POLL_READ)
+                    ready = poller.poll(remaining * 1000)
+                elif writing:
+                    ready = select.select([], [self.sock], [self.sock], remaining)[1]
+                else:
+                    ready = select.select([self.sock], [], [self.sock], remaining)[0]
+            except select.error, excep:
+                if excep.args[0] != EINTR:
+                    raise
+                continue
+            if len(ready) != 0:
+                return
+    
+    def __call(self, writing, deadline, operation, *args):
+        """
+        Performs a non-blocking socket operation, waiting for the socket 
+        whenever the operation would block.
+        @type operation: function
+        @param operation: The native socket method to call with args.
+        @raise Timeout: If the deadline is reached.
+        """
+        while True:
+            try:
+                return operation(*args) #IGNORE:W0142
+            except socket_error, excep:
+                if excep.args[0] not in _RETRY_ERRORS:
+                    raise
+            self.__wait(writing, deadline)
     
     def bind(self, address):
         """
-        Direct wrapper of the bind function of a native socket.
+        Direct wrapper of the bind function of a native socket. A Unix 
+        domain socket left behind by a server that is gone is replaced.
         @see: socket.bind
         """
-        self.sock.bind(address)
+        if self.socket_type == 'unix':
+            remove_stale_socket(address)
+            self.sock.bind(address)
+            self.__path = address
+        else:
+            self.sock.bind(address)
         self.addr = self.sock.getsockname()
         
     def listen(self, backlog):
@@ -97,34 +290,20 @@ class TimedSocket(object):
         @raise ValueError: If the timeout value is invalid.
         @see: socket.accept
         """
-        # Set the timeout used for this command and start listening for 
-        # activity.
-        if not timeout:
-            timeout = self.timeout
-        else:
-            # Sanity check.
-            if timeout < 0:
-                raise ValueError('Invalid timeout period (%f)'%timeout)
-        (readers, _, exceptions) = select([self.sock], [], [self.sock], timeout)
-        
-        # Check for exceptions - this probably means something is wrong.
-        if len(exceptions) != 0:
-            raise TimedSocket.Exception('Connection broken?')
-        
-        # Check for activity on the socket.
-        if len(readers) != 0:
-            connection = self.sock.accept()
-            return TimedSocket(type='tcp', wrap=connection)
-        # No activity means that the timeout was reached.
-        else:
-            raise TimedSocket.Timeout()
+        connection = self.__call(False, self.__deadline(timeout), self.sock.accept)
+        return TimedSocket(type=self.socket_type, wrap=connection)
     
     def connect(self, address):
         """
-        Wrapper of the native connect call.
+        Wrapper of the native connect call. It blocks for at most the 
+        default timeout period.
         @see: socket.connect
         """
-        self.sock.connect(address)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(address)
+        finally:
+            self.sock.setblocking(0)
     
     def send(self, message, timeout=None):
         """
@@ -139,26 +318,7 @@ class TimedSocket(object):
         @raise ValueError: If the timeout value is invalid.
         @see: socket.send
         """
-        # Set the timeout used for this command and start listening.
-        if not timeout:
-            timeout = self.timeout
-        else:
-            # Sanity check.
-            if timeout < 0:
-                raise ValueError('Invalid timeout period (%f)'%timeout)
-
-        (_, writers, exceptions) = select([], [self.sock], [self.sock], timeout)
-        
-        # Check for exceptions - this probably means something is wrong.
-        if len(exceptions) != 0:
-            raise TimedSocket.Exception('Connection broken?')
-
-        # Check to see if the socket is ready to receive data.
-        if len(writers) != 0:
-            return self.sock.send(message)
-        else:
-            # The timeout must have been reached.
-            raise TimedSocket.Timeout()
+        return self.__call(True, self.__deadline(timeout), self.sock.send, message)
     
     def recv(self, buffersize, timeout=None):
         """
@@ -171,91 +331,207 @@ class TimedSocket(object):
         @return: The message that was read from the socket.
         @raise Timeout: If the timeout is reached before data arrives.
         @raise ValueError: If the timeout value is invalid.
-        @raise TimedSocket.Exception: If an error occurs on the native socket.
         @see: socket.recv
         """
-        # Set the timeout used for this command and start listening for 
-        # activity.
-        if not timeout:
-            timeout = self.timeout
-        else:
-            # Sanity check.
-            if timeout < 0:
-                raise ValueError('Invalid timeout period (%f)'%timeout)
-        
-        (readers, _, exceptions) = select([self.sock], [], [self.sock], timeout)
-        
-        # Check for exceptions - this probably means something is wrong.
-        if len(exceptions) != 0:
-            raise TimedSocket.Exception('Connection broken?')
-        
-        # Check for activity on the socket.
-        if len(readers) != 0:
-            return self.sock.recv(buffersize)
-        else:
-            # The command timed out.
-            raise TimedSocket.Timeout()
+        if self.__filled > self.__start:
+            return str(self.__take(buffersize))
+        return self.__call(False, self.__deadline(timeout), self.sock.recv, buffersize)
+    
+    def recv_into(self, buf, timeout=None):
+        """
+        Semi-blocking receive call reading straight into a writable buffer.
+        @type buf: memoryview
+        @param buf: The buffer to fill. At most len(buf) bytes are read.
+        @type timeout: float
+        @param timeout: A custom timeout period used for this one function call.
+        @rtype: int
+        @return: The number of bytes read. 0 means that the peer has closed 
+        the connection.
+        @raise Timeout: If the timeout is reached before data arrives.
+        @raise ValueError: If the timeout value is invalid.
+        @see: socket.recv_into
+        """
+        if self.__filled > self.__start:
+            data = self.__take(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+        return self.__call(False, self.__deadline(timeout), self.sock.recv_into, buf)
     
     def send_lp(self, msg, timeout=None):
         """
         A length-prefixed send method. This method simply prefixes the length 
         of the message as an unsigned int (4 bytes) before sending the message.
+        The message may be given as a sequence of parts (e.g. a header and a
+        payload). Large parts are sent straight from their own memory 
+        instead of being copied into a single message first.
+        @type msg: str or tuple
+        @param msg: The message or the parts of the message.
+        @type timeout: float
+        @param timeout: The timeout period for sending the whole message.
+        Defaults to LP_TIMEOUT.
+        @raise Timeout: If the timeout is reached. Part of the message may 
+        have been sent.
         @see: TimedSocket.send
         """
         #print 'send ->', msg #DEBUG
-        message = struct.pack('!I', len(msg)) + msg
-        length = len(message)
-        sent = 0
-        while sent < length:
-            sent += self.send(message[sent:sent+4096], timeout)
+        deadline = self.__deadline(timeout or TimedSocket.LP_TIMEOUT)
+        send = self.sock.send
+        for data in pack_lp(msg):
+            length = len(data)
+            sent = self.__call(True, deadline, send, data)
+            while sent < length:
+                sent += self.__call(True, deadline, send, buffer(data, sent))
                 
     def recv_lp(self, timeout=None):
         """
         A length-prefixed version of the recv call. This method assumes that 
         messages are prefixed by an unsigned int designating the length of 
         the message.
+        @rtype: str
         @raise TimedSocket.Exception: If the lp format is incorrect.
-        @see: TimedSocket.recv
+        @see: TimedSocket.recv_lp_buffer
         """
-        # Wait for the message length indicator.
-        try:
-            msg = self.recv(4, timeout)
-            if msg == '':
-                # The connection has been closed.
-                return msg
-            (msg_length, ) = struct.unpack("!I", msg)
-        except struct.error:
-            raise TimedSocket.Exception('Invalid format for lp-mode.')
+        return str(self.recv_lp_buffer(timeout))
     
-        # The message length has been read. Now receive the specified
-        # amount of bytes. 
-        timeout = TimedSocket.LP_RECV_CHUNK_TIMEOUT
-        timed_out = False
-        chunk_table = []
-        received_so_far = 0
-        while received_so_far < msg_length:
+    def recv_lp_buffer(self, timeout=None):
+        """
+        Like recv_lp but returns the message in a bytearray of its own. 
+        Data is read ahead into a buffer, so the length prefix and small 
+        messages take as few receive calls as possible, and messages that 
+        do not fit into the buffer are received straight into their own.
+        @type timeout: float
+        @param timeout: The timeout period for the start of a message. Once
+        it has begun, the rest of the message must arrive within LP_TIMEOUT.
+        @rtype: bytearray
+        @return: The message. It is empty if the connection has been closed.
+        @raise Timeout: If no message begins within the timeout.
+        @raise TimedSocket.Exception: If the connection breaks off in the
+        middle of a message.
+        @see: TimedSocket.recv_into
+        """
+        if self.__input == None:
+            self.__input = bytearray(TimedSocket.RECV_SIZE)
+
+        # Wait for the message length indicator, which may arrive in parts.
+        deadline = self.__deadline(timeout)
+        if self.__filled > self.__start:
+            deadline = time.time() + TimedSocket.LP_TIMEOUT
+        while self.__filled - self.__start < 4:
             try:
-                next_chunk_size = min(4096, msg_length - received_so_far) 
-                chunk = self.recv(next_chunk_size, timeout)
-                if chunk == '':
-                    # The connection has been closed.
-                    raise TimedSocket.Exception('Connection was closed unexpectably.')
-                chunk_table.append(chunk)
-                received_so_far += len(chunk)
-                timed_out = False
+                self.__fill(deadline, self.__filled > self.__start)
             except TimedSocket.Timeout:
-                if timed_out:
-                    raise TimedSocket.Exception('Not enough data was received.')
-                timed_out = True
-        
-        # The entire message has been read.
-        #print 'recv ->', msg #DEBUG
-        return ''.join(chunk_table)
+                # The connection is idle, and an idle connection holds no
+                # read-ahead buffer.
+                self.__release_input()
+                raise
+            if self.__filled == self.__start:
+                # The connection has been closed.
+                self.__release_input()
+                return bytearray()
+            deadline = time.time() + TimedSocket.LP_TIMEOUT
+        (msg_length, ) = struct.unpack_from('!I', self.__input, self.__start)
+        self.__start += 4
+
+        # Receive the rest of the message.
+        if msg_length > len(self.__input):
+            # The message is received straight into its own buffer.
+            message = bytearray(msg_length)
+            received_so_far = self.__filled - self.__start
+            message[:received_so_far] = self.__take(received_so_far)
+            view = memoryview(message)
+            while received_so_far < msg_length:
+                received_so_far += self.__receive(deadline, view[received_so_far:])
+            self.__release_input()
+            return message
+        # The header has been consumed, so the message has begun even if no
+        # more of it has been read yet.
+        while self.__filled - self.__start < msg_length:
+            self.__fill(deadline, True)
+        return self.__take(msg_length)
     
+    def buffered(self):
+        """
+        Returns the data that has been read ahead but not yet consumed, for
+        handing the socket over to other code.
+        @rtype: str
+        """
+        data = str(self.__take(self.__filled - self.__start))
+        self.__release_input()
+        return data
+    
+    def __release_input(self):
+        """Drops the read-ahead buffer if it holds no data."""
+        if self.__filled == self.__start:
+            self.__input = None
+            self.__start = 0
+            self.__filled = 0
+    
+    def __take(self, length):
+        """Consumes up to length bytes of the read-ahead buffer."""
+        data = self.__input[self.__start:min(self.__filled, self.__start + length)]
+        self.__start += len(data)
+        return data
+    
+    def __fill(self, deadline, begun):
+        """
+        Reads more data into the read-ahead buffer. The data that has not
+        been consumed is moved to the front first; it is never more than
+        part of one message.
+        @type begun: bool
+        @param begun: Whether a message has begun. Between messages, the
+        buffer is left empty if the connection is closed, and a timeout 
+        raises TimedSocket.Timeout.
+        @raise TimedSocket.Exception: If the connection is closed in the 
+        middle of a message or the deadline is reached.
+        """
+        if self.__start != 0:
+            self.__input[:self.__filled - self.__start] = self.__input[self.__start:self.__filled]
+            self.__filled -= self.__start
+            self.__start = 0
+        if not begun:
+            # Between messages a timeout is not an error.
+            received = self.__call(False, deadline, self.sock.recv_into, self.__input)
+            if received == 0:
+                return
+        else:
+            received = self.__receive(deadline, memoryview(self.__input)[self.__filled:])
+        self.__filled += received
+    
+    def __receive(self, deadline, view):
+        """
+        Receives part of a message that has begun.
+        @rtype: int
+        @raise TimedSocket.Exception: If the connection is closed or the 
+        deadline is reached.
+        """
+        try:
+            received = self.__call(False, deadline, self.sock.recv_into, view)
+        except TimedSocket.Timeout:
+            raise TimedSocket.Exception('Not enough data was received.')
+        if received == 0:
+            # The connection has been closed.
+            raise TimedSocket.Exception('Connection was closed unexpectably.')
+        return received
+    
+    def shutdown(self, how=SHUT_RDWR):
+        """
+        Wrapper around the shutdown call of native sockets. Unlike close
+        this wakes up any thread blocked waiting for the socket.
+        @see: socket.shutdown
+        """
+        self.sock.shutdown(how)
+
     def close(self):
         """
-        Wrapper around the close call of native sockets.
+        Wrapper around the close call of native sockets. The Unix domain 
+        socket bound is removed.
         @see: socket.close
         """
         self.sock.close()
+        if self.__path != None:
+            try:
+                os.unlink(self.__path)
+            except OSError:
+                pass
+            self.__path = None
         
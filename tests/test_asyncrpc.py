@@ -0,0 +1,93 @@
+"""Tests of the event loop based server."""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scrpc import AsyncSCRPC, SCProxy
+from scrpc.executor import ThreadPool
+from scrpc.protocol import NACK, SERVER_OVERLOADED
+from scrpc.serializers import get_serializer
+from scrpc.streaming import STREAM_BATCH
+from threading import Event
+import unittest
+
+class LimitedExecutor(object):
+    """An executor that takes a number of calls and no more."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.pool = ThreadPool(2)
+
+    def submit(self, function, *args):
+        if self.limit == 0:
+            raise ThreadPool.Full('Queue full.')
+        self.limit -= 1
+        return self.pool.submit(function, *args)
+
+class PullChunkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = LimitedExecutor(0)
+        self.server = AsyncSCRPC(('127.0.0.1', 0), executor=self.executor)
+
+    def tearDown(self):
+        self.server.teardown()
+        self.executor.pool.shutdown(False)
+
+    def pull(self, started):
+        replies = []
+        self.server.pull_chunk(iter([1]), get_serializer('pickle'), lambda *reply: replies.append(reply),
+                               started)
+        self.assertEqual(len(replies), 1)
+        self.assertEqual(replies[0][0], NACK)
+        return replies[0][1]
+
+    def test_full_before_first_chunk(self):
+        self.assertTrue(self.pull(False).startswith(SERVER_OVERLOADED))
+
+    def test_full_after_first_chunk(self):
+        # The generator has run, so the call must not be retried.
+        self.assertFalse(self.pull(True).startswith(SERVER_OVERLOADED))
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.closed = Event()
+        # The call and the first chunk are performed, the second chunk is
+        # refused.
+        self.executor = LimitedExecutor(2)
+        self.server = AsyncSCRPC(('127.0.0.1', 0), executor=self.executor)
+        self.server.register_function(self.items)
+        self.server.start()
+        self.proxy = SCProxy(self.server.get_address())
+
+    def tearDown(self):
+        self.proxy.close()
+        self.server.stop(True)
+        self.server.teardown()
+        self.executor.pool.shutdown(False)
+
+    def items(self):
+        try:
+            for item in xrange(STREAM_BATCH * 3):
+                yield item
+        finally:
+            self.closed.set()
+
+    def test_refused_chunk(self):
+        stream = self.proxy.items()
+        self.assertEqual([stream.next() for _ in xrange(STREAM_BATCH)], range(STREAM_BATCH))
+        try:
+            stream.next()
+        except SCProxy.Overloaded:
+            self.fail('A stream that has started must not be retried.')
+        except SCProxy.RemoteError:
+            pass
+        else:
+            self.fail('No exception raised.')
+        # The generator cut short is finalized.
+        self.assertTrue(self.closed.wait(1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+"""Tests of the result cache."""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scrpc.cache import ResultCache
+import unittest
+
+class ResultCacheTest(unittest.TestCase):
+
+    def test_entry_limit(self):
+        cache = ResultCache(size=2)
+        for key in range(3):
+            cache.put(key, 'pickle', ('x', ))
+        self.assertEqual(cache.get(0, 'pickle'), None)
+        self.assertEqual(cache.get(2, 'pickle'), ('x', ))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_limit(self):
+        cache = ResultCache(max_bytes=100, max_result_bytes=50)
+        cache.put(1, 'pickle', ('x' * 40, ))
+        cache.put(2, 'pickle', ('x' * 20, 'x' * 20))
+        cache.get(1, 'pickle')
+        cache.put(3, 'pickle', ('x' * 40, ))
+        # The least recently used call makes room.
+        self.assertEqual(cache.get(2, 'pickle'), None)
+        self.assertEqual(cache.get(1, 'pickle'), ('x' * 40, ))
+        self.assertEqual(cache.stats()['bytes'], 80)
+
+    def test_oversized_result(self):
+        cache = ResultCache(max_bytes=100, max_result_bytes=50)
+        cache.put(1, 'pickle', ('x' * 40, ))
+        cache.put(2, 'pickle', 'x' * 60)
+        self.assertEqual(cache.get(2, 'pickle'), None)
+        self.assertEqual(cache.get(1, 'pickle'), ('x' * 40, ))
+        stats = cache.stats()
+        self.assertEqual(stats['oversized'], 1)
+        self.assertEqual(stats['evictions'], 0)
+
+    def test_replaced_and_invalidated_bytes(self):
+        cache = ResultCache(max_bytes=100)
+        cache.put(('f', (1, ), (int, )), 'pickle', ('x' * 30, ))
+        cache.put(('f', (1, ), (int, )), 'pickle', ('x' * 10, ))
+        cache.put(('f', (1, ), (int, )), 'marshal', ('x' * 5, ))
+        self.assertEqual(cache.stats()['bytes'], 15)
+        cache.invalidate('f')
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
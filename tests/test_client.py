@@ -0,0 +1,72 @@
+"""Tests of SCProxy."""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scrpc import SCRPC, SCProxy
+import time
+import unittest
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+class Version1DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SCRPC(('127.0.0.1', 0))
+        self.server.register_function(sleep)
+        self.server.start()
+        self.proxy = SCProxy(self.server.get_address(), protocol=1)
+
+    def tearDown(self):
+        self.proxy.close()
+        self.server.stop(True)
+
+    def test_expired_deadline(self):
+        self.assertRaises(SCProxy.DeadlineExceeded, self.proxy.sleep, 0, deadline=time.time() - 1)
+        future = self.proxy.call_async('sleep', 0, deadline=time.time() - 1)
+        self.assertRaises(SCProxy.DeadlineExceeded, future.result)
+
+    def test_deadline(self):
+        started = time.time()
+        self.assertRaises(SCProxy.DeadlineExceeded, self.proxy.sleep, 1, timeout=0.2)
+        self.assertTrue(time.time() - started < 0.8)
+        # The late result of the abandoned call does not reach the next one.
+        self.assertEqual(self.proxy.sleep(0), 0)
+
+def double(value):
+    return value * 2
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SCRPC(('127.0.0.1', 0))
+        self.server.register_function(sleep)
+        self.server.register_function(double, cache=True)
+        self.server.start()
+        self.proxy = SCProxy(self.server.get_address(), cache=True)
+
+    def tearDown(self):
+        self.proxy.close()
+        self.server.stop(True)
+
+    def test_uncacheable_calls_skip_cache(self):
+        for _ in range(3):
+            self.assertEqual(self.proxy.sleep(0), 0)
+        stats = self.proxy.cache_stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 0)
+
+    def test_cacheable_calls(self):
+        # The first result is cached from the reply that marks it cacheable.
+        for _ in range(3):
+            self.assertEqual(self.proxy.double(2), 4)
+        stats = self.proxy.cache_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(self.proxy.double(3), 6)
+        self.assertEqual(self.proxy.cache_stats()['misses'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Tests of the framed connections of the event loop."""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scrpc.eventloop import EventLoop, FramedConnection
+from threading import Event
+from socket import socketpair
+import struct
+import unittest
+
+class RecordingConnection(FramedConnection):
+    """Records the frames received."""
+
+    def __init__(self, loop, sock, data=''):
+        self.frames = []
+        self.received = Event()
+        super(RecordingConnection, self).__init__(loop, sock, data)
+
+    def frame_received(self, frame):
+        self.frames.append(str(frame))
+        self.received.set()
+
+class FramedConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        ours, self.peer = socketpair()
+        self.connection = RecordingConnection(self.loop, ours)
+        self.thread = self.loop.run_in_thread()
+
+    def tearDown(self):
+        self.loop.stop()
+        self.thread.join(1)
+        self.loop.close()
+        self.connection.sock.close()
+        self.peer.close()
+
+    def wait_for(self, count):
+        while len(self.connection.frames) < count:
+            self.assertTrue(self.connection.received.wait(1))
+            self.connection.received.clear()
+
+    def sync(self):
+        """Waits until the loop has handled the events so far."""
+        done = Event()
+        self.loop.call_soon_threadsafe(done.set)
+        self.assertTrue(done.wait(1))
+
+    def test_idle_connection_holds_no_buffer(self):
+        self.assertEqual(self.connection._FramedConnection__input, None)
+        self.peer.sendall(struct.pack('!I', 5) + 'hello')
+        self.wait_for(1)
+        self.sync()
+        self.assertEqual(self.connection._FramedConnection__input, None)
+
+    def test_frame_in_parts(self):
+        self.peer.sendall(struct.pack('!I', 5) + 'he')
+        self.sync()
+        self.peer.sendall('llo' + struct.pack('!I', 3) + 'abc')
+        self.wait_for(2)
+        self.assertEqual(self.connection.frames, ['hello', 'abc'])
+        self.sync()
+        self.assertEqual(self.connection._FramedConnection__input, None)
+
+    def test_large_frame(self):
+        frame = 'x' * (FramedConnection.RECV_SIZE * 2)
+        self.peer.sendall(struct.pack('!I', len(frame)) + frame)
+        self.wait_for(1)
+        self.assertEqual(self.connection.frames, [frame])
+
+class EventLoopTest(unittest.TestCase):
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'Needs /proc to count file descriptors.')
+    def test_close_releases_descriptors(self):
+        before = len(os.listdir('/proc/self/fd'))
+        # The loops are kept, like the loop of a stopped server.
+        loops = [EventLoop() for _ in range(3)]
+        for loop in loops:
+            loop.close()
+        self.assertEqual(len(os.listdir('/proc/self/fd')), before)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Tests of the process pool executor."""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scrpc import SCRPC, SCProxy
+from scrpc.executor import ProcessPool
+import signal
+import time
+import unittest
+
+def double(value):
+    return value * 2
+
+def die():
+    os._exit(1)
+
+def unpicklable():
+    return lambda: None
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+class ProcessPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ProcessPool(2)
+
+    def tearDown(self):
+        self.pool.shutdown(False)
+
+    def test_result(self):
+        self.assertEqual(self.pool.submit(double, 21).result(5), 42)
+
+    def test_unpicklable_result(self):
+        future = self.pool.submit(unpicklable)
+        self.assertTrue(future.wait(5))
+        self.assertRaises(RuntimeError, future.result)
+
+    def test_worker_dies(self):
+        future = self.pool.submit(die)
+        self.assertTrue(future.wait(5))
+        self.assertRaises(ProcessPool.Broken, future.result)
+        # A new pool takes over.
+        self.assertEqual(self.pool.submit(double, 2).result(5), 4)
+
+    def test_worker_dies_while_idle(self):
+        workers = self.pool._ProcessPool__pool._pool
+        os.kill(workers[0].pid, signal.SIGKILL)
+        # Let Pool replace the worker and the watchdog look at the pool.
+        time.sleep(ProcessPool.WATCH_INTERVAL * 3)
+        # The call is pending while the watchdog checks the pool again.
+        future = self.pool.submit(sleep, ProcessPool.WATCH_INTERVAL * 2)
+        self.assertEqual(future.result(5), ProcessPool.WATCH_INTERVAL * 2)
+
+class ServerProcessPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SCRPC(('127.0.0.1', 0))
+        self.server.register_function(die, executor='process')
+        self.server.register_function(sleep, executor='process')
+        self.server.start()
+        self.proxy = SCProxy(self.server.get_address())
+
+    def tearDown(self):
+        self.proxy.close()
+        self.server.stop(True)
+
+    def test_worker_dies(self):
+        future = self.proxy.call_async('die')
+        self.assertTrue(future.wait(5))
+        self.assertRaises(ProcessPool.Broken, future.result)
+        self.assertEqual(self.proxy.sleep(0), 0)
+
+    def test_deadline(self):
+        started = time.time()
+        self.assertRaises(SCProxy.DeadlineExceeded, self.proxy.sleep, 5, timeout=0.3)
+        self.assertTrue(time.time() - started < 2)
+        # The server is not held up by the abandoned call.
+        self.assertEqual(self.proxy.sleep(0), 0)
+
+if __name__ == '__main__':
+    unittest.main()
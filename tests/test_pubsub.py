@@ -0,0 +1,40 @@
+"""Tests of the queues of values pushed to subscribers."""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scrpc.pubsub import PushQueue
+import unittest
+
+class PushQueueTest(unittest.TestCase):
+
+    def test_coalesce_before_full(self):
+        queue = PushQueue(4)
+        queue.put('a', 1)
+        queue.put('b', 1)
+        queue.put('a', 2)
+        self.assertEqual(queue.get(), ('a', 2))
+        self.assertEqual(queue.get(), ('b', 1))
+        stats = queue.stats()
+        self.assertEqual(stats['coalesced'], 1)
+        self.assertEqual(stats['dropped'], 0)
+
+    def test_drop_oldest_topic(self):
+        queue = PushQueue(2)
+        queue.put('a', 1)
+        queue.put('b', 1)
+        queue.put('b', 2)
+        queue.put('c', 1)
+        self.assertEqual(queue.get(), ('b', 2))
+        self.assertEqual(queue.get(), ('c', 1))
+        self.assertEqual(queue.stats()['dropped'], 1)
+
+    def test_close(self):
+        queue = PushQueue()
+        queue.put('a', 1)
+        queue.close()
+        self.assertEqual(queue.get(), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Tests of the negotiation of shared memory transfers."""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scrpc import SCRPC, SCProxy
+from scrpc import client
+from scrpc.sharedmemory import SHARED_MEMORY_DIR, check_probe, create_probe
+import unittest
+
+def echo(value):
+    return value
+
+def foreign_probe():
+    """Creates a probe file owned by another user."""
+    name = create_probe()
+    os.chown(os.path.join(SHARED_MEMORY_DIR, name), os.geteuid() + 1, -1)
+    return name
+
+class ProbeTest(unittest.TestCase):
+
+    def test_own_probe(self):
+        name = create_probe()
+        self.assertTrue(check_probe(name))
+        self.assertFalse(os.path.exists(os.path.join(SHARED_MEMORY_DIR, name)))
+
+    def test_missing_probe(self):
+        self.assertFalse(check_probe(None))
+        self.assertFalse(check_probe('scrpc-missing'))
+        self.assertFalse(check_probe('../etc/passwd'))
+
+    @unittest.skipUnless(os.geteuid() == 0, 'Changing the owner of a file needs root.')
+    def test_foreign_probe(self):
+        self.assertFalse(check_probe(foreign_probe()))
+
+class NegotiationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SCRPC(('127.0.0.1', 0))
+        self.server.register_function(echo)
+        self.server.start()
+        self.create_probe = client.create_probe
+
+    def tearDown(self):
+        client.create_probe = self.create_probe
+        self.server.stop(True)
+
+    def call(self):
+        proxy = SCProxy(self.server.get_address(), shared_memory=1024)
+        try:
+            value = 'x' * 4096
+            self.assertEqual(proxy.echo(value), value)
+            return proxy._SCProxy__shared != None
+        finally:
+            proxy.close()
+
+    def test_shared(self):
+        self.assertTrue(self.call())
+
+    @unittest.skipUnless(os.geteuid() == 0, 'Changing the owner of a file needs root.')
+    def test_unreachable_files(self):
+        client.create_probe = foreign_probe
+        self.assertFalse(self.call())
+
+    def test_no_probe(self):
+        client.create_probe = lambda: None
+        self.assertFalse(self.call())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Tests of the length-prefixed framing of TimedSocket."""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scrpc.timedsocket import TimedSocket
+from socket import socketpair
+import struct
+import unittest
+
+def connected_pair():
+    """Returns a TimedSocket and the native socket of its peer."""
+    ours, theirs = socketpair()
+    return TimedSocket(type='unix', wrap=(ours, '')), theirs
+
+class RecvLpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = connected_pair()
+        self.lp_timeout = TimedSocket.LP_TIMEOUT
+
+    def tearDown(self):
+        TimedSocket.LP_TIMEOUT = self.lp_timeout
+        self.sock.close()
+        self.peer.close()
+
+    def test_message_in_parts(self):
+        self.peer.sendall(struct.pack('!I', 5)[:2])
+        self.peer.sendall(struct.pack('!I', 5)[2:] + 'hel')
+        self.peer.sendall('lo')
+        self.assertEqual(self.sock.recv_lp(1), 'hello')
+
+    def test_close_between_messages(self):
+        self.peer.close()
+        self.assertEqual(self.sock.recv_lp(1), '')
+
+    def test_idle_timeout(self):
+        self.assertRaises(TimedSocket.Timeout, self.sock.recv_lp, 0.1)
+
+    def test_idle_connection_holds_no_buffer(self):
+        self.peer.sendall(struct.pack('!I', 5) + 'hello')
+        self.assertEqual(self.sock.recv_lp(1), 'hello')
+        self.assertRaises(TimedSocket.Timeout, self.sock.recv_lp, 0.1)
+        self.assertEqual(self.sock._TimedSocket__input, None)
+
+    def test_close_between_header_and_body(self):
+        self.peer.sendall(struct.pack('!I', 5))
+        self.peer.close()
+        self.assertRaises(TimedSocket.Exception, self.sock.recv_lp, 1)
+
+    def test_stall_between_header_and_body(self):
+        TimedSocket.LP_TIMEOUT = 0.1
+        self.peer.sendall(struct.pack('!I', 5))
+        try:
+            self.sock.recv_lp(1)
+        except TimedSocket.Timeout:
+            self.fail('A stalled message must not look like an idle connection.')
+        except TimedSocket.Exception:
+            pass
+        else:
+            self.fail('No exception raised.')
+
+    def test_close_in_large_message(self):
+        self.peer.sendall(struct.pack('!I', TimedSocket.RECV_SIZE * 2) + 'x' * 10)
+        self.peer.close()
+        self.assertRaises(TimedSocket.Exception, self.sock.recv_lp, 1)
+
+if __name__ == '__main__':
+    unittest.main()